@@ -0,0 +1,921 @@
+import argparse
+import contextlib
+import difflib
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MYVCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myvcs.py')
+MYVCS_CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myvcs_client.py')
+
+# Runs myvcs.py with an audit hook that counts the files and directories it opens, written
+# to the path given as the first argument when the process exits
+BOOTSTRAP = """
+import atexit, json, runpy, sys
+counts = {'open': 0, 'os.listdir': 0, 'os.scandir': 0}
+def count_event(event, args):
+    if event in counts:
+        counts[event] += 1
+def write_counts():
+    data = json.dumps(counts)
+    with open(stats_path, 'w') as stats_file:
+        stats_file.write(data)
+stats_path = sys.argv[1]
+sys.argv = sys.argv[2:]
+sys.addaudithook(count_event)
+atexit.register(write_counts)
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+def proc_io(pid='self'):
+    """Return the I/O counters of a process from /proc (empty where it is not available)."""
+    try:
+        with open(f'/proc/{pid}/io', 'r') as io_file:
+            return {key: int(value) for key, value in (line.split(': ') for line in io_file)}
+    except OSError:
+        return {}
+
+def run_myvcs(repo_dir, *args):
+    """
+    Run a myvcs command in repo_dir and return its measurements.
+
+    The result holds the wall time, the peak RSS, the bytes read and written and the read and
+    write syscalls (from /proc/<pid>/io), the blocks written to disk (accounted in 512-byte
+    units when pages are dirtied), the files and directories opened, and the command's output.
+    """
+    with tempfile.NamedTemporaryFile('r', suffix='.json') as stats_file:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-c', BOOTSTRAP, stats_file.name, MYVCS, *args], cwd=repo_dir,
+                                   stdout=subprocess.PIPE, text=True)
+        output = process.stdout.read()
+        process.stdout.close()
+        # Wait without reaping so /proc/<pid>/io can still be read, then collect the usage of
+        # this child alone with wait4 (unlike RUSAGE_CHILDREN)
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        elapsed = time.perf_counter() - start
+        io = proc_io(process.pid)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            raise RuntimeError(f"'myvcs {' '.join(args)}' failed in {repo_dir}")
+        counts = json.loads(stats_file.read() or '{}')
+    return {
+        'seconds': round(elapsed, 3),
+        'peak_rss_kb': usage.ru_maxrss,
+        'bytes_read': io.get('rchar'),
+        'bytes_written': io.get('wchar'),
+        'read_syscalls': io.get('syscr'),
+        'write_syscalls': io.get('syscw'),
+        'disk_bytes_written': usage.ru_oublock * 512,
+        'files_opened': counts.get('open'),
+        'directories_listed': counts.get('os.listdir', 0) + counts.get('os.scandir', 0) if counts else None,
+        'output': output,
+    }
+
+def commit_all(repo_dir, message):
+    """Stage every file in repo_dir, commit it and return the commit hash."""
+    run_myvcs(repo_dir, 'add', '-A')
+    return commit_staged(repo_dir, message)
+
+def commit_staged(repo_dir, message):
+    """Commit what is staged in repo_dir and return the commit hash."""
+    output = run_myvcs(repo_dir, 'commit', '-m', message)['output']
+    return re.search(r'hash: (\w+)', output).group(1)
+
+def stage_paths(repo_dir, paths, add_all=False):
+    """Stage paths (every file with add_all), one 'add' per file on revisions that take a single path."""
+    try:
+        run_myvcs(repo_dir, 'add', *(['-A'] if add_all else paths))
+    except RuntimeError:
+        for path in paths:
+            run_myvcs(repo_dir, 'add', path)
+
+def size_sampler(spec):
+    """
+    Return a function drawing file sizes from a distribution spec.
+
+    Specs are 'fixed:SIZE', 'uniform:MIN:MAX' or 'lognormal:MEDIAN:SIGMA' (most files small,
+    a few large, like real source trees), sizes written as accepted by parse_size.
+    """
+    kind, *values = spec.split(':')
+    if kind == 'fixed' and len(values) == 1:
+        size = parse_size(values[0])
+        return lambda rng: size
+    if kind == 'uniform' and len(values) == 2:
+        low, high = parse_size(values[0]), parse_size(values[1])
+        return lambda rng: rng.randint(low, high)
+    if kind == 'lognormal' and len(values) == 2:
+        median, sigma = parse_size(values[0]), float(values[1])
+        return lambda rng: int(rng.lognormvariate(math.log(median), sigma))
+    raise ValueError(f"Unknown size distribution '{spec}'.")
+
+def generate_tree(repo_dir, file_count, file_size, depth, seed=0):
+    """
+    Write file_count files spread over directories depth levels deep.
+
+    file_size is a size in bytes or a function drawing one from a random generator.
+    """
+    rng = random.Random(seed)
+    sizes = file_size if callable(file_size) else (lambda rng: file_size)
+    paths = []
+    for i in range(file_count):
+        parts = [f'd{rng.randrange(8)}' for _ in range(depth)]
+        folder = os.path.join(repo_dir, *parts)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'file{i}.txt')
+        with open(path, 'w') as file:
+            file.write(f'{i}\n' + 'x' * sizes(rng))
+        paths.append(path)
+    return paths
+
+def init_repo(repo_dir, *options):
+    """Create an empty repository in repo_dir, passing options on to 'init'."""
+    open(os.path.join(repo_dir, '.myvcsignore'), 'w').close()
+    run_myvcs(repo_dir, 'init', '-n', 'bench', '-e', 'bench@example.com', *options)
+
+def write_random_file(path, size):
+    """Write size bytes of incompressible data without holding them in memory."""
+    block = 1024 * 1024
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining > 0:
+            file.write(os.urandom(min(block, remaining)))
+            remaining -= block
+
+def parse_size(text):
+    """Parse sizes like '512K', '1M' or '10G' into bytes."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+def bench_add_memory(sizes):
+    """Stage one file of each size and record the wall time and peak RSS of 'add'."""
+    results = []
+    for size_text in sizes:
+        size = parse_size(size_text)
+        with tempfile.TemporaryDirectory() as repo_dir:
+            init_repo(repo_dir)
+            write_random_file(os.path.join(repo_dir, 'data.bin'), size)
+            run = run_myvcs(repo_dir, 'add', 'data.bin')
+        results.append({
+            'size': size_text,
+            'bytes': size,
+            'seconds': run['seconds'],
+            'mb_per_s': round(size / (1024 ** 2) / run['seconds'], 1),
+            'peak_rss_kb': run['peak_rss_kb'],
+        })
+        print(f"add {size_text:>6}: {run['seconds']:8.3f}s  peak RSS {run['peak_rss_kb'] / 1024:8.1f} MB", file=sys.stderr)
+    return results
+
+def bench_checkout(file_count, file_size, changed):
+    """Switch back and forth between two commits that differ in a few files."""
+    with tempfile.TemporaryDirectory() as repo_dir:
+        init_repo(repo_dir)
+        paths = generate_tree(repo_dir, file_count, file_size, depth=3)
+        first = commit_all(repo_dir, 'first')
+        for path in random.Random(1).sample(paths, changed):
+            with open(path, 'a') as file:
+                file.write('changed\n')
+        second = commit_all(repo_dir, 'second')
+
+        results = []
+        for target in (first, second):
+            run = run_myvcs(repo_dir, 'checkout', '-ch', target, '-f')
+            del run['output']
+            results.append(dict(run, target=target))
+            print(f"checkout {target[:8]}: {run['seconds']:8.3f}s  {run['disk_bytes_written'] / 1024:10.1f} KB written", file=sys.stderr)
+    return results
+
+def evict_page_cache(directory):
+    """Drop the cached pages of every file under directory, so the next read comes from disk."""
+    os.sync()
+    for folder, _, names in os.walk(directory):
+        for name in names:
+            with open(os.path.join(folder, name), 'rb') as file:
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def bench_materialize(file_count, file_size, jobs):
+    """
+    Check out a whole tree into an empty worktree, with each thread count, cold and warm.
+
+    'cold' evicts the object store from the page cache first (posix_fadvise, no root needed),
+    'warm' reads it from memory. A sparse checkout of one of the 8 top-level directories is
+    timed last.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as repo_dir:
+        init_repo(repo_dir)
+        generate_tree(repo_dir, file_count, file_size, depth=3)
+        commit = commit_all(repo_dir, 'first')
+
+        def materialize(threads, cache, count):
+            for name in os.listdir(repo_dir):
+                if name.startswith('d'):
+                    shutil.rmtree(os.path.join(repo_dir, name))
+            if cache == 'cold':
+                evict_page_cache(os.path.join(repo_dir, '.myvcs', 'objects'))
+            run = run_myvcs(repo_dir, 'checkout', '-ch', commit, '-f', '-j', str(threads))
+            results.append({'threads': threads, 'cache': cache, 'files': count, 'seconds': run['seconds'],
+                            'files_per_s': round(count / run['seconds'])})
+            print(f"{threads:3} thread(s) {cache}: {run['seconds']:7.3f}s  {count / run['seconds']:8.0f} files/s", file=sys.stderr)
+
+        for threads in jobs:
+            for cache in ('cold', 'warm'):
+                materialize(threads, cache, file_count)
+        run_myvcs(repo_dir, 'sparse-checkout', 'd0')
+        sparse_count = sum(len(names) for _, _, names in os.walk(os.path.join(repo_dir, 'd0')))
+        for cache in ('cold', 'warm'):
+            materialize(max(jobs), cache, sparse_count)
+            results[-1]['sparse'] = 'd0'
+    return results
+
+def bench_restage(file_count, file_size):
+    """
+    Re-stage an already committed tree, untouched and then with every file's stat data changed.
+
+    The second pass models a fresh clone or a 'touch -R': every file has to be read again, but
+    none of the content is new, so no object should be written.
+    """
+    with tempfile.TemporaryDirectory() as repo_dir:
+        init_repo(repo_dir)
+        paths = generate_tree(repo_dir, file_count, file_size, depth=3)
+        commit_all(repo_dir, 'first')
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+
+        results = []
+        for case in ('unchanged', 'touched'):
+            if case == 'touched':
+                for path in paths:
+                    os.utime(path)
+            run = run_myvcs(repo_dir, 'add', '-A')
+            del run['output']
+            results.append(dict(run, case=case, files=file_count,
+                                files_per_s=round(file_count / run['seconds']),
+                                mb_per_s=round(total_bytes / (1024 ** 2) / run['seconds'], 1)))
+            print(f"restage {case:>9}: {run['seconds']:8.3f}s  {file_count / run['seconds']:10.0f} files/s  "
+                  f"{run['disk_bytes_written'] / 1024:10.1f} KB written", file=sys.stderr)
+    return results
+
+def load_myvcs():
+    """Import the myvcs.py being benchmarked as a module, to build large histories quickly."""
+    spec = importlib.util.spec_from_file_location('myvcs', MYVCS)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so worker processes forked by 'add' can find the functions they run
+    sys.modules['myvcs'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def build_diverged_branches(repo_dir, distance):
+    """
+    Give repo_dir a 'main' and a 'topic' branch that are distance commits apart on each side.
+
+    Each commit changes one file of its own side, so the two tips merge without conflicts,
+    and 'main' is left checked out. The commits are written in-process, running the CLI 2 * distance times would take hours.
+    """
+    myvcs = load_myvcs()
+    cwd = os.getcwd()
+    os.chdir(repo_dir)
+    try:
+        base_tree = myvcs.update_tree(None, {'main/count.txt': myvcs.write_object('blob', '0\n'),
+                                             'topic/count.txt': myvcs.write_object('blob', '0\n'),
+                                             'shared.txt': myvcs.write_object('blob', 'shared\n')})
+        base = myvcs.write_commit(base_tree, [], 'base')
+        for side in ('main', 'topic'):
+            commit_hash, tree_hash = base, base_tree
+            for i in range(1, distance + 1):
+                tree_hash = myvcs.update_tree(tree_hash, {f'{side}/count.txt': myvcs.write_object('blob', f'{i}\n')})
+                commit_hash = myvcs.write_commit(tree_hash, [commit_hash], f'{side} {i}')
+            with open(f'.myvcs/refs/branches/{side}', 'w') as ref:
+                ref.write(commit_hash)
+        myvcs.write_commit_graph()
+    finally:
+        os.chdir(cwd)
+    # HEAD is on 'main': check its files out and stage them, or the merge would take every
+    # missing file for a local deletion
+    run_myvcs(repo_dir, 'checkout', '-ch', 'main', '-f')
+
+def bench_merge(distance):
+    """Merge two branches that are distance commits apart on each side."""
+    with tempfile.TemporaryDirectory() as repo_dir:
+        init_repo(repo_dir)
+        start = time.perf_counter()
+        build_diverged_branches(repo_dir, distance)
+        setup = time.perf_counter() - start
+        print(f"history of {2 * distance} commits written in {setup:.1f}s", file=sys.stderr)
+
+        run = run_myvcs(repo_dir, 'branch', '-m', 'topic', '-i', 'main')
+        del run['output']
+        print(f"merge {distance} commits apart: {run['seconds']:8.3f}s  peak RSS {run['peak_rss_kb'] / 1024:8.1f} MB", file=sys.stderr)
+    return [dict(run, distance=distance)]
+
+def write_edited_files(old_path, new_path, line_count, changes):
+    """Write a file of line_count lines and a copy of it with changes lines changed, deleted or inserted."""
+    rng = random.Random(0)
+    old_lines = [f'{i} {rng.getrandbits(64):016x}\n' for i in range(line_count)]
+    new_lines = list(old_lines)
+    for position in sorted(rng.sample(range(line_count), changes), reverse=True):
+        edit = rng.randrange(3)
+        if edit == 0:
+            new_lines[position] = 'changed\n'
+        elif edit == 1:
+            del new_lines[position]
+        else:
+            new_lines.insert(position, 'inserted\n')
+    for path, lines in ((old_path, old_lines), (new_path, new_lines)):
+        with open(path, 'w') as file:
+            file.writelines(lines)
+
+def bench_diff(line_count, changes):
+    """Diff a large generated file against a version with a few scattered edits."""
+    with tempfile.TemporaryDirectory() as repo_dir, tempfile.TemporaryDirectory() as work_dir:
+        old_path = os.path.join(work_dir, 'old.txt')
+        new_path = os.path.join(work_dir, 'new.txt')
+        # The lines are built in a separate process: a myvcs child forked from a large parent
+        # would report the parent's pages in its peak RSS
+        generator = multiprocessing.Process(target=write_edited_files, args=(old_path, new_path, line_count, changes))
+        generator.start()
+        generator.join()
+        init_repo(repo_dir)
+        path = os.path.join(repo_dir, 'large.txt')
+        shutil.copyfile(old_path, path)
+        commit_all(repo_dir, 'large file')
+        shutil.copyfile(new_path, path)
+        run = run_myvcs(repo_dir, 'diff')
+
+        # difflib on lists of strings, for reference
+        with open(old_path) as old_file, open(new_path) as new_file:
+            old_lines, new_lines = old_file.readlines(), new_file.readlines()
+        start = time.perf_counter()
+        reference_bytes = sum(len(line) for line in difflib.unified_diff(old_lines, new_lines, 'a/large.txt', 'b/large.txt'))
+        reference_seconds = time.perf_counter() - start
+        size = os.path.getsize(old_path)
+
+    result = {
+        'lines': line_count,
+        'bytes': size,
+        'changes': changes,
+        'seconds': run['seconds'],
+        'mb_per_s': round(size / (1024 ** 2) / run['seconds'], 1),
+        'peak_rss_kb': run['peak_rss_kb'],
+        'output_bytes': len(run['output']),
+        'difflib_seconds': round(reference_seconds, 3),
+        'difflib_output_bytes': reference_bytes,
+    }
+    print(f"diff {line_count} lines, {changes} edits: {run['seconds']:8.3f}s  peak RSS {run['peak_rss_kb'] / 1024:8.1f} MB"
+          f"  (difflib {reference_seconds:.3f}s in-process)", file=sys.stderr)
+    return [result]
+
+# Small commands editors and scripts run over and over, with how to set up each run
+SERVE_COMMANDS = [
+    ('status', ['status']),
+    ('log', ['log', '-n', '5']),
+    ('diff', ['diff']),
+    ('branch-list', ['branch', '-l']),
+    ('add-one', ['add', 'edited.txt']),
+]
+
+def median_latency(repo_dir, command, runs, before=None):
+    """Return the median wall time in ms of running command (a full argv) in repo_dir."""
+    times = []
+    for run in range(runs):
+        if before is not None:
+            before(run)
+        start = time.perf_counter()
+        subprocess.run(command, cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+def bench_serve(file_count, runs):
+    """Latency of small commands run directly, through myvcs_client.py and as bare socket requests."""
+    with tempfile.TemporaryDirectory() as repo_dir:
+        init_repo(repo_dir)
+        generate_tree(repo_dir, file_count, 2048, depth=3)
+        edited = os.path.join(repo_dir, 'edited.txt')
+        with open(edited, 'w') as file:
+            file.write('edited\n')
+        commit_all(repo_dir, 'first')
+
+        def edit(run):
+            with open(edited, 'a') as file:
+                file.write(f'{run}\n')
+
+        results = []
+        server = subprocess.Popen([sys.executable, MYVCS, 'serve'], cwd=repo_dir, stdout=subprocess.PIPE, text=True)
+        try:
+            # The server prints its first line once the socket is listening
+            server.stdout.readline()
+            myvcs = load_myvcs()
+            for name, argv in SERVE_COMMANDS:
+                before = edit if name == 'add-one' else None
+                direct = median_latency(repo_dir, [sys.executable, MYVCS] + argv, runs, before)
+                client = median_latency(repo_dir, [sys.executable, MYVCS_CLIENT] + argv, runs, before)
+                # The same request without starting any interpreter: the floor a native client would see
+                times = []
+                with contextlib.chdir(repo_dir):
+                    for run in range(runs):
+                        if before is not None:
+                            before(run)
+                        start = time.perf_counter()
+                        status = myvcs.serve_request(argv)
+                        times.append(time.perf_counter() - start)
+                        if status is None or status[0] != 0:
+                            raise RuntimeError(f"'{name}' failed on the server.")
+                request = statistics.median(times) * 1000
+                results.append({'command': name, 'direct_ms': round(direct, 2), 'client_ms': round(client, 2),
+                                'request_ms': round(request, 2), 'speedup': round(direct / client, 1)})
+                print(f"{name:12} direct {direct:8.1f} ms  client {client:8.1f} ms  socket {request:8.2f} ms  "
+                      f"({direct / client:.1f}x)", file=sys.stderr)
+        finally:
+            subprocess.run([sys.executable, MYVCS, 'serve', '--stop'], cwd=repo_dir, stdout=subprocess.DEVNULL)
+            server.wait()
+    return results
+
+def bench_refs(ref_count):
+    """
+    Time ref commands in a repository with ref_count tags, stored loose and then packed.
+
+    The tags are written as loose files directly, creating them through the CLI would take
+    an interpreter start each.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as repo_dir:
+        init_repo(repo_dir)
+        with open(os.path.join(repo_dir, 'file.txt'), 'w') as file:
+            file.write('content\n')
+        commit_hash = commit_all(repo_dir, 'first')
+        tags_dir = os.path.join(repo_dir, '.myvcs', 'refs', 'tags')
+        os.makedirs(tags_dir, exist_ok=True)
+        for i in range(ref_count):
+            with open(os.path.join(tags_dir, f'release-{i:06d}'), 'w') as tag:
+                tag.write(commit_hash)
+
+        for storage in ('loose', 'packed'):
+            if storage == 'packed':
+                run = run_myvcs(repo_dir, 'pack-refs')
+                results.append({'storage': storage, 'operation': 'pack-refs', 'seconds': run['seconds']})
+                print(f"pack-refs {ref_count} refs: {run['seconds']:.3f}s", file=sys.stderr)
+            operations = [('tag', ['tag', '-tn', f'new-{storage}']),
+                          ('checkout tag', ['checkout', '-ch', f'release-{ref_count // 2:06d}', '-f']),
+                          ('branch list', ['branch', '-l']),
+                          ('gc', ['gc'])]
+            for operation, args in operations:
+                run = run_myvcs(repo_dir, *args)
+                results.append({'storage': storage, 'operation': operation, 'refs': ref_count, 'seconds': run['seconds'],
+                                'files_opened': run['files_opened'], 'directories_listed': run['directories_listed']})
+                print(f"{storage:>6} {operation:13}: {run['seconds']:7.3f}s  {run['files_opened']} files opened", file=sys.stderr)
+    return results
+
+def build_linear_history(myvcs, repo_dir, commit_count, file_count, rare_path, rare_every):
+    """
+    Write commit_count commits in-process, each changing one of file_count files, and rare_path every rare_every commits.
+
+    Objects are written without fsync and the commit graph is built once at the end.
+    """
+    cwd = os.getcwd()
+    os.chdir(repo_dir)
+    rng = random.Random(0)
+    try:
+        with open('.myvcs/config', 'a') as config:
+            config.write("fsync=off\n")
+        tree_hash = myvcs.update_tree(None, {rare_path: myvcs.write_object('blob', '0\n')})
+        commit_hash = myvcs.write_commit(tree_hash, [], 'commit 0')
+        for i in range(1, commit_count):
+            if i % rare_every == 0:
+                path = rare_path
+            else:
+                path = f'src/d{rng.randrange(32)}/file{rng.randrange(file_count)}.txt'
+            tree_hash = myvcs.update_tree(tree_hash, {path: myvcs.write_object('blob', f'{i}\n')})
+            commit_hash = myvcs.write_commit(tree_hash, [commit_hash], f'commit {i}')
+        myvcs.write_repository_file('.myvcs/refs/branches/main', commit_hash)
+        myvcs.write_commit_graph()
+    finally:
+        os.chdir(cwd)
+
+def bench_log_path(commit_count, rare_every):
+    """
+    Time 'log --path' for a rarely changed file over a long history, with the Bloom filters and without.
+
+    Without them every commit's tree and its parent's are read along the path; the in-process
+    run also counts the commits the filters let through, to give the false positive rate.
+    """
+    rare_path = 'config/prod.yaml'
+    results = []
+    with tempfile.TemporaryDirectory() as repo_dir:
+        init_repo(repo_dir)
+        myvcs = load_myvcs()
+        start = time.perf_counter()
+        build_linear_history(myvcs, repo_dir, commit_count, 1000, rare_path, rare_every)
+        print(f"built {commit_count} commits in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        run = run_myvcs(repo_dir, 'log', '-n', '0', '--oneline', '--path', rare_path)
+        matches = len(run['output'].splitlines())
+        results.append({'mode': 'bloom', 'commits': commit_count, 'matches': matches, 'seconds': run['seconds'],
+                        'files_opened': run['files_opened']})
+        print(f" bloom: {run['seconds']:7.3f}s  {matches} matches  {run['files_opened']} files opened", file=sys.stderr)
+
+        cwd = os.getcwd()
+        os.chdir(repo_dir)
+        try:
+            graph = myvcs.load_commit_graph()
+            keys = [myvcs.bloom_key(rare_path)]
+            passed = sum(1 for position in range(graph.count) if graph.may_have_changed(position, keys))
+            graph.close()
+            # Walking without the graph confirms every commit from its trees, like log did before
+            start = time.perf_counter()
+            exact = sum(1 for _ in myvcs.log_history(myvcs.head_commit(), None, [rare_path]))
+            seconds = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+        false_positives = passed - exact
+        results.append({'mode': 'trees', 'commits': commit_count, 'matches': exact, 'seconds': round(seconds, 3),
+                        'bloom_passed': passed, 'false_positive_rate': round(false_positives / (commit_count - exact), 4)})
+        print(f" trees: {seconds:7.3f}s  {exact} matches, Bloom filters passed {passed} "
+              f"({false_positives / (commit_count - exact):.2%} false positives)", file=sys.stderr)
+    return results
+
+def stored_bytes(repo_dir):
+    """Return the bytes the object store of repo_dir takes on disk, loose objects and packs."""
+    total = 0
+    for folder, _, names in os.walk(os.path.join(repo_dir, '.myvcs', 'objects')):
+        total += sum(os.path.getsize(os.path.join(folder, name)) for name in names)
+    return total
+
+def edit_large_file(path, rng, edits):
+    """Overwrite a few bytes at edits random places of a file and insert a short run near its middle."""
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as file:
+        for _ in range(edits):
+            file.seek(rng.randrange(size - 64))
+            file.write(rng.randbytes(64))
+    # An insertion shifts everything after it, which fixed-size blocks would not survive; it is
+    # streamed through a copy so this process stays small (forked children inherit its peak RSS)
+    with open(path, 'rb') as source, open(path + '.tmp', 'wb') as target:
+        remaining = size // 2
+        while remaining > 0:
+            block = source.read(min(remaining, 1024 * 1024))
+            target.write(block)
+            remaining -= len(block)
+        target.write(rng.randbytes(100))
+        shutil.copyfileobj(source, target)
+    os.replace(path + '.tmp', path)
+
+def bench_chunking(file_size, versions, edits):
+    """
+    Commit successive versions of a large binary file with a few scattered edits each.
+
+    The file is stored once as content-defined chunks and once as a whole blob (a threshold
+    above its size). The dedup ratio is the content committed over the bytes the object store
+    grew by; the last version is then checked out again from the first.
+    """
+    results = []
+    for mode in ('chunked', 'whole'):
+        with tempfile.TemporaryDirectory() as repo_dir:
+            init_repo(repo_dir)
+            if mode == 'whole':
+                with open(os.path.join(repo_dir, '.myvcs', 'config'), 'a') as config:
+                    config.write(f"chunk_threshold={file_size * 2}\n")
+            path = os.path.join(repo_dir, 'large.bin')
+            write_random_file(path, file_size)
+            rng = random.Random(0)
+            commits = []
+            for version in range(versions):
+                if version:
+                    edit_large_file(path, rng, edits)
+                before = stored_bytes(repo_dir)
+                add = run_myvcs(repo_dir, 'add', 'large.bin')
+                commits.append(re.search(r'hash: (\w+)', run_myvcs(repo_dir, 'commit', '-m', f'v{version}')['output']).group(1))
+                stored = stored_bytes(repo_dir) - before
+                size = os.path.getsize(path)
+                results.append({'mode': mode, 'version': version, 'file_bytes': size, 'stored_bytes': stored,
+                                'add_seconds': add['seconds'], 'peak_rss_kb': add['peak_rss_kb'],
+                                'ingest_mb_per_s': round(size / (1024 ** 2) / add['seconds'], 1)})
+                print(f"{mode:>7} v{version}: add {add['seconds']:7.2f}s ({size / (1024 ** 2) / add['seconds']:6.1f} MB/s)  "
+                      f"{stored / (1024 ** 2):8.1f} MB stored", file=sys.stderr)
+            logical = sum(run['file_bytes'] for run in results if run['mode'] == mode)
+            total = stored_bytes(repo_dir)
+            run_myvcs(repo_dir, 'checkout', '-ch', commits[0], '-f')
+            checkout = run_myvcs(repo_dir, 'checkout', '-ch', commits[-1], '-f')
+            results.append({'mode': mode, 'logical_bytes': logical, 'stored_bytes': total,
+                            'dedup_ratio': round(logical / total, 2), 'checkout_seconds': checkout['seconds'],
+                            'checkout_peak_rss_kb': checkout['peak_rss_kb']})
+            print(f"{mode:>7}: dedup ratio {logical / total:5.2f}  checkout {checkout['seconds']:6.2f}s", file=sys.stderr)
+    return results
+
+def bench_hash(file_size, small_files, small_size):
+    """
+    Hashing throughput of every object hash, on one large file and on many small ones.
+
+    Both are hashed in-process with hash_file after a warm-up pass, so the numbers are the hash
+    plus reads from the page cache. 'add' of the small files and 'status' after touching all of
+    them (which hashes every file again) are then timed in a repository using each hash.
+    """
+    myvcs = load_myvcs()
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        large_path = os.path.join(data_dir, 'large.bin')
+        write_random_file(large_path, file_size)
+        small_paths = []
+        for i in range(small_files):
+            path = os.path.join(data_dir, f'small{i}.bin')
+            with open(path, 'wb') as file:
+                file.write(os.urandom(small_size))
+            small_paths.append(path)
+
+        for algorithm in myvcs.HASH_ALGORITHMS:
+            myvcs.hash_file(large_path, algorithm)
+            start = time.perf_counter()
+            myvcs.hash_file(large_path, algorithm)
+            large_seconds = time.perf_counter() - start
+            for path in small_paths:
+                myvcs.hash_file(path, algorithm)
+            start = time.perf_counter()
+            for path in small_paths:
+                myvcs.hash_file(path, algorithm)
+            small_seconds = time.perf_counter() - start
+
+            with tempfile.TemporaryDirectory() as repo_dir:
+                init_repo(repo_dir, '--hash', algorithm)
+                paths = generate_tree(repo_dir, small_files, small_size, 2)
+                add = run_myvcs(repo_dir, 'add', '-A')
+                run_myvcs(repo_dir, 'commit', '-m', 'initial')
+                for path in paths:
+                    os.utime(path)
+                status = run_myvcs(repo_dir, 'status')
+
+            results.append({'algorithm': algorithm,
+                            'large_mb_per_s': round(file_size / (1024 ** 2) / large_seconds, 1),
+                            'small_files_per_s': round(small_files / small_seconds),
+                            'small_mb_per_s': round(small_files * small_size / (1024 ** 2) / small_seconds, 1),
+                            'add_seconds': add['seconds'], 'status_seconds': status['seconds']})
+            print(f"{algorithm:>8}: large {results[-1]['large_mb_per_s']:7.1f} MB/s  small {results[-1]['small_files_per_s']:7d} files/s  "
+                  f"add {add['seconds']:6.2f}s  status after touch {status['seconds']:6.2f}s", file=sys.stderr)
+    return results
+
+# Counts of the audited events of the in-process operation being measured (None when idle)
+inprocess_counts = None
+
+def count_event(event, args):
+    """Audit hook counting the files and directories opened by in-process operations."""
+    if inprocess_counts is not None and event in inprocess_counts:
+        inprocess_counts[event] += 1
+
+def run_inprocess(call):
+    """Run one operation in this process with its output discarded and return its measurements."""
+    global inprocess_counts
+    inprocess_counts = {'open': 0, 'os.listdir': 0, 'os.scandir': 0}
+    io_before = proc_io()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        try:
+            call()
+        finally:
+            elapsed = time.perf_counter() - start
+            counts, inprocess_counts = inprocess_counts, None
+    io_after = proc_io()
+    delta = {key: io_after[key] - io_before[key] for key in io_after}
+    return {
+        'seconds': round(elapsed, 3),
+        'bytes_read': delta.get('rchar'),
+        'bytes_written': delta.get('wchar'),
+        'read_syscalls': delta.get('syscr'),
+        'write_syscalls': delta.get('syscw'),
+        'files_opened': counts['open'],
+        'directories_listed': counts['os.listdir'] + counts['os.scandir'],
+    }
+
+def modify_files(repo_dir, paths, fraction, rng):
+    """Append a line to a random fraction (at least one) of paths and return the ones changed."""
+    changed = rng.sample(paths, max(1, int(len(paths) * fraction)))
+    for path in changed:
+        with open(os.path.join(repo_dir, path), 'a') as file:
+            file.write(f'changed {rng.getrandbits(32)}\n')
+    return changed
+
+def build_history(repo_dir, shape):
+    """
+    Generate the files of a repository shape and commit them over shape['commits'] commits.
+
+    The history is built through the CLI of the myvcs.py being benchmarked (only the changed
+    files are staged each time), so older revisions build it with the commands they have.
+    Returns the relative paths and the commit hashes.
+    """
+    absolute_paths = generate_tree(repo_dir, shape['files'], size_sampler(shape['sizes']), shape['depth'], shape['seed'])
+    paths = [os.path.relpath(path, repo_dir) for path in absolute_paths]
+    rng = random.Random(shape['seed'])
+    stage_paths(repo_dir, paths, add_all=True)
+    commits = [commit_staged(repo_dir, 'commit 0')]
+    for i in range(1, shape['commits']):
+        stage_paths(repo_dir, modify_files(repo_dir, paths, shape['change_fraction'], rng))
+        commits.append(commit_staged(repo_dir, f'commit {i}'))
+    return paths, commits
+
+def suite_operations(myvcs, repo_dir, paths, commits, shape):
+    """Return the operations the suite times, in order, as (name, CLI arguments, in-process call, preparation)."""
+    rng = random.Random(shape['seed'] + 1)
+    first = commits[0]
+
+    def modify():
+        modify_files(repo_dir, paths, shape['change_fraction'], rng)
+
+    return [
+        ('status-clean', ['status'], lambda: myvcs.status_check(), None),
+        ('status-dirty', ['status'], lambda: myvcs.status_check(), modify),
+        ('add', ['add', '-A'], lambda: myvcs.add_files([], add_all=True), None),
+        ('commit', ['commit', '-m', 'bench'], lambda: myvcs.create_commit('bench'), None),
+        ('log', ['log', '-n', '10'], lambda: myvcs.log_commit(10), None),
+        ('log-oneline', ['log', '-n', str(len(commits) + 1), '--oneline'], lambda: myvcs.log_commit(len(commits) + 1, True), None),
+        ('checkout-first', ['checkout', '-ch', first, '-f'], lambda: myvcs.checkout(first, True), None),
+        ('checkout-head', ['checkout', '-ch', 'main', '-f'], lambda: myvcs.checkout('main', True), None),
+        ('tag', ['tag', '-tn', 'bench-tag'], lambda: myvcs.add_tag('bench-tag'), None),
+        ('branch-create', ['branch', '-cb', 'bench-branch'], lambda: myvcs.branch('bench-branch', None, None, None, None, 'main'), None),
+        ('branch-list', ['branch', '-l'], lambda: myvcs.branch(None, True, None, None, None, 'main'), None),
+        ('branch-switch', ['branch', '-ch', 'main'], lambda: myvcs.branch(None, None, None, 'main', None, 'main'), None),
+        ('branch-delete', ['branch', '-d', 'bench-branch'], lambda: myvcs.branch(None, None, 'bench-branch', None, None, 'main'), None),
+    ]
+
+def bench_suite(shape, modes):
+    """
+    Time every CLI operation on a synthetic repository of the given shape.
+
+    Each mode gets its own repository generated from the same seed, so runs are reproducible
+    and the two modes see identical trees and histories.
+    """
+    results = []
+    for mode in modes:
+        with tempfile.TemporaryDirectory() as repo_dir:
+            init_repo(repo_dir)
+            myvcs = load_myvcs()
+            start = time.perf_counter()
+            try:
+                paths, commits = build_history(repo_dir, shape)
+            except Exception as error:
+                results.append({'mode': mode, 'operation': 'build-history', 'error': str(error)})
+                print(f"[{mode}] build-history   failed: {error}", file=sys.stderr)
+                continue
+            print(f"[{mode}] {shape['files']} files, {len(commits)} commits generated in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+            cwd = os.getcwd()
+            if mode == 'inprocess':
+                os.chdir(repo_dir)
+            try:
+                for name, cli_args, call, prepare in suite_operations(myvcs, repo_dir, paths, commits, shape):
+                    if prepare is not None:
+                        prepare()
+                    try:
+                        if mode == 'inprocess':
+                            run = run_inprocess(call)
+                        else:
+                            run = run_myvcs(repo_dir, *cli_args)
+                            del run['output']
+                    except Exception as error:
+                        # Older revisions may not support an operation, record it and go on
+                        results.append({'mode': mode, 'operation': name, 'error': str(error)})
+                        print(f"[{mode}] {name:15} failed: {error}", file=sys.stderr)
+                        continue
+                    results.append(dict(run, mode=mode, operation=name))
+                    print(f"[{mode}] {name:15} {run['seconds']:8.3f}s  {run['files_opened']:>7} files opened", file=sys.stderr)
+            finally:
+                os.chdir(cwd)
+    return results
+
+def compare_results(old_path, new_path):
+    """Compare two suite result files operation by operation (new time / old time)."""
+    with open(old_path, 'r') as old_file, open(new_path, 'r') as new_file:
+        old_results = {(run['mode'], run['operation']): run for run in json.load(old_file)['results'] if 'error' not in run}
+        new_results = {(run['mode'], run['operation']): run for run in json.load(new_file)['results'] if 'error' not in run}
+    comparison = []
+    for key in old_results.keys() & new_results.keys():
+        old_run, new_run = old_results[key], new_results[key]
+        ratio = new_run['seconds'] / old_run['seconds'] if old_run['seconds'] else None
+        comparison.append({'mode': key[0], 'operation': key[1], 'old_seconds': old_run['seconds'],
+                           'new_seconds': new_run['seconds'], 'ratio': round(ratio, 2) if ratio is not None else None})
+    comparison.sort(key=lambda run: (run['mode'], run['operation']))
+    for run in comparison:
+        print(f"[{run['mode']}] {run['operation']:15} {run['old_seconds']:8.3f}s -> {run['new_seconds']:8.3f}s  x{run['ratio']}", file=sys.stderr)
+    return comparison
+
+def create_parser():
+    """Create and return the command-line argument parser."""
+    parser = argparse.ArgumentParser(description="Benchmarks for myvcs")
+    parser.add_argument("--myvcs", default=MYVCS, help="myvcs.py to benchmark (e.g. an older revision).")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    add_memory_parser = subparsers.add_parser("add-memory", help="Peak RSS of 'add' across file sizes")
+    add_memory_parser.add_argument("--sizes", nargs='+', default=['1M', '10M', '100M', '1G', '10G'],
+                                   help="File sizes to stage (e.g. 1M 100M 10G)")
+
+    checkout_parser = subparsers.add_parser("checkout", help="Checkout between two commits that differ in a few files")
+    checkout_parser.add_argument("--files", type=int, default=20000, help="Number of files in the repository")
+    checkout_parser.add_argument("--file-size", type=int, default=4096, help="Approximate size of each file in bytes")
+    checkout_parser.add_argument("--changed", type=int, default=3, help="Files that differ between the two commits")
+
+    materialize_parser = subparsers.add_parser("materialize", help="Check out a whole tree into an empty worktree, cold and warm")
+    materialize_parser.add_argument("--files", type=int, default=20000, help="Number of files in the repository")
+    materialize_parser.add_argument("--file-size", type=int, default=4096, help="Approximate size of each file in bytes")
+    materialize_parser.add_argument("--jobs", type=int, nargs='+', default=[1, 8], help="Checkout thread counts to compare")
+
+    restage_parser = subparsers.add_parser("restage", help="Stage an already committed tree again, untouched and touched")
+    restage_parser.add_argument("--files", type=int, default=20000, help="Number of files in the repository")
+    restage_parser.add_argument("--file-size", type=int, default=4096, help="Approximate size of each file in bytes")
+
+    merge_parser = subparsers.add_parser("merge", help="Merge two branches whose histories diverged long ago")
+    merge_parser.add_argument("--distance", type=int, default=10000, help="Commits on each branch since the merge base")
+
+    diff_parser = subparsers.add_parser("diff", help="Diff a large file with a few scattered edits")
+    diff_parser.add_argument("--lines", type=int, default=1000000, help="Number of lines in the file")
+    diff_parser.add_argument("--changes", type=int, default=100, help="Lines changed, deleted or inserted")
+
+    serve_parser = subparsers.add_parser("serve", help="Latency of small commands with and without the server")
+    serve_parser.add_argument("--files", type=int, default=5000, help="Number of files in the repository")
+    serve_parser.add_argument("--runs", type=int, default=20, help="Runs of each command, the median is reported")
+
+    refs_parser = subparsers.add_parser("refs", help="Ref commands with many tags, loose and packed")
+    refs_parser.add_argument("--refs", type=int, default=50000, help="Number of tags in the repository")
+
+    log_path_parser = subparsers.add_parser("log-path", help="'log --path' over a long history, with and without Bloom filters")
+    log_path_parser.add_argument("--commits", type=int, default=100000, help="Commits in the history")
+    log_path_parser.add_argument("--rare-every", type=int, default=1000, help="The logged path changes every this many commits")
+
+    chunking_parser = subparsers.add_parser("chunking", help="Dedup and ingest speed of a large file edited between commits")
+    chunking_parser.add_argument("--file-size", default='256M', help="Size of the file (e.g. 256M, 1G)")
+    chunking_parser.add_argument("--versions", type=int, default=5, help="Versions of the file committed")
+    chunking_parser.add_argument("--edits", type=int, default=3, help="Scattered 64-byte overwrites per version")
+
+    hash_parser = subparsers.add_parser("hash", help="Throughput of each object hash on large and small files")
+    hash_parser.add_argument("--file-size", default='256M', help="Size of the large file (e.g. 256M, 1G)")
+    hash_parser.add_argument("--small-files", type=int, default=20000, help="Number of small files")
+    hash_parser.add_argument("--small-size", default='4K', help="Size of each small file")
+
+    suite_parser = subparsers.add_parser("suite", help="Time every operation on a synthetic repository")
+    suite_parser.add_argument("--files", type=int, default=5000, help="Number of files in the repository")
+    suite_parser.add_argument("--sizes", default='lognormal:2K:1.5',
+                              help="File size distribution: fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA")
+    suite_parser.add_argument("--depth", type=int, default=3, help="Directory levels files are spread over")
+    suite_parser.add_argument("--commits", type=int, default=20, help="Commits in the generated history")
+    suite_parser.add_argument("--change-fraction", type=float, default=0.01, help="Fraction of files changed per commit")
+    suite_parser.add_argument("--seed", type=int, default=0, help="Seed of the generated repository")
+    suite_parser.add_argument("--modes", nargs='+', choices=['subprocess', 'inprocess'], default=['subprocess', 'inprocess'],
+                              help="Run operations as CLI processes, as function calls, or both")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two suite result files")
+    compare_parser.add_argument("old", help="Results of the baseline revision")
+    compare_parser.add_argument("new", help="Results of the revision being measured")
+    return parser
+
+def func_main():
+    """Run the selected benchmark and print its results as JSON."""
+    global MYVCS
+    parser = create_parser()
+    args = parser.parse_args()
+    MYVCS = os.path.abspath(args.myvcs)
+
+    if args.benchmark == 'add-memory':
+        results = bench_add_memory(args.sizes)
+    elif args.benchmark == 'checkout':
+        results = bench_checkout(args.files, args.file_size, args.changed)
+    elif args.benchmark == 'materialize':
+        results = bench_materialize(args.files, args.file_size, args.jobs)
+    elif args.benchmark == 'restage':
+        results = bench_restage(args.files, args.file_size)
+    elif args.benchmark == 'merge':
+        results = bench_merge(args.distance)
+    elif args.benchmark == 'diff':
+        results = bench_diff(args.lines, args.changes)
+    elif args.benchmark == 'serve':
+        results = bench_serve(args.files, args.runs)
+    elif args.benchmark == 'refs':
+        results = bench_refs(args.refs)
+    elif args.benchmark == 'log-path':
+        results = bench_log_path(args.commits, args.rare_every)
+    elif args.benchmark == 'chunking':
+        results = bench_chunking(parse_size(args.file_size), args.versions, args.edits)
+    elif args.benchmark == 'hash':
+        results = bench_hash(parse_size(args.file_size), args.small_files, parse_size(args.small_size))
+    elif args.benchmark == 'suite':
+        sys.addaudithook(count_event)
+        shape = {'files': args.files, 'sizes': args.sizes, 'depth': args.depth, 'commits': args.commits,
+                 'change_fraction': args.change_fraction, 'seed': args.seed}
+        results = bench_suite(shape, args.modes)
+    elif args.benchmark == 'compare':
+        results = compare_results(args.old, args.new)
+    else:
+        parser.print_help()
+        return
+    # The parameters and interpreter are recorded so runs on different revisions can be compared
+    parameters = {key: value for key, value in vars(args).items() if key != 'benchmark'}
+    print(json.dumps({'benchmark': args.benchmark, 'parameters': parameters, 'python': sys.version.split()[0],
+                      'results': results}, indent=2))
+
+if __name__ == "__main__":
+    func_main()
@@ -1,514 +1,4515 @@
 import argparse
+import array
+import collections
+import cProfile
+import concurrent.futures
+import contextlib
+import contextvars
+import ctypes
+import ctypes.util
+import glob
 import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
+import selectors
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
 import time
+import traceback
+import types
 import os
+import pstats
+import re
+import zlib
 
-def load_index():
-    """Load the index file and return the list of staged files and their hashes."""
-    index_path = '.myvcs/index'
-    index_data = []
-    if not os.path.exists(index_path):
-        raise FileNotFoundError(f"The index file '{index_path}' does not exist.")
-    with open(index_path, 'r') as index_file:
+# Files are hashed and copied in chunks of this size so memory stays flat for any file size
+CHUNK_SIZE = 1024 * 1024
+
+# ================================ Repository root ================================
+# The paths the functions below work with are relative to the root of the repository: the
+# current directory, or the root a Repository call runs in (see Repository). They are joined
+# with that root where files are opened, so threads working in different repositories never
+# depend on the process's working directory. Threads started for a call run in a copy of the
+# caller's context (in_context) to see the same root.
+
+REPOSITORY_ROOT = contextvars.ContextVar('REPOSITORY_ROOT', default=None)
+
+def repo_path(path):
+    """Return the location on disk of a path relative to the repository root; absolute paths are kept."""
+    root = REPOSITORY_ROOT.get()
+    return path if root is None else os.path.join(root, path)
+
+def set_repository_root(root):
+    """Make root the repository of the current context; the initializer of worker processes."""
+    REPOSITORY_ROOT.set(root)
+
+def in_context(function):
+    """Wrap function so pool threads run it in a copy of the calling thread's context."""
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(function, *args)
+
+# ===================================== Index =====================================
+# .myvcs/index is a header (signature, version, entry count, hash size), a table with the
+# offset of every entry, the entries sorted by path and a SHA-1 of everything before it.
+# An entry is the cached stat data, a flag telling whether that stat data is set, the length
+# of the path, then the raw object id and the path. The offset table makes the file
+# searchable in place: it is mapped into memory and a path is found by binary search
+# without reading the other entries. The file is never edited, every change rewrites it
+# atomically with one entry per path. Indexes written as "path hash [stat data]" text lines
+# by older versions are still read, and converted by the next write.
+
+INDEX_PATH = '.myvcs/index'
+INDEX_SIGNATURE = b'MVIX'
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct('>4sIIB')
+INDEX_OFFSET = struct.Struct('>I')
+INDEX_ENTRY = struct.Struct('>qqqQIBH')
+INDEX_HAS_STAT = 1
+INDEX_CHECKSUM_SIZE = 20
+
+class IndexFile:
+    """A binary index file, mapped into memory."""
+
+    def __init__(self, path=INDEX_PATH, verify=True):
+        """Map the index; verify checks the checksum, which single lookups skip to stay O(log n)."""
+        with open(repo_path(path), 'rb') as index_file:
+            self.data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            signature, version, self.count, self.hash_size = INDEX_HEADER.unpack_from(self.data, 0)
+            if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+                raise ValueError("The index file is corrupt.")
+            if not verify:
+                return
+            body_size = len(self.data) - INDEX_CHECKSUM_SIZE
+            view = memoryview(self.data)
+            try:
+                checksum = hashlib.sha1(view[:body_size]).digest()
+            finally:
+                view.release()
+            if checksum != self.data[body_size:]:
+                raise ValueError("The index file is corrupt, its checksum does not match.")
+        except (ValueError, struct.error):
+            self.data.close()
+            raise ValueError("The index file is corrupt.")
+
+    def path(self, position):
+        """Return the path of an entry as bytes."""
+        offset = INDEX_OFFSET.unpack_from(self.data, INDEX_HEADER.size + position * INDEX_OFFSET.size)[0]
+        path_length = INDEX_ENTRY.unpack_from(self.data, offset)[6]
+        start = offset + INDEX_ENTRY.size + self.hash_size
+        return self.data[start:start + path_length]
+
+    def entry(self, position):
+        """Return (path, [hash, stat_data]) of an entry."""
+        offset = INDEX_OFFSET.unpack_from(self.data, INDEX_HEADER.size + position * INDEX_OFFSET.size)[0]
+        *stat_data, flags, path_length = INDEX_ENTRY.unpack_from(self.data, offset)
+        start = offset + INDEX_ENTRY.size
+        hashed_content = self.data[start:start + self.hash_size].hex()
+        path = os.fsdecode(self.data[start + self.hash_size:start + self.hash_size + path_length])
+        return path, [hashed_content, tuple(stat_data) if flags & INDEX_HAS_STAT else None]
+
+    def lookup(self, path):
+        """Return the [hash, stat_data] of a path by binary search, or None if it is not staged."""
+        key = os.fsencode(path)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.path(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.path(low) == key:
+            return self.entry(low)[1]
+        return None
+
+    def entries(self):
+        """Yield (path, [hash, stat_data]) for every entry, in path order."""
+        # Entries are stored back to back, so a full read walks them without the offset table
+        data, hash_size, unpack_entry = self.data, self.hash_size, INDEX_ENTRY.unpack_from
+        offset = INDEX_HEADER.size + self.count * INDEX_OFFSET.size
+        for _ in range(self.count):
+            mtime_ns, ctime_ns, size, inode, mode, flags, path_length = unpack_entry(data, offset)
+            offset += INDEX_ENTRY.size
+            hashed_content = data[offset:offset + hash_size].hex()
+            offset += hash_size
+            path = data[offset:offset + path_length].decode('utf-8', 'surrogateescape')
+            offset += path_length
+            stat_data = (mtime_ns, ctime_ns, size, inode, mode) if flags & INDEX_HAS_STAT else None
+            yield path, [hashed_content, stat_data]
+
+    def close(self):
+        """Unmap the index."""
+        self.data.close()
+
+def is_binary_index(index_path=INDEX_PATH):
+    """Return True if the index file is in the binary format (False for the old text format)."""
+    with open(repo_path(index_path), 'rb') as index_file:
+        return index_file.read(len(INDEX_SIGNATURE)) == INDEX_SIGNATURE
+
+def load_text_index(index_path=INDEX_PATH):
+    """Read an index in the old "path hash [stat data]" text format."""
+    index_data = {}
+    with open(repo_path(index_path), 'r') as index_file:
         for line in index_file:
-            path, hashed_content = line.strip().split()
-            index_data.append([hashed_content, path])
-            
+            fields = line.strip().split()
+            if not fields:
+                continue
+            path, hashed_content = fields[0], fields[1]
+            stat_data = tuple(int(value) for value in fields[2:7]) if len(fields) >= 7 else None
+            # Later lines win, so a file staged twice keeps its most recent hash
+            index_data[path] = [hashed_content, stat_data]
     return index_data
 
-def log_commit(n_commit):
-    """Log commit prints out N most recent commits."""
-    head_path = ".myvcs/HEAD"
-    # Check if HEAD file exists
-    if not os.path.exists(head_path):
-        raise FileNotFoundError(f"The HEAD file does not exist.")
-    with open(head_path, 'r') as head:
-        head_path_data = head.read().strip()
-        
-    # Chech if the HEAD file contains the path to the main  
+# The index of an open Repository.batch(), written to disk when the batch ends (None outside one)
+PENDING_INDEX = contextvars.ContextVar('PENDING_INDEX', default=None)
+
+def load_index(missing_ok=False):
+    """
+    Load the index file and return a dict mapping each staged path to [hash, stat_data].
+
+    stat_data is the (mtime_ns, ctime_ns, size, inode, mode) tuple cached when the entry
+    was written, or None for entries written without it (older index files). With missing_ok
+    a repository without an index has an empty one.
+    """
+    pending = PENDING_INDEX.get()
+    if pending is not None:
+        return {path: list(entry) for path, entry in pending.items()}
+    if not os.path.exists(repo_path(INDEX_PATH)):
+        if missing_ok:
+            return {}
+        raise FileNotFoundError(f"The index file '{INDEX_PATH}' does not exist.")
+    if REPOSITORY_CACHE.get() is None:
+        return read_index_file()
+    # Callers change the dict and its entries, the copy kept by 'serve' has to stay as read
+    return {path: list(entry) for path, entry in cached_file(INDEX_PATH, read_index_file).items()}
+
+def read_index_file():
+    """Parse the index file, in either format."""
+    if not is_binary_index():
+        return load_text_index()
+    index = IndexFile()
+    try:
+        return dict(index.entries())
+    finally:
+        index.close()
+
+def file_stat_data(filepath, st=None):
+    """Return the stat data cached in the index for a file, from st when the caller already has it."""
+    if st is None:
+        st = os.stat(repo_path(filepath))
+    return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode)
+
+def stat_matches(stat_data, filepath, index_mtime_ns, current=None):
+    """
+    Return True when the cached stat data proves the file is unchanged since it was hashed.
+
+    An entry whose mtime is not older than the index file itself is "racily clean": the file
+    may have been modified in the same timestamp tick the index was written, so its stat data
+    cannot be trusted and the file has to be hashed again.
+    """
+    if stat_data is None:
+        return False
+    if current is None:
+        try:
+            current = file_stat_data(filepath)
+        except OSError:
+            return False
+    if current != stat_data:
+        return False
+    return stat_data[0] < index_mtime_ns
+
+def write_index(index_data, durable=False):
+    """
+    Rewrite the whole index atomically from a dict of path -> [hash, stat_data].
+
+    With durable the new index is fsynced before it replaces the old one (unless fsync is off),
+    which 'add' asks for; refreshing cached stat data does not need it. Inside a batch the
+    index is only kept in memory until the batch ends.
+    """
+    if PENDING_INDEX.get() is not None:
+        PENDING_INDEX.set(index_data)
+        return
+    tmp_path = repo_path(INDEX_PATH + '.tmp')
+
+    def write_entries():
+        # The offset table needs every entry's size up front, so the entries are built first
+        entries = []
+        for path, (hashed_content, stat_data) in index_data.items():
+            raw_path = os.fsencode(path)
+            raw_hash = bytes.fromhex(hashed_content)
+            flags = INDEX_HAS_STAT if stat_data is not None else 0
+            entries.append((raw_path, INDEX_ENTRY.pack(*(stat_data or (0, 0, 0, 0, 0)), flags, len(raw_path)) + raw_hash + raw_path))
+        entries.sort(key=lambda entry: entry[0])
+        hash_size = len(bytes.fromhex(next(iter(index_data.values()))[0])) if index_data else id_size()
+        hasher = hashlib.sha1()
+        with open(tmp_path, 'wb') as index_file:
+            def write(data):
+                hasher.update(data)
+                index_file.write(data)
+
+            write(INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(entries), hash_size))
+            offset = INDEX_HEADER.size + len(entries) * INDEX_OFFSET.size
+            offsets = []
+            for _, entry in entries:
+                offsets.append(offset)
+                offset += len(entry)
+            write(struct.pack(f'>{len(offsets)}I', *offsets))
+            write(b''.join(entry for _, entry in entries))
+            index_file.write(hasher.digest())
+        return os.stat(tmp_path).st_mtime_ns
+
+    index_mtime_ns = write_entries()
+    # Entries modified in the same tick as the index write would look clean forever once the
+    # index gets older, so drop their stat data and let the next status hash them again
+    racy = [path for path, (_, stat_data) in index_data.items()
+            if stat_data is not None and stat_data[0] >= index_mtime_ns]
+    if racy:
+        for path in racy:
+            index_data[path][1] = None
+        write_entries()
+    durable = durable and fsync_mode() == 'batch'
+    if durable:
+        fsync_path(tmp_path)
+    os.replace(tmp_path, repo_path(INDEX_PATH))
+    if durable:
+        fsync_path(repo_path('.myvcs'))
+
+def head_ref_path():
+    """Return the path of the branch file HEAD points to."""
+    head_path_data = read_repository_file('.myvcs/HEAD')
     if head_path_data == '':
         raise ValueError(f"The HEAD file is empty.")
-    
-    # Check if main exists
-    if not os.path.exists(os.path.join('.myvcs', head_path_data)):
-        raise FileNotFoundError(f"The HEAD file '{head_path_data}' does not exist.")
-
-    # Main path is the contents of head_date
-    main_path = os.path.join('.myvcs', head_path_data)
-    if not os.path.exists(main_path):
-        raise FileNotFoundError(f"The main file '{main_path}' does not exist.")
-    
-    # Read the main file and get the commit hash
-    with open(main_path, 'r') as main:
-        hash_path = main.read().strip()
+    # 'init' writes the ref relative to .myvcs while the branch commands keep the prefix
+    if not head_path_data.startswith('.myvcs/'):
+        head_path_data = os.path.join('.myvcs', head_path_data)
+    return head_path_data
 
-    for i in range(n_commit):
-        # Parent flag initiated as False in each iteration of the loop, idicates the existance of a previous commit
-        parent = False
+def head_ref_name():
+    """Return the name of the branch ref HEAD points to, like refs/branches/main."""
+    return os.path.relpath(head_ref_path(), '.myvcs')
 
-        commit_path = os.path.join('.myvcs/objects', hash_path)
-        
-        # Raise error if the path doesn't exist
-        if not os.path.exists(commit_path):
-            raise FileNotFoundError(f"The commit file '{commit_path}' does not exist.")
-    
-        with open(commit_path, 'r') as commit:
-            commit_data = commit.read().strip()
-            
-        lines = commit_data.split('\n')
-        print(f"Commit: {hash_path}")
-        for line in lines:
-            line_data = line.strip().split()
-            if line_data[0] == 'tree':
-                print(f"Tree: {line_data[1]}")
-                with open(os.path.join('.myvcs/objects', line_data[1]), 'r') as tree_content:
-                    tree_files = tree_content.read().strip()
-                for idx, file in enumerate(tree_files.splitlines()):
-                    if idx == 0:
-                        print(f"File(s): {file}")
-                    else:
-                        print(f"      {file}")
-            elif line_data[0] == 'parent':
-                print(f"Parent: {line_data[1]}")
-                hash_path = line_data[1]
-                # Flag set as true to indicate that the current commit has a parent
-                parent = True
-            elif line_data[0] == 'author':
-                print(f"Author: {line_data[1]}")
-                print(f"Email: {line_data[2]}")
-            elif line_data[0] == 'timestamp':
-                timestamp_readable = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(line_data[1])))
-                print(f"Timestamp: {timestamp_readable}")
-            elif line_data[0] == 'message':
-                print(f"Message: {' '.join(line_data[1:])}")
-
-        # If no parent commit is found, print a message and return
-        if parent == False:
-            print("\n(No more commits to print.)")
+def head_commit():
+    """Return the hash of the commit HEAD points to, or None if there are no commits yet."""
+    return read_ref(head_ref_name()) or None
+
+def read_repository_file(path):
+    """Return the stripped text of a small repository file such as HEAD or a ref."""
+    def read():
+        with open(repo_path(path), 'r') as file:
+            return file.read().strip()
+    return cached_file(path, read)
+
+def write_repository_file(path, text):
+    """Replace the content of a small repository file such as HEAD atomically, under its lock."""
+    with LockFile(path) as lock:
+        lock.write(text)
+        lock.commit()
+
+# ================================ Parsed objects ================================
+# Commits, trees and blobs are read through read_commit, read_tree and read_blob, which return
+# parsed records and keep them in a cache bounded by an approximate byte budget, least recently
+# used first out. Objects never change once written, so cached records only need dropping when
+# objects are deleted (gc, migrate-objects). Records are shared, callers must not modify them.
+# The budget is the object_cache_budget config key, applied whenever a repository is entered.
+
+OBJECT_CACHE_BUDGET = 32 * 1024 * 1024
+# Rough per-record and per-tree-entry Python overhead, added to the content size
+RECORD_OVERHEAD = 200
+TREE_ENTRY_OVERHEAD = 150
+
+class Commit:
+    """A parsed commit object."""
+    __slots__ = ('hash', 'tree', 'parents', 'author', 'email', 'timestamp', 'message')
+
+    def __init__(self, commit_hash, tree, parents, author, email, timestamp, message):
+        self.hash = commit_hash
+        self.tree = tree
+        self.parents = parents
+        self.author = author
+        self.email = email
+        self.timestamp = timestamp
+        self.message = message
+
+class Tree:
+    """A parsed tree object: name -> (kind, hash) entries, and whether it is an old flat tree."""
+    __slots__ = ('hash', 'entries', 'flat')
+
+    def __init__(self, tree_hash, entries, flat):
+        self.hash = tree_hash
+        self.entries = entries
+        self.flat = flat
+
+class Blob:
+    """The content of a blob object."""
+    __slots__ = ('hash', 'data')
+
+    def __init__(self, blob_hash, data):
+        self.hash = blob_hash
+        self.data = data
+
+# Stands in for a missing tree (None), e.g. the parent tree of a first commit
+EMPTY_TREE = Tree(None, {}, False)
+
+class ObjectCache:
+    """Parsed object records by id, evicting the least recently used once their cost passes budget bytes."""
+
+    def __init__(self, budget=OBJECT_CACHE_BUDGET):
+        self.budget = budget
+        self.records = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Shared by every thread and repository of the process (objects are content-addressed)
+        self.lock = threading.Lock()
+
+    def get(self, object_hash, record_type):
+        """Return the cached record of an object if it is of record_type, else None."""
+        with self.lock:
+            cached = self.records.get(object_hash)
+            if cached is None or not isinstance(cached[0], record_type):
+                self.misses += 1
+                return None
+            self.records.move_to_end(object_hash)
+            self.hits += 1
+            return cached[0]
+
+    def put(self, object_hash, record, cost):
+        """Cache a record; records too big to be worth keeping are skipped."""
+        with self.lock:
+            if cost > self.budget // 8:
+                return
+            previous = self.records.pop(object_hash, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.records[object_hash] = (record, cost)
+            self.size += cost
+            self.evict()
+
+    def resize(self, budget):
+        """Change the byte budget, evicting records if it shrank."""
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used records until the cache fits its budget; the lock is held."""
+        while self.size > self.budget and self.records:
+            _, (_, evicted_cost) = self.records.popitem(last=False)
+            self.size -= evicted_cost
+            self.evictions += 1
+
+    def clear(self):
+        """Drop every record, for when objects are deleted or rewritten."""
+        with self.lock:
+            self.records.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return the hit, miss and eviction counts and the cache's current size."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'records': len(self.records), 'bytes': self.size, 'budget': self.budget}
+
+OBJECT_CACHE = ObjectCache()
+
+def read_commit(commit_hash):
+    """Return the parsed Commit record of a commit object."""
+    commit = OBJECT_CACHE.get(commit_hash, Commit)
+    if commit is not None:
+        return commit
+    content = read_object(commit_hash, 'commit')
+    tree, parents, author, email, timestamp, message = None, [], '', '', 0, ''
+    for line in content.decode().splitlines():
+        line_data = line.strip().split()
+        if not line_data:
+            continue
+        if line_data[0] == 'tree':
+            tree = line_data[1]
+        elif line_data[0] == 'parent':
+            parents.append(line_data[1])
+        elif line_data[0] == 'author':
+            author = line_data[1]
+            email = line_data[2] if len(line_data) > 2 else ''
+        elif line_data[0] == 'timestamp':
+            timestamp = int(line_data[1])
+        elif line_data[0] == 'message':
+            message = ' '.join(line_data[1:])
+    if tree is None:
+        raise ValueError(f"The commit '{commit_hash}' has no tree.")
+    commit = Commit(commit_hash, tree, tuple(parents), author, email, timestamp, message)
+    OBJECT_CACHE.put(commit_hash, commit, len(content) + RECORD_OVERHEAD)
+    return commit
+
+# A tree object lists one directory, one "<blob|tree> <hash> <name>" line per entry, sorted by
+# name, so a directory that did not change keeps its hash and is shared between commits.
+# Older trees are a single flat list of "<hash> <path>" lines covering the whole worktree.
+
+def read_tree(tree_hash):
+    """
+    Return the parsed Tree record of a tree object (EMPTY_TREE for None).
+
+    The entries of an old flat tree come back as blobs named by their full path.
+    """
+    if tree_hash is None:
+        return EMPTY_TREE
+    tree = OBJECT_CACHE.get(tree_hash, Tree)
+    if tree is not None:
+        return tree
+    content = read_object(tree_hash, 'tree')
+    entries = {}
+    for line in content.decode().splitlines():
+        line_data = line.strip().split(' ', 2)
+        if len(line_data) == 3:
+            entries[line_data[2]] = (line_data[0], line_data[1])
+        elif len(line_data) == 2:
+            entries[line_data[1]] = ('blob', line_data[0])
+    # Names in an old flat tree are whole paths
+    tree = Tree(tree_hash, entries, any('/' in name for name in entries))
+    OBJECT_CACHE.put(tree_hash, tree, len(content) + RECORD_OVERHEAD + TREE_ENTRY_OVERHEAD * len(entries))
+    return tree
+
+def read_blob(blob_hash):
+    """Return the Blob record of a blob object; large blobs are read but not cached."""
+    blob = OBJECT_CACHE.get(blob_hash, Blob)
+    if blob is not None:
+        return blob
+    blob = Blob(blob_hash, b''.join(iter_blob(blob_hash)))
+    OBJECT_CACHE.put(blob_hash, blob, len(blob.data) + RECORD_OVERHEAD)
+    return blob
+
+def tree_files(tree_hash, prefix='', sparse=None):
+    """
+    Return a dict mapping each path in a tree (and its subtrees) to its blob hash.
+
+    With a SparseCone only the paths inside it are returned, and subtrees it does not reach
+    are not read.
+    """
+    files = {}
+    for name, (kind, entry_hash) in read_tree(tree_hash).entries.items():
+        if kind == 'tree':
+            if sparse is None or sparse.enters(prefix + name):
+                files.update(tree_files(entry_hash, prefix + name + '/', sparse))
+        elif sparse is None or sparse.contains(prefix + name):
+            files[prefix + name] = entry_hash
+    return files
+
+def update_tree(base_tree, changes):
+    """
+    Write the trees for base_tree with changes (path -> blob hash, None to remove) applied.
+
+    Only the directories along the changed paths get new tree objects, every other subtree
+    keeps the hash it has in base_tree. Returns the new root tree hash (None if it is empty).
+    """
+    base = read_tree(base_tree)
+    # A copy, the record is shared through the object cache
+    entries = dict(base.entries)
+    if base.flat:
+        # Old flat trees are rewritten as nested trees in one go
+        changes = dict(tree_files(base_tree), **changes)
+        entries = {}
+
+    subtree_changes = {}
+    for path, blob_hash in changes.items():
+        name, _, rest = path.partition('/')
+        if rest:
+            subtree_changes.setdefault(name, {})[rest] = blob_hash
+        elif blob_hash is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = ('blob', blob_hash)
+
+    for name, sub_changes in subtree_changes.items():
+        current = entries.get(name)
+        sub_base = current[1] if current is not None and current[0] == 'tree' else None
+        sub_tree = update_tree(sub_base, sub_changes)
+        if sub_tree is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = ('tree', sub_tree)
+
+    return write_tree(entries)
+
+def write_tree(entries):
+    """Write one tree object from name -> (kind, hash) entries and return its hash (None if empty)."""
+    if not entries:
+        return None
+    tree_content = "".join(f'{kind} {entry_hash} {name}\n' for name, (kind, entry_hash) in sorted(entries.items()))
+    # write_object leaves existing objects alone, so unchanged directories cost nothing
+    return write_object('tree', tree_content)
+
+def diff_trees(old_tree, new_tree, prefix=''):
+    """
+    Yield (path, old blob hash, new blob hash) for every file that differs between two trees.
+
+    Either tree may be None (empty). Subtrees with the same hash on both sides are skipped
+    without being read.
+    """
+    if old_tree == new_tree:
+        return
+    old = read_tree(old_tree)
+    new = read_tree(new_tree)
+    if old.flat or new.flat:
+        # Old flat trees cannot be matched directory by directory, compare every path
+        old_files = tree_files(old_tree, prefix)
+        new_files = tree_files(new_tree, prefix)
+        for path in sorted(set(old_files) | set(new_files)):
+            if old_files.get(path) != new_files.get(path):
+                yield path, old_files.get(path), new_files.get(path)
+        return
+
+    for name in sorted(set(old.entries) | set(new.entries)):
+        old_entry = old.entries.get(name)
+        new_entry = new.entries.get(name)
+        if old_entry == new_entry:
+            continue
+        path = prefix + name
+        old_sub = old_entry[1] if old_entry is not None and old_entry[0] == 'tree' else None
+        new_sub = new_entry[1] if new_entry is not None and new_entry[0] == 'tree' else None
+        old_blob = old_entry[1] if old_entry is not None and old_entry[0] == 'blob' else None
+        new_blob = new_entry[1] if new_entry is not None and new_entry[0] == 'blob' else None
+        if old_sub is not None or new_sub is not None:
+            yield from diff_trees(old_sub, new_sub, path + '/')
+        if old_blob != new_blob:
+            yield path, old_blob, new_blob
+
+def head_tree(sparse=None):
+    """Return the path -> hash dict of the HEAD commit's tree (empty before the first commit), limited to a SparseCone."""
+    commit_hash = head_commit()
+    if commit_hash is None:
+        return {}
+    return tree_files(read_commit(commit_hash).tree, sparse=sparse)
+
+# ================================= Commit graph =================================
+# .myvcs/commit-graph is a header (signature, version, size of the raw ids) followed by
+# fixed-size rows, one per commit, written parents first: commit id, tree id, the row numbers of up to two parents, timestamp, generation number
+# (1 + the largest parent generation), the offset of "author\0message\n" in
+# .myvcs/commit-graph-summaries and the offset of the commit's changed-path Bloom filter in
+# .myvcs/commit-graph-bloom. The files are only ever appended to by create_commit and are
+# read whole or through mmap, so walking history never opens a commit object.
+#
+# A Bloom filter holds every path that differs from the first parent (the root commit: every
+# path), directories included, so 'log --path' can skip a commit that did not touch a path
+# without reading a tree; a "maybe" is confirmed by comparing the path's entries in the two
+# trees. A filter is a '>I' bit count followed by the bits, BLOOM_HASHES bits set per path
+# from a blake2b digest of it (double hashing). Commits changing more than BLOOM_MAX_PATHS
+# paths get a count of 0, which matches every path.
+#
+# .myvcs/commit-graph-lookup finds the row of a commit by binary search, like a pack's .idx:
+# a header (signature, number of rows covered), a 256-entry fan-out table, the raw ids of the
+# first rows sorted and the row number of each. Rows appended since it was written are
+# scanned; once there are more than COMMIT_GRAPH_LOOKUP_TAIL of them it is written again.
+
+COMMIT_GRAPH_PATH = '.myvcs/commit-graph'
+COMMIT_GRAPH_SUMMARIES_PATH = '.myvcs/commit-graph-summaries'
+COMMIT_GRAPH_BLOOM_PATH = '.myvcs/commit-graph-bloom'
+COMMIT_GRAPH_LOOKUP_PATH = '.myvcs/commit-graph-lookup'
+COMMIT_GRAPH_LOOKUP_SIGNATURE = b'MCGL'
+COMMIT_GRAPH_LOOKUP_HEADER = struct.Struct('>4sI')
+COMMIT_GRAPH_LOOKUP_TAIL = 1024
+COMMIT_GRAPH_SIGNATURE = b'MCGF'
+COMMIT_GRAPH_VERSION = 3
+COMMIT_GRAPH_HEADER = struct.Struct('>4sIB')
+GRAPH_NO_PARENT = 0xffffffff
+BLOOM_BITS_PER_PATH = 10
+BLOOM_HASHES = 7
+BLOOM_MAX_PATHS = 512
+BLOOM_HEADER = struct.Struct('>I')
+
+class CommitGraph:
+    """The commit-graph file and its summaries, mapped into memory."""
+
+    def __init__(self):
+        with open(repo_path(COMMIT_GRAPH_PATH), 'rb') as graph_file:
+            self.data = mmap.mmap(graph_file.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, graph_id_size = COMMIT_GRAPH_HEADER.unpack_from(self.data, 0)
+        # A graph written before 'convert-hash' is rebuilt like an outdated one
+        if signature != COMMIT_GRAPH_SIGNATURE or version != COMMIT_GRAPH_VERSION or graph_id_size != id_size():
+            self.data.close()
+            raise ValueError("The commit-graph file is corrupt.")
+        self.row_struct = commit_graph_row(graph_id_size)
+        # A row cut short by a crash is ignored, the next create_commit rebuilds the graph
+        self.count = (len(self.data) - COMMIT_GRAPH_HEADER.size) // self.row_struct.size
+        with open(repo_path(COMMIT_GRAPH_SUMMARIES_PATH), 'rb') as summaries_file:
+            self.summaries = summaries_file.read()
+        with open(repo_path(COMMIT_GRAPH_BLOOM_PATH), 'rb') as bloom_file:
+            self.bloom = bloom_file.read()
+        self.id_size = graph_id_size
+        self.load_lookup()
+
+    def load_lookup(self):
+        """Read the sorted ids of the lookup file; without a usable one every row is scanned."""
+        self.lookup_data = b''
+        self.indexed = 0
+        if not os.path.exists(repo_path(COMMIT_GRAPH_LOOKUP_PATH)):
+            return
+        with open(repo_path(COMMIT_GRAPH_LOOKUP_PATH), 'rb') as lookup_file:
+            data = lookup_file.read()
+        try:
+            signature, indexed = COMMIT_GRAPH_LOOKUP_HEADER.unpack_from(data, 0)
+        except struct.error:
             return
-        print("\n")
+        expected_size = COMMIT_GRAPH_LOOKUP_HEADER.size + 256 * 4 + indexed * (self.id_size + 4)
+        if signature == COMMIT_GRAPH_LOOKUP_SIGNATURE and indexed <= self.count and len(data) == expected_size:
+            self.lookup_data = data
+            self.indexed = indexed
 
-def update_index(filepath, hash):
-    """Update the index with the file path and its hash."""
-    index_path = '.myvcs/index'
-    with open(index_path, 'a') as index_file:
-        index_file.write(f"{filepath} {hash}\n")
-    
-def add_file(filepath):
-    """Add a file to the staging area."""
-    if not os.path.exists(filepath):
-        raise FileNotFoundError(f"The file '{filepath}' does not exist.")
-    if not os.path.isfile(filepath):
-        raise ValueError(f"The path '{filepath}' is not a file.")
-    # Inform the user that the file is being added to the staging area
-    print(f"Adding file '{filepath}' to the staging area...")  
-    
-    with open(filepath, 'rb') as file:
-        content = file.read()
-        
-    hashed_content = hashlib.sha1(content).hexdigest()
-    # Create the object file in the .myvcs/objects directory
-    with open(f'.myvcs/objects/{hashed_content}', 'wb') as object_file:
-        object_file.write(content)
-    
-    # Update the index with the file path and its hash
-    update_index(filepath, hashed_content)
-        
-def initialize_vcs(author_name, author_email):
-    """Initialize the version control system by creating necessary directories and files."""
+    def fanout(self, byte):
+        """Return how many sorted ids start with a byte lower than or equal to byte."""
+        return struct.unpack_from('>I', self.lookup_data, COMMIT_GRAPH_LOOKUP_HEADER.size + 4 * byte)[0]
+
+    def lookup(self, commit_hash):
+        """Return the row number of a commit, or None if the graph does not know it."""
+        raw = bytes.fromhex(commit_hash)
+        if self.indexed:
+            ids_start = COMMIT_GRAPH_LOOKUP_HEADER.size + 256 * 4
+            rows_start = ids_start + self.indexed * self.id_size
+            first = raw[0]
+            # The fan-out table narrows the search to the ids starting with the same byte
+            low = self.fanout(first - 1) if first else 0
+            high = self.fanout(first)
+            while low < high:
+                middle = (low + high) // 2
+                start = ids_start + self.id_size * middle
+                current = self.lookup_data[start:start + self.id_size]
+                if current == raw:
+                    position = struct.unpack_from('>I', self.lookup_data, rows_start + 4 * middle)[0]
+                    # A lookup file left from an older graph is not trusted, the rows are scanned instead
+                    if position < self.count and self.row_id(position) == raw:
+                        return position
+                    return self.scan(raw, 0)
+                if current < raw:
+                    low = middle + 1
+                else:
+                    high = middle
+        return self.scan(raw, self.indexed)
+
+    def scan(self, raw, first_row):
+        """Return the row number of a raw commit id among the rows from first_row on, or None."""
+        begin = COMMIT_GRAPH_HEADER.size + first_row * self.row_struct.size
+        end = COMMIT_GRAPH_HEADER.size + self.count * self.row_struct.size
+        # New commits are appended, so the tips log starts from are found near the end
+        while True:
+            pos = self.data.rfind(raw, begin, end)
+            if pos == -1:
+                return None
+            if (pos - COMMIT_GRAPH_HEADER.size) % self.row_struct.size == 0:
+                return (pos - COMMIT_GRAPH_HEADER.size) // self.row_struct.size
+            end = pos + len(raw) - 1
+
+    def row_id(self, position):
+        """Return the raw commit id of a row."""
+        start = COMMIT_GRAPH_HEADER.size + position * self.row_struct.size
+        return self.data[start:start + self.id_size]
+
+    def row(self, position):
+        """Return (commit, tree, parent rows, timestamp, generation) of a row."""
+        commit, tree, parent1, parent2, timestamp, generation, _, _ = self.row_struct.unpack_from(
+            self.data, COMMIT_GRAPH_HEADER.size + position * self.row_struct.size)
+        parents = [parent for parent in (parent1, parent2) if parent != GRAPH_NO_PARENT]
+        return commit.hex(), tree.hex(), parents, timestamp, generation
+
+    def summary(self, position):
+        """Return (author, message) of a row."""
+        offset = self.row_struct.unpack_from(self.data, COMMIT_GRAPH_HEADER.size + position * self.row_struct.size)[6]
+        end = self.summaries.index(b'\n', offset)
+        author, message = self.summaries[offset:end].decode().split('\0', 1)
+        return author, message
+
+    def may_have_changed(self, position, keys):
+        """Return False when the Bloom filter of a row rules out a change to every path of keys (from bloom_key)."""
+        offset = self.row_struct.unpack_from(self.data, COMMIT_GRAPH_HEADER.size + position * self.row_struct.size)[7]
+        bits, = BLOOM_HEADER.unpack_from(self.bloom, offset)
+        if bits == 0:
+            return True
+        start = offset + BLOOM_HEADER.size
+        for key in keys:
+            if all(self.bloom[start + (bit >> 3)] & (1 << (bit & 7)) for bit in bloom_bits(key, bits)):
+                return True
+        return False
+
+    def close(self):
+        """Unmap the graph."""
+        self.data.close()
+
+def commit_graph_row(graph_id_size):
+    """Return the struct of a commit-graph row holding raw ids of graph_id_size bytes."""
+    return struct.Struct(f'>{graph_id_size}s{graph_id_size}sIIqIQQ')
+
+def load_commit_graph():
+    """Return the commit graph, or None when it is missing or unreadable."""
+    if not all(os.path.exists(repo_path(path)) for path in (COMMIT_GRAPH_PATH, COMMIT_GRAPH_SUMMARIES_PATH, COMMIT_GRAPH_BLOOM_PATH)):
+        return None
     try:
-        # Check if .myvcs/ already exists
-        if not os.path.exists('.myvcs'):
-            # If not, create the directory structure
-            os.makedirs('.myvcs/objects', exist_ok=True)
-            os.makedirs('.myvcs/refs', exist_ok=True)
-            os.makedirs('.myvcs/refs/branches')
-            with open('.myvcs/HEAD', 'w') as head_file:
-                # Create the HEAD file with default branch
-                head_file.write('refs/branches/main\n')
+        return CommitGraph()
+    except (ValueError, OSError, struct.error):
+        return None
+
+def ref_tips():
+    """Return the commit hashes every branch and tag points to."""
+    tips = []
+    for prefix in (BRANCH_PREFIX, TAG_PREFIX):
+        tips.extend(ref_hash for ref_hash in list_refs(prefix).values() if ref_hash)
+    return tips
+
+def graph_summary(commit):
+    """Return the summary line stored for a parsed commit."""
+    return f"{commit.author}\0{commit.message}\n".encode()
+
+def bloom_key(path):
+    """Return the pair of hashes a path sets and tests Bloom filter bits with."""
+    digest = hashlib.blake2b(path.encode(), digest_size=16).digest()
+    # An odd step never cycles early through a power-of-two sized filter
+    return int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+
+def bloom_bits(key, bits):
+    """Return the bit numbers of a key in a filter of bits bits."""
+    first, step = key
+    return [(first + i * step) % bits for i in range(BLOOM_HASHES)]
+
+def bloom_filter(changed_paths):
+    """Return the stored Bloom filter of a commit's changed paths, with their directories."""
+    paths = set()
+    for path in changed_paths:
+        parts = path.split('/')
+        paths.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    if len(paths) > BLOOM_MAX_PATHS:
+        return BLOOM_HEADER.pack(0)
+    bits = max(64, -(-len(paths) * BLOOM_BITS_PER_PATH // 8) * 8)
+    data = bytearray(bits // 8)
+    for path in paths:
+        for bit in bloom_bits(bloom_key(path), bits):
+            data[bit >> 3] |= 1 << (bit & 7)
+    return BLOOM_HEADER.pack(bits) + data
+
+def commit_bloom_filter(commit, parent_tree):
+    """Return the Bloom filter of the paths a commit changed against its first parent's tree."""
+    return bloom_filter(path for path, _, _ in diff_trees(parent_tree, commit.tree))
+
+def write_commit_graph():
+    """Rebuild the commit graph from every commit reachable from a branch or tag."""
+    rows = {}
+    order = []
+    commits_parsed = {}
+    for tip in ref_tips():
+        # Iterative post-order walk so every parent gets its row before its children
+        stack = [(tip, False)]
+        while stack:
+            commit_hash, parents_done = stack.pop()
+            if commit_hash in rows:
+                continue
+            if parents_done:
+                rows[commit_hash] = len(order)
+                order.append(commit_hash)
+                continue
+            commit = read_commit(commit_hash)
+            commits_parsed[commit_hash] = commit
+            stack.append((commit_hash, True))
+            for parent in commit.parents:
+                if parent not in rows:
+                    stack.append((parent, False))
+
+    generations = {}
+    tmp_graph_path = repo_path(COMMIT_GRAPH_PATH + '.tmp')
+    tmp_summaries_path = repo_path(COMMIT_GRAPH_SUMMARIES_PATH + '.tmp')
+    tmp_bloom_path = repo_path(COMMIT_GRAPH_BLOOM_PATH + '.tmp')
+    with open(tmp_graph_path, 'wb') as graph_file, open(tmp_summaries_path, 'wb') as summaries_file, \
+            open(tmp_bloom_path, 'wb') as bloom_file:
+        graph_id_size = id_size()
+        row_struct = commit_graph_row(graph_id_size)
+        graph_file.write(COMMIT_GRAPH_HEADER.pack(COMMIT_GRAPH_SIGNATURE, COMMIT_GRAPH_VERSION, graph_id_size))
+        for commit_hash in order:
+            commit = commits_parsed[commit_hash]
+            parents = [rows[parent] for parent in commit.parents[:2]]
+            generations[commit_hash] = 1 + max((generations[parent] for parent in commit.parents[:2]), default=0)
+            summary_offset = summaries_file.tell()
+            summaries_file.write(graph_summary(commit))
+            bloom_offset = bloom_file.tell()
+            parent_tree = commits_parsed[commit.parents[0]].tree if commit.parents else None
+            bloom_file.write(commit_bloom_filter(commit, parent_tree))
+            parents += [GRAPH_NO_PARENT] * (2 - len(parents))
+            graph_file.write(row_struct.pack(bytes.fromhex(commit_hash), bytes.fromhex(commit.tree), parents[0], parents[1],
+                                             commit.timestamp, generations[commit_hash], summary_offset, bloom_offset))
+    # Summaries and filters go in first so a row never points past the end of them
+    os.replace(tmp_summaries_path, repo_path(COMMIT_GRAPH_SUMMARIES_PATH))
+    os.replace(tmp_bloom_path, repo_path(COMMIT_GRAPH_BLOOM_PATH))
+    os.replace(tmp_graph_path, repo_path(COMMIT_GRAPH_PATH))
+    write_commit_graph_lookup([bytes.fromhex(commit_hash) for commit_hash in order])
+    return len(order)
+
+def write_commit_graph_lookup(row_ids):
+    """Write the lookup file for a graph whose rows hold the raw ids row_ids, in order."""
+    entries = sorted(zip(row_ids, range(len(row_ids))))
+    fanout = [0] * 256
+    for raw, _ in entries:
+        fanout[raw[0]] += 1
+    for byte in range(1, 256):
+        fanout[byte] += fanout[byte - 1]
+    tmp_lookup_path = repo_path(COMMIT_GRAPH_LOOKUP_PATH + '.tmp')
+    with open(tmp_lookup_path, 'wb') as lookup_file:
+        lookup_file.write(COMMIT_GRAPH_LOOKUP_HEADER.pack(COMMIT_GRAPH_LOOKUP_SIGNATURE, len(entries)))
+        lookup_file.write(struct.pack('>256I', *fanout))
+        lookup_file.write(b''.join(raw for raw, _ in entries))
+        lookup_file.write(struct.pack(f'>{len(entries)}I', *(position for _, position in entries)))
+    os.replace(tmp_lookup_path, repo_path(COMMIT_GRAPH_LOOKUP_PATH))
+
+def update_commit_graph(commit_hash):
+    """Append a new commit to the commit graph, rebuilding the graph if it is missing or stale."""
+    commit = read_commit(commit_hash)
+    graph = load_commit_graph()
+    parents = []
+    generation = 1
+    if graph is not None:
+        try:
+            for parent in commit.parents[:2]:
+                position = graph.lookup(parent)
+                if position is None:
+                    break
+                parents.append(position)
+                generation = max(generation, graph.row(position)[4] + 1)
+            count = graph.count
+            row_struct = graph.row_struct
+            indexed = graph.indexed
+            stale = len(parents) != len(commit.parents[:2]) or graph.lookup(commit_hash) is not None
+            parent_tree = graph.row(parents[0])[1] if parents else None
+        finally:
+            graph.close()
+    if graph is None or stale:
+        write_commit_graph()
+        return
+
+    with open(repo_path(COMMIT_GRAPH_SUMMARIES_PATH), 'ab') as summaries_file:
+        summary_offset = summaries_file.tell()
+        summaries_file.write(graph_summary(commit))
+    with open(repo_path(COMMIT_GRAPH_BLOOM_PATH), 'ab') as bloom_file:
+        bloom_offset = bloom_file.tell()
+        bloom_file.write(commit_bloom_filter(commit, parent_tree))
+    parents += [GRAPH_NO_PARENT] * (2 - len(parents))
+    with open(repo_path(COMMIT_GRAPH_PATH), 'r+b') as graph_file:
+        # Drop a half-written row left by an interrupted append before adding the new one
+        graph_file.truncate(COMMIT_GRAPH_HEADER.size + count * row_struct.size)
+        graph_file.seek(0, os.SEEK_END)
+        graph_file.write(row_struct.pack(bytes.fromhex(commit_hash), bytes.fromhex(commit.tree), parents[0], parents[1],
+                                         commit.timestamp, generation, summary_offset, bloom_offset))
+    if count + 1 - indexed > COMMIT_GRAPH_LOOKUP_TAIL:
+        graph = CommitGraph()
+        try:
+            write_commit_graph_lookup([graph.row_id(position) for position in range(graph.count)])
+        finally:
+            graph.close()
+
+def first_parent_history(commit_hash, graph):
+    """
+    Yield (commit hash, graph row or None) along first parents, starting at commit_hash.
+
+    Commits the graph does not know yet (it is stale) are read from their objects until the
+    walk reaches one that it does, from where it continues inside the graph.
+    """
+    position = graph.lookup(commit_hash) if graph is not None else None
+    while commit_hash is not None:
+        if position is not None:
+            yield commit_hash, position
+            _, _, parents, _, _ = graph.row(position)
+            position = parents[0] if parents else None
+            commit_hash = graph.row(position)[0] if position is not None else None
         else:
-            # In case the directory exists, we can check if the necessary subdirectories and files exist and create them if they don't
-            os.makedirs('.myvcs/objects', exist_ok=True)
-            os.makedirs('.myvcs/refs', exist_ok=True)
-            if not os.path.exists('.myvcs/HEAD'):
-                with open('.myvcs/HEAD', 'w') as head_file:
-                    # Create the HEAD file with default branch
-                    head_file.write('refs/branches/main\n')
-        with open('.myvcs/config', 'w') as config_file:
-            # Create the config file with author information
-            config_file.write(f"author_name={author_name}\n")
-            config_file.write(f"author_email={author_email}\n")
-    except PermissionError:
-        print("Error: Permission denied. Please run this script with appropriate permissions.")
-    except OSError as e:
-        print(f"Error: {e.strerror}. Please check your file system.")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-    
-def author_info():
+            yield commit_hash, None
+            parents = read_commit(commit_hash).parents
+            commit_hash = parents[0] if parents else None
+            position = graph.lookup(commit_hash) if graph is not None and commit_hash is not None else None
+
+def tree_entry(tree_hash, path):
+    """Return the (kind, hash) entry of a path in a tree, or None; only the trees along the path are read."""
+    parts = path.split('/')
+    for i, name in enumerate(parts):
+        tree = read_tree(tree_hash)
+        if tree.flat:
+            # Old flat trees name files by full path, a directory is compared by the files below it
+            rest = '/'.join(parts[i:])
+            return tree.entries.get(rest) or frozenset(
+                entry for entry in tree.entries.items() if entry[0].startswith(rest + '/')) or None
+        entry = tree.entries.get(name)
+        if entry is None or i == len(parts) - 1:
+            return entry
+        if entry[0] != 'tree':
+            return None
+        tree_hash = entry[1]
+
+def parse_log_date(text):
+    """Parse a --since/--until date (YYYY-MM-DD, YYYY-MM-DD HH:MM:SS or a Unix timestamp) into a timestamp."""
+    if text.isdigit():
+        return int(text)
+    for date_format in ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return int(time.mktime(time.strptime(text, date_format)))
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid date '{text}', expected YYYY-MM-DD, 'YYYY-MM-DD HH:MM:SS' or a timestamp.")
+
+def log_history(commit_hash, graph, paths=(), author=None, since=None, until=None, grep=None):
+    """
+    Yield (commit hash, graph row or None) of the first-parent history matching every filter.
+
+    paths keeps the commits that changed any of the paths (files or directories) against their
+    first parent, author and grep are regular expressions searched in the author name and the
+    message, since and until are inclusive timestamps. Commits known to the graph are matched
+    from its rows; for paths their Bloom filter rejects most of them before any tree is read.
+    """
+    paths = [path.strip('/') for path in paths]
+    keys = [bloom_key(path) for path in paths]
+    author = re.compile(author) if author is not None else None
+    grep = re.compile(grep) if grep is not None else None
+    for commit_hash, position in first_parent_history(commit_hash, graph):
+        if position is not None:
+            _, tree, parents, timestamp, _ = graph.row(position)
+            parent_tree = graph.row(parents[0])[1] if parents else None
+            if author is not None or grep is not None:
+                author_name, message = graph.summary(position)
+        else:
+            commit = read_commit(commit_hash)
+            tree, timestamp, author_name, message = commit.tree, commit.timestamp, commit.author, commit.message
+            parent_tree = read_commit(commit.parents[0]).tree if commit.parents else None
+        if since is not None and timestamp < since or until is not None and timestamp > until:
+            continue
+        if author is not None and not author.search(author_name):
+            continue
+        if grep is not None and not grep.search(message):
+            continue
+        if paths:
+            if position is not None and not graph.may_have_changed(position, keys):
+                continue
+            if all(tree_entry(tree, path) == tree_entry(parent_tree, path) for path in paths):
+                continue
+        yield commit_hash, position
+
+def commit_record(commit):
+    """Return a parsed commit as a dict, as printed by 'log --json'."""
+    return {'commit': commit.hash, 'tree': commit.tree, 'parents': list(commit.parents), 'author': commit.author,
+            'email': commit.email.strip('<>'), 'timestamp': commit.timestamp, 'message': commit.message}
+
+def log_commit(n_commit, oneline=False, paths=(), author=None, since=None, until=None, grep=None, json_lines=False):
+    """
+    Log commit prints out N most recent commits (all of them when N is 0) that match the filters.
+
+    The history is walked through the commit graph; with oneline only the graph is read,
+    without opening any commit or tree object (but for the trees --path needs to confirm a
+    Bloom filter match). With json_lines each commit is printed as one JSON object.
+    """
+    head_path = ".myvcs/HEAD"
+    # Check if HEAD file exists
+    if not os.path.exists(repo_path(head_path)):
+        raise FileNotFoundError(f"The HEAD file does not exist.")
+
+    # Get the commit hash of the branch HEAD points to
+    hash_path = head_commit()
+    if hash_path is None:
+        raise FileNotFoundError(f"The branch '{head_ref_name()}' has no commits.")
+
+    graph = load_commit_graph()
+    try:
+        history = log_history(hash_path, graph, paths, author, since, until, grep)
+        for i, (hash_path, position) in enumerate(history):
+            if i == n_commit and n_commit:
+                return
+            if json_lines:
+                print(json.dumps(commit_record(read_commit(hash_path))))
+                continue
+            if oneline:
+                print_summary(hash_path, *commit_summary(hash_path, graph, position))
+                continue
+            if i > 0:
+                print("\n")
+            commit = read_commit(hash_path)
+            print_commit(commit, tree_files(commit.tree))
+    finally:
+        if graph is not None:
+            graph.close()
+    if not oneline and not json_lines:
+        print("\n(No more commits to print.)")
+
+def commit_summary(commit_hash, graph, position):
+    """Return (timestamp, author, message) of a commit, from its graph row when position is not None."""
+    if position is not None:
+        _, _, _, timestamp, _ = graph.row(position)
+        author_name, message = graph.summary(position)
+        return timestamp, author_name, message
+    commit = read_commit(commit_hash)
+    return commit.timestamp, commit.author, commit.message
+
+def print_summary(commit_hash, timestamp, author_name, message):
+    """Print one commit on one line, as shown by 'log --oneline'."""
+    timestamp_readable = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+    print(f"{commit_hash[:10]} {timestamp_readable} {author_name}: {message}")
+
+def print_commit(commit, files):
+    """Print one commit with the files of its tree (a dict of path -> blob hash), as shown by 'log'."""
+    print(f"Commit: {commit.hash}")
+    print(f"Tree: {commit.tree}")
+    for idx, file in enumerate(f'{file_hash} {path}' for path, file_hash in files.items()):
+        if idx == 0:
+            print(f"File(s): {file}")
+        else:
+            print(f"      {file}")
+    for parent in commit.parents:
+        print(f"Parent: {parent}")
+    print(f"Author: {commit.author}")
+    print(f"Email: {commit.email}")
+    timestamp_readable = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(commit.timestamp))
+    print(f"Timestamp: {timestamp_readable}")
+    print(f"Message: {commit.message}")
+
+def stage_file(filepath, entry=None, index_mtime_ns=0):
+    """
+    Store one file as a blob and return (path, hash, stat data, bytes read, new object paths); runs in the add worker pool.
+
+    entry is the file's [hash, stat_data] in the index. When its stat data still matches, the
+    file is not read at all. A tracked file that looks modified is hashed before anything is
+    written, so content that is already stored (a touched file, a reverted edit) costs one read
+    and no write; new files are hashed and stored in a single pass.
+    """
+    stat_data = file_stat_data(filepath)
+    path = os.path.normpath(filepath)
+    if entry is not None:
+        if stat_matches(entry[1], path, index_mtime_ns, stat_data):
+            return path, entry[0], stat_data, 0, []
+        hashed_content = hash_file(filepath)
+        if object_exists(hashed_content):
+            return path, hashed_content, stat_data, stat_data[2], []
+    hashed_content, written = store_file(filepath)
+    return path, hashed_content, stat_data, stat_data[2], written
+
+def expand_add_paths(paths, add_all):
+    """
+    Expand the arguments of 'add' (files, directories and globs) into the files to stage.
+
+    Tracked files missing from the worktree are included when they are named, lie in a named
+    directory or add_all is set; stage_files records them as deletions.
+    """
+    tracked = load_index(missing_ok=True)
+
+    def missing_tracked(path):
+        prefix = os.path.normpath(path)
+        return [tracked_path for tracked_path in tracked
+                if (prefix == '.' or tracked_path == prefix or tracked_path.startswith(prefix + '/'))
+                and not os.path.exists(repo_path(tracked_path))]
+
+    if add_all:
+        return list_all_files() + missing_tracked('.')
+
+    filepaths = []
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path, root_dir=REPOSITORY_ROOT.get(), recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"No files match '{path}'.")
+        else:
+            if not os.path.exists(repo_path(path)):
+                deleted = missing_tracked(path)
+                if not deleted:
+                    raise FileNotFoundError(f"The file '{path}' does not exist.")
+                filepaths.extend(deleted)
+                continue
+            matches = [path]
+        for match in matches:
+            if os.path.isdir(repo_path(match)):
+                filepaths.extend(os.path.join(match, file) for file in list_all_files(match))
+                filepaths.extend(missing_tracked(match))
+            elif os.path.isfile(repo_path(match)):
+                filepaths.append(match)
+    # The same file can be named by several arguments
+    return list(dict.fromkeys(os.path.normpath(filepath) for filepath in filepaths))
+
+def stage_files(filepaths, jobs=None):
+    """
+    Stage many files at once and return the (path, hash, stat data, bytes read, written) of each.
+
+    Blobs are hashed, compressed and written by a pool of worker processes, and the index is
+    rewritten once at the end instead of being appended to for every file. A path missing from
+    the worktree is staged as a deletion: it leaves the index and is returned with hash None.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    deleted = [os.path.normpath(filepath) for filepath in filepaths if not os.path.exists(repo_path(filepath))]
+    filepaths = [filepath for filepath in filepaths if os.path.exists(repo_path(filepath))]
+    index_data = load_index(missing_ok=True)
+    index_path = repo_path(INDEX_PATH)
+    index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+    entries = [index_data.get(os.path.normpath(filepath)) for filepath in filepaths]
+    mtimes = [index_mtime_ns] * len(filepaths)
+    with object_transaction():
+        if jobs == 1 or len(filepaths) <= 1:
+            staged = list(map(stage_file, filepaths, entries, mtimes))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=set_repository_root,
+                                                        initargs=(REPOSITORY_ROOT.get(),)) as executor:
+                # Hand files out in batches so per-task overhead does not dominate small files
+                chunksize = max(1, min(64, len(filepaths) // (jobs * 4)))
+                staged = list(executor.map(stage_file, filepaths, entries, mtimes, chunksize=chunksize))
+        # The workers cannot see this process's transaction, so their new objects join it here
+        pending = PENDING_SYNC.get()
+        if pending is not None:
+            for *_, written in staged:
+                pending.extend(written)
+
+    for path, hashed_content, stat_data, _, _ in staged:
+        index_data[path] = [hashed_content, stat_data]
+    for path in deleted:
+        index_data.pop(path, None)
+    write_index(index_data, durable=True)
+    return staged + [(path, None, None, 0, []) for path in deleted]
+
+def add_paths(paths, add_all=False, jobs=None):
+    """
+    Stage files, directories or glob patterns and return a summary, or None when nothing matched.
+
+    The summary maps 'files' and 'deleted' to the numbers of files and of deletions staged,
+    'bytes' to the bytes read, 'objects' to the new objects written and 'seconds' to the time taken.
+    """
+    filepaths = expand_add_paths(paths, add_all)
+    if not filepaths:
+        return None
+    start = time.perf_counter()
+    staged = stage_files(filepaths, jobs)
+    deleted = sum(1 for _, hashed_content, *_ in staged if hashed_content is None)
+    return {'files': len(staged) - deleted, 'deleted': deleted, 'bytes': sum(size for _, _, _, size, _ in staged),
+            'objects': sum(len(new) for *_, new in staged), 'seconds': time.perf_counter() - start}
+
+def add_files(paths, add_all=False, jobs=None):
+    """Stage the files named on the command line and report the throughput."""
+    print_add_summary(add_paths(paths, add_all, jobs))
+
+def print_add_summary(summary):
+    """Print the summary returned by add_paths with the throughput, as 'add' does."""
+    if summary is None:
+        print('No files to add.')
+        return
+    elapsed = summary['seconds']
+    rate = (summary['files'] + summary['deleted']) / elapsed if elapsed else float('inf')
+    throughput = summary['bytes'] / (1024 * 1024) / elapsed if elapsed else float('inf')
+    print(f"Added {summary['files']} file(s), {summary['bytes'] / (1024 * 1024):.1f} MB read in {elapsed:.2f}s "
+          f"({rate:.0f} files/s, {throughput:.1f} MB/s), {summary['objects']} new object(s).")
+    if summary['deleted']:
+        print(f"Staged the deletion of {summary['deleted']} file(s).")
+
+def hash_file(filepath, algorithm=None):
+    """Return the object id of a file's content, reading it in chunks."""
+    hasher = new_hasher(algorithm)
+    with open(repo_path(filepath), 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def read_config():
+    """Return the key=value pairs of the config file as a dict."""
     config_path = '.myvcs/config'
-    if not os.path.exists(config_path):
+    if not os.path.exists(repo_path(config_path)):
         raise FileNotFoundError(f"The config file '{config_path}' does not exist.")
-    with open(config_path, 'r') as config_file:
-        config_data = config_file.readlines()
-    author_name = config_data[0].split('=')[1].strip()
-    author_email = config_data[1].split('=')[1].strip()
-    
-    return author_name, author_email
 
-def create_commit(message):
-    staged_files = load_index()
-    
-    if not staged_files:
-        raise ValueError("No files staged for commit.")
-    
-    tree_content = "".join(f'{file[0]} {file[1]}\n' for file in staged_files)
-    tree_hash = hashlib.sha1(tree_content.encode()).hexdigest()
-    
-    # Save the tree to the objects directory so we can know what has been modified in the commit
-    with open(f".myvcs/objects/{tree_hash}", "w") as tree_file:
-        tree_file.write(tree_content)
+    def read():
+        config = {}
+        with open(repo_path(config_path), 'r') as config_file:
+            for line in config_file:
+                if '=' in line:
+                    key, value = line.split('=', 1)
+                    config[key.strip()] = value.strip()
+        return config
+    return dict(cached_file(config_path, read))
 
-    aurhor_name, author_email = author_info()
-    
-    timestamp = int(time.time())
-    if not os.path.exists('.myvcs/refs/branches/main') or os.path.getsize('.myvcs/refs/branches/main') == 0:
-        commit_content = f"""
-                tree {tree_hash}
-                author {aurhor_name} <{author_email}> 
-                timestamp {timestamp}
-                message {message}
-            """
+def set_config(key, value):
+    """Set a key of the config file, or remove it when value is None."""
+    config = read_config()
+    config.pop(key, None)
+    if value is not None:
+        config[key] = value
+    write_repository_file('.myvcs/config', ''.join(f"{name}={setting}\n" for name, setting in config.items()))
+
+def compression_level():
+    """Return the zlib level objects are written with (compression_level in the config)."""
+    if not os.path.exists(repo_path('.myvcs/config')):
+        return zlib.Z_DEFAULT_COMPRESSION
+    return int(read_config().get('compression_level', zlib.Z_DEFAULT_COMPRESSION))
+
+# Files at least this large are stored as content-defined chunks (chunk_threshold in the config)
+CHUNK_THRESHOLD = 8 * 1024 * 1024
+
+def object_cache_budget():
+    """Return the byte budget of the parsed object cache (object_cache_budget in the config)."""
+    if not os.path.exists(repo_path('.myvcs/config')):
+        return OBJECT_CACHE_BUDGET
+    return int(read_config().get('object_cache_budget', OBJECT_CACHE_BUDGET))
+
+def chunk_threshold():
+    """Return the size from which files are stored as chunks (chunk_threshold in the config)."""
+    if not os.path.exists(repo_path('.myvcs/config')):
+        return CHUNK_THRESHOLD
+    return int(read_config().get('chunk_threshold', CHUNK_THRESHOLD))
+
+FSYNC_MODES = ('batch', 'off')
+# Threads issuing the fsyncs of one batch
+FSYNC_THREADS = 8
+
+def fsync_mode():
+    """
+    Return how new objects and the index are made durable (fsync in the config).
+
+    'batch' (the default) fsyncs everything a command wrote in one pass before the index or a
+    ref is updated; 'off' leaves flushing to the operating system.
+    """
+    if not os.path.exists(repo_path('.myvcs/config')):
+        return 'batch'
+    mode = read_config().get('fsync', 'batch')
+    if mode not in FSYNC_MODES:
+        raise ValueError(f"Unknown fsync mode '{mode}', expected one of: {', '.join(FSYNC_MODES)}.")
+    return mode
+
+# Object ids are hex digests of the content, made with the hash named in the config. It is
+# chosen at 'init' and only changed by 'convert-hash', which rewrites every object; repositories
+# from before the setting existed use sha1. blake2b ids are 32-byte digests, as long as sha256.
+HASH_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': lambda data=b'': hashlib.blake2b(data, digest_size=32),
+}
+DEFAULT_HASH = 'sha1'
+# Matches an object id of any of the algorithms
+OBJECT_ID_PATTERN = re.compile(r'[0-9a-f]{40}|[0-9a-f]{64}')
+
+def hash_algorithm():
+    """Return the name of the hash object ids are made with (hash in the config)."""
+    if not os.path.exists(repo_path('.myvcs/config')):
+        return DEFAULT_HASH
+    algorithm = read_config().get('hash', DEFAULT_HASH)
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm '{algorithm}', expected one of: {', '.join(HASH_ALGORITHMS)}.")
+    return algorithm
+
+def new_hasher(algorithm=None):
+    """Return a hash object for object ids, of the repository's algorithm unless one is given."""
+    return HASH_ALGORITHMS[algorithm or hash_algorithm()]()
+
+def hash_bytes(data, algorithm=None):
+    """Return the object id of in-memory content."""
+    return HASH_ALGORITHMS[algorithm or hash_algorithm()](data).hexdigest()
+
+def id_size(algorithm=None):
+    """Return the size in bytes of a raw object id."""
+    return new_hasher(algorithm).digest_size
+
+# ================================= Object store =================================
+# Objects are stored zlib-compressed as "<type> <size>\0<content>" under a two-character
+# fan-out directory (.myvcs/objects/ab/cdef...). The object id is the hash of the content
+# alone, so ids are the same as in the older flat, uncompressed layout, which is still
+# readable until 'migrate-objects' converts it.
+
+OBJECT_TYPES = ('blob', 'tree', 'commit', 'chunked')
+
+def object_path(object_hash):
+    """Return the location of a loose object in the fan-out layout."""
+    return repo_path(os.path.join('.myvcs/objects', object_hash[:2], object_hash[2:]))
+
+def legacy_object_path(object_hash):
+    """Return the location of an object in the old flat, uncompressed layout."""
+    return repo_path(os.path.join('.myvcs/objects', object_hash))
+
+def object_exists(object_hash):
+    """Return True if the object is stored loose in either layout or in a pack."""
+    if os.path.exists(object_path(object_hash)) or os.path.exists(legacy_object_path(object_hash)):
+        return True
+    return find_packed(object_hash)[0] is not None
+
+def object_header(obj_type, size):
+    """Return the header that precedes an object's content."""
+    if obj_type not in OBJECT_TYPES:
+        raise ValueError(f"Unknown object type '{obj_type}'.")
+    return f"{obj_type} {size}\0".encode()
+
+def install_object(tmp_path, object_hash):
+    """
+    Atomically move a fully written temporary object file to its final name.
+
+    Objects are write-once: when the object already exists the temporary file is dropped and
+    False is returned, so a stored object is never rewritten under readers.
+    """
+    final_path = object_path(object_hash)
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+        return False
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(tmp_path, final_path)
+    record_write(final_path)
+    return True
+
+# Paths written inside the running object transaction that still need an fsync, None outside one
+PENDING_SYNC = contextvars.ContextVar('PENDING_SYNC', default=None)
+
+def fsync_path(path):
+    """fsync a file or a directory by name."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_paths(paths):
+    """
+    fsync a batch of new files, then the directories that gained them.
+
+    The files are synced in parallel so the device sees one burst of flushes; each directory is
+    synced once afterwards, together with its parent in case it was just created (a new fan-out
+    directory is itself a new entry of the objects directory).
+    """
+    paths = list(paths)
+    if not paths:
+        return
+    directories = {os.path.dirname(path) or '.' for path in paths}
+    directories |= {os.path.dirname(directory) for directory in directories if os.path.dirname(directory)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FSYNC_THREADS) as executor:
+        list(executor.map(fsync_path, paths))
+    for directory in sorted(directories, key=len, reverse=True):
+        fsync_path(directory)
+
+def sync_pending_objects():
+    """fsync what the running object transaction wrote so far, before a ref is pointed at it."""
+    pending = PENDING_SYNC.get()
+    if pending:
+        if fsync_mode() == 'batch':
+            sync_paths(pending)
+        pending.clear()
+
+def record_write(path):
+    """Make a newly installed file durable, in the running transaction's batch or right away."""
+    pending = PENDING_SYNC.get()
+    if pending is not None:
+        pending.append(path)
+    elif fsync_mode() == 'batch':
+        sync_paths([path])
+
+@contextlib.contextmanager
+def object_transaction():
+    """
+    Collect the objects written inside the block and fsync them all when it ends.
+
+    Callers update the index or a ref only after the block, so nothing ever points at an object
+    that is not on disk yet. Nested blocks join the outer one; on an exception nothing is synced.
+    """
+    if PENDING_SYNC.get() is not None:
+        yield
+        return
+    pending = []
+    token = PENDING_SYNC.set(pending)
+    try:
+        yield
+    finally:
+        PENDING_SYNC.reset(token)
+    if fsync_mode() == 'batch':
+        sync_paths(pending)
+
+def write_object(obj_type, content, object_hash=None):
+    """
+    Store an in-memory object (trees and commits) and return its hash.
+
+    object_hash is only given when the id is already known (re-storing an object under the id
+    it has, or 'convert-hash'), and then only a copy in the compressed loose layout counts as
+    already stored.
+    """
+    if isinstance(content, str):
+        content = content.encode()
+    if object_hash is None:
+        object_hash = hash_bytes(content)
+        if object_exists(object_hash):
+            return object_hash
+    elif os.path.exists(object_path(object_hash)):
+        return object_hash
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir=repo_path('.myvcs/objects'))
+    try:
+        with os.fdopen(fd, 'wb') as object_file:
+            object_file.write(zlib.compress(object_header(obj_type, len(content)) + content, compression_level()))
+        install_object(tmp_path, object_hash)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return object_hash
+
+def store_file(filepath):
+    """
+    Stream a file into the object store as a blob and return (hash, paths of the new objects).
+
+    Only one chunk of the file is held in memory at a time (see store_stream). Files of
+    chunk_threshold bytes or more are stored as chunks instead (see store_chunked_file).
+    """
+    size = os.path.getsize(repo_path(filepath))
+    # Files too small to be split never need the config read
+    if size >= 2 * CDC_MIN_SIZE and size >= chunk_threshold():
+        return store_chunked_file(filepath)
+    with open(repo_path(filepath), 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+
+        def chunks():
+            read_size = 0
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                read_size += len(chunk)
+                yield chunk
+            # The header was written from the size at open time, it must still describe the content
+            if read_size != size:
+                raise ValueError(f"The file '{filepath}' changed while it was being added.")
+        return store_stream('blob', size, chunks())
+
+def store_stream(obj_type, size, chunks, algorithm=None):
+    """
+    Store an object of size bytes given as an iterable of chunks and return (hash, paths of the new objects).
+
+    The content is hashed and compressed chunk by chunk into a temporary file next to the
+    objects, which is renamed into place once the digest is known, so a partial write never
+    sits under a valid object name. algorithm overrides the repository's hash, for 'convert-hash'.
+    """
+    hasher = new_hasher(algorithm)
+    compressor = zlib.compressobj(compression_level())
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir=repo_path('.myvcs/objects'))
+    try:
+        with os.fdopen(fd, 'wb') as object_file:
+            object_file.write(compressor.compress(object_header(obj_type, size)))
+            for chunk in chunks:
+                hasher.update(chunk)
+                object_file.write(compressor.compress(chunk))
+            object_file.write(compressor.flush())
+        object_hash = hasher.hexdigest()
+        written = [object_path(object_hash)] if install_object(tmp_path, object_hash) else []
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return object_hash, written
+
+def decompress_chunks(decompressor, compressed_chunks):
+    """Yield the output of a decompressor fed from compressed_chunks, at most CHUNK_SIZE at a time."""
+    for data in compressed_chunks:
+        while data:
+            chunk = decompressor.decompress(data, CHUNK_SIZE)
+            if chunk:
+                yield chunk
+            data = decompressor.unconsumed_tail
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+def loose_object_header(path):
+    """Return (type, size) from the header of a loose object, decompressing only the header."""
+    decompressor = zlib.decompressobj()
+    header = b''
+    with open(path, 'rb') as object_file:
+        while b'\0' not in header:
+            compressed = decompressor.unconsumed_tail + object_file.read(64)
+            if not compressed:
+                raise ValueError(f"The object '{path}' is corrupt.")
+            header += decompressor.decompress(compressed, 64)
+    obj_type, size = header.split(b'\0', 1)[0].decode().split()
+    return obj_type, int(size)
+
+def iter_object(object_hash):
+    """
+    Return (type, chunks) for a stored object, where chunks yields its decompressed content.
+
+    Objects in the old flat layout carry no header, so their type is returned as None.
+    """
+    path = object_path(object_hash)
+    try:
+        object_file = open(path, 'rb')
+    except FileNotFoundError:
+        object_file = None
+    if object_file is not None:
+        # The header is read from the start of the content, so the object is opened only once
+        decompressed = decompress_chunks(zlib.decompressobj(), iter(lambda: object_file.read(CHUNK_SIZE), b''))
+        header = b''
+        try:
+            for chunk in decompressed:
+                header += chunk
+                if b'\0' in header:
+                    break
+            else:
+                raise ValueError(f"The object '{path}' is corrupt.")
+        except BaseException:
+            object_file.close()
+            raise
+        header, first = header.split(b'\0', 1)
+
+        def chunks():
+            with object_file:
+                if first:
+                    yield first
+                yield from decompressed
+        return header.decode().split()[0], chunks()
+
+    legacy_path = legacy_object_path(object_hash)
+    if os.path.exists(legacy_path):
+        def legacy_chunks():
+            with open(legacy_path, 'rb') as object_file:
+                yield from iter(lambda: object_file.read(CHUNK_SIZE), b'')
+        return None, legacy_chunks()
+
+    pack, offset = find_packed(object_hash)
+    if pack is None:
+        raise FileNotFoundError(f"The object '{object_hash}' does not exist.")
+    return pack.iter_at(offset)
+
+def object_info(object_hash):
+    """Return (type, size) of a stored object without reading its whole content."""
+    path = object_path(object_hash)
+    if os.path.exists(path):
+        return loose_object_header(path)
+    legacy_path = legacy_object_path(object_hash)
+    if os.path.exists(legacy_path):
+        return None, os.path.getsize(legacy_path)
+    pack, offset = find_packed(object_hash)
+    if pack is None:
+        raise FileNotFoundError(f"The object '{object_hash}' does not exist.")
+    return pack.object_info(offset)
+
+def read_object(object_hash, expected_type=None):
+    """Return the content of a stored object as bytes, checking its type when it is known."""
+    obj_type, chunks = iter_object(object_hash)
+    content = b''.join(chunks)
+    if expected_type is not None and obj_type is not None and obj_type != expected_type:
+        raise ValueError(f"The object '{object_hash}' is a {obj_type}, not a {expected_type}.")
+    return content
+
+# ================================= Chunked blobs =================================
+# Large files are split at content-defined boundaries (FastCDC-style) and each chunk is stored
+# as a blob of its own, so the chunks an edit does not touch are shared with earlier versions
+# and with other files. The file itself is stored as a 'chunked' object under the hash of its
+# whole content, the same id a whole blob would have, listing "<chunk hash> <size>" lines;
+# trees, the index and status never see the difference, and readers reassemble the content
+# one chunk at a time.
+#
+# A boundary is where the gear hash of the last 64 bytes has its masked top bits all zero,
+# with a stricter mask before the normal size and a looser one after it (FastCDC's normalized
+# chunking). Running the gear hash byte by byte is far too slow in Python, so it is only
+# evaluated at candidate positions found at C speed: the data is translated to one bit per
+# byte (the low bit of the byte's gear value) and runs of CDC_RUN set bits are searched for.
+# Candidates and boundaries both depend on the last 64 bytes only, so an insertion moves
+# the boundaries after it with the content instead of shifting every later chunk.
+
+CDC_MIN_SIZE = 256 * 1024
+CDC_NORMAL_SIZE = 1024 * 1024
+CDC_MAX_SIZE = 4 * 1024 * 1024
+CDC_WINDOW = 64
+CDC_GEAR = [int.from_bytes(hashlib.sha1(bytes([value])).digest()[:8], 'big') for value in range(256)]
+# CDC_GEAR_SHIFTED[i][b] is the contribution of byte b at position i of the window before a boundary
+CDC_GEAR_SHIFTED = [[(gear << shift) & 0xffffffffffffffff for gear in CDC_GEAR] for shift in range(CDC_WINDOW - 1, -1, -1)]
+CDC_CANDIDATE_BITS = bytes(b'01'[gear & 1] for gear in CDC_GEAR)
+CDC_RUN = b'1' * 8
+# A candidate turns up about every 512 bytes of random data; these masks make a boundary about
+# one candidate in 2048 before the normal size and one in 256 after it
+CDC_MASK_SMALL = ((1 << 11) - 1) << (64 - 11)
+CDC_MASK_LARGE = ((1 << 8) - 1) << (64 - 8)
+
+def gear_hash(data, end):
+    """Return FastCDC's rolling gear hash at position end, computed from the 64 bytes before it."""
+    return sum(map(list.__getitem__, CDC_GEAR_SHIFTED, data[end - CDC_WINDOW:end])) & 0xffffffffffffffff
+
+def chunk_boundary(data):
+    """Return the length of the first chunk of data, which holds CDC_MAX_SIZE bytes or the rest of a file."""
+    if len(data) <= CDC_MIN_SIZE:
+        return len(data)
+    limit = min(len(data), CDC_MAX_SIZE)
+    # The first candidate run may start before the minimum size as long as it ends after it
+    start = CDC_MIN_SIZE - len(CDC_RUN)
+    bits = data[start:limit].translate(CDC_CANDIDATE_BITS)
+    position = bits.find(CDC_RUN)
+    while position != -1:
+        end = start + position + len(CDC_RUN)
+        mask = CDC_MASK_SMALL if end < CDC_NORMAL_SIZE else CDC_MASK_LARGE
+        if not gear_hash(data, end) & mask:
+            return end
+        # Only the start of a run is a candidate, so long runs of one byte value cost one test
+        position = bits.find(b'0', position)
+        if position == -1:
+            break
+        position = bits.find(CDC_RUN, position)
+    return limit
+
+def content_defined_chunks(file):
+    """Yield the chunks of an open binary file, holding at most CDC_MAX_SIZE bytes (plus one read) at a time."""
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < CDC_MAX_SIZE:
+            data = file.read(CHUNK_SIZE)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        length = chunk_boundary(buffer)
+        yield bytes(buffer[:length])
+        del buffer[:length]
+
+def store_chunked_file(filepath):
+    """
+    Store a file as content-defined chunks plus a manifest and return (hash, paths of the new objects).
+
+    Chunks already in the object store, from an earlier version or another file, are not
+    written again.
+    """
+    algorithm = hash_algorithm()
+    hasher = new_hasher(algorithm)
+    manifest = []
+    written = []
+    read_size = 0
+    with open(repo_path(filepath), 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        for chunk in content_defined_chunks(file):
+            hasher.update(chunk)
+            read_size += len(chunk)
+            chunk_hash = hash_bytes(chunk, algorithm)
+            if not object_exists(chunk_hash):
+                write_object('blob', chunk, chunk_hash)
+                written.append(object_path(chunk_hash))
+            manifest.append(f"{chunk_hash} {len(chunk)}\n")
+    if read_size != size:
+        raise ValueError(f"The file '{filepath}' changed while it was being added.")
+    file_hash = hasher.hexdigest()
+    if not object_exists(file_hash):
+        write_object('chunked', ''.join(manifest), file_hash)
+        written.append(object_path(file_hash))
+    return file_hash, written
+
+def read_manifest(object_hash):
+    """Return the (chunk hash, size) pairs of a chunked blob."""
+    manifest = read_object(object_hash, 'chunked').decode()
+    return [(chunk_hash, int(size)) for chunk_hash, size in (line.split() for line in manifest.splitlines())]
+
+def stored_type(object_hash):
+    """Return the type an object is stored as, or None if it is missing or has no header."""
+    try:
+        return object_info(object_hash)[0]
+    except FileNotFoundError:
+        return None
+
+def iter_blob(blob_hash):
+    """Return an iterator over the content of a blob, reading a chunked blob one chunk at a time."""
+    obj_type, chunks = iter_object(blob_hash)
+    if obj_type not in ('blob', 'chunked', None):
+        raise ValueError(f"The object '{blob_hash}' is a {obj_type}, not a blob.")
+    if obj_type != 'chunked':
+        return chunks
+    manifest = [chunk_hash for chunk_hash, _ in read_manifest(blob_hash)]
+
+    # A chunk can be a whole chunked file stored earlier under the same id, so chunks are read as blobs
+    def chunked_content():
+        for chunk_hash in manifest:
+            yield from iter_blob(chunk_hash)
+    return chunked_content()
+
+# ================================== Pack files ==================================
+# 'repack' moves objects into .myvcs/objects/pack/pack-<id>.pack, where each entry is
+#   <type byte> <size varint> <compressed length varint> [<base distance varint>] <zlib data>
+# and delta entries hold copy/insert instructions against an earlier entry of the same pack.
+# The matching .idx file holds the size of the ids, a 256-entry fan-out table, the sorted raw
+# object ids and their pack offsets, and is read through mmap with a binary search, so a lookup
+# costs O(log n) without touching the objects directory. Version 1 indexes have no id size and
+# hold 20-byte sha1 ids.
+
+PACK_DIR = '.myvcs/objects/pack'
+PACK_SIGNATURE = b'MPAK'
+PACK_INDEX_SIGNATURE = b'MIDX'
+PACK_VERSION = 1
+PACK_INDEX_VERSION = 2
+PACK_TYPE_CODES = {'commit': 1, 'tree': 2, 'blob': 3, 'chunked': 4}
+PACK_TYPE_NAMES = {code: name for name, code in PACK_TYPE_CODES.items()}
+PACK_DELTA = 7
+# Longest chain of deltas a reader has to apply to rebuild an object
+MAX_DELTA_DEPTH = 10
+# How many similar objects each object is tried against as a delta base
+DELTA_WINDOW = 10
+# Objects above this size are packed whole instead of being delta-encoded
+DELTA_SIZE_LIMIT = 16 * 1024 * 1024
+
+def encode_varint(value):
+    """Encode a non-negative integer as a little-endian base-128 varint."""
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+def decode_varint(data, pos):
+    """Decode a varint from data at pos and return (value, position after it)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def create_delta(base, target):
+    """
+    Return the instructions that rebuild target from base.
+
+    The base is indexed by line and every target line found in it starts a copy that is
+    extended over the following lines for as long as the base keeps matching. Everything
+    else is inserted literally. The encoding is the base and target sizes as varints, then
+    copy instructions (0x80 | offset/size byte flags, followed by those bytes) and inserts
+    (a length byte of 1-127 followed by the literal bytes).
+    """
+    base_lines = {}
+    pos = 0
+    for line in base.splitlines(keepends=True):
+        base_lines.setdefault(line, pos)
+        pos += len(line)
+
+    delta = bytearray(encode_varint(len(base)) + encode_varint(len(target)))
+    literal = bytearray()
+
+    def flush_literal():
+        for start in range(0, len(literal), 127):
+            piece = literal[start:start + 127]
+            delta.append(len(piece))
+            delta.extend(piece)
+        literal.clear()
+
+    def emit_copy(offset, size):
+        # A single copy instruction addresses at most 0xffffff bytes
+        while size:
+            piece = min(size, 0xffffff)
+            command = 0x80
+            arguments = bytearray()
+            for i in range(4):
+                byte = (offset >> (8 * i)) & 0xff
+                if byte:
+                    command |= 1 << i
+                    arguments.append(byte)
+            for i in range(3):
+                byte = (piece >> (8 * i)) & 0xff
+                if byte:
+                    command |= 1 << (4 + i)
+                    arguments.append(byte)
+            delta.append(command)
+            delta.extend(arguments)
+            offset += piece
+            size -= piece
+
+    target_lines = target.splitlines(keepends=True)
+    i = 0
+    while i < len(target_lines):
+        line = target_lines[i]
+        offset = base_lines.get(line)
+        i += 1
+        # Copying very short lines costs more than inserting them
+        if offset is None or len(line) < 4:
+            literal.extend(line)
+            continue
+        size = len(line)
+        while i < len(target_lines) and base.startswith(target_lines[i], offset + size):
+            size += len(target_lines[i])
+            i += 1
+        flush_literal()
+        emit_copy(offset, size)
+    flush_literal()
+    return bytes(delta)
+
+def apply_delta(base, delta):
+    """Rebuild an object from its delta base and the instructions made by create_delta."""
+    base_size, pos = decode_varint(delta, 0)
+    result_size, pos = decode_varint(delta, pos)
+    if base_size != len(base):
+        raise ValueError("Delta does not apply to this base.")
+    result = bytearray()
+    while pos < len(delta):
+        command = delta[pos]
+        pos += 1
+        if command & 0x80:
+            offset = 0
+            for i in range(4):
+                if command & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if command & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            result += base[offset:offset + size]
+        else:
+            result += delta[pos:pos + command]
+            pos += command
+    if len(result) != result_size:
+        raise ValueError("Delta produced an object of the wrong size.")
+    return bytes(result)
+
+class Pack:
+    """A pack file and its index, both mapped into memory."""
+
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        self.index_path = pack_path[:-len('.pack')] + '.idx'
+        with open(self.index_path, 'rb') as index_file:
+            self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.pack_path, 'rb') as pack_file:
+            self.data = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.index[:4] != PACK_INDEX_SIGNATURE or self.data[:4] != PACK_SIGNATURE:
+            raise ValueError(f"The pack '{pack_path}' is corrupt.")
+        version, self.count = struct.unpack('>II', self.index[4:12])
+        if version == 1:
+            self.id_size = 20
+            self.fanout_start = 12
+        else:
+            self.id_size = self.index[12]
+            self.fanout_start = 13
+        self.ids_start = self.fanout_start + 256 * 4
+        self.offsets_start = self.ids_start + self.id_size * self.count
+
+    def object_id(self, position):
+        """Return the hex id stored at a position of the sorted id table."""
+        start = self.ids_start + self.id_size * position
+        return self.index[start:start + self.id_size].hex()
+
+    def fanout(self, byte):
+        """Return how many ids in the index start with a byte lower than or equal to byte."""
+        start = self.fanout_start + 4 * byte
+        return struct.unpack('>I', self.index[start:start + 4])[0]
+
+    def find(self, object_hash):
+        """Return the pack offset of an object, or None if this pack does not hold it."""
+        raw = bytes.fromhex(object_hash)
+        if len(raw) != self.id_size:
+            return None
+        first = raw[0]
+        # The fan-out table narrows the search to the ids starting with the same byte
+        low = self.fanout(first - 1) if first else 0
+        high = self.fanout(first)
+        while low < high:
+            middle = (low + high) // 2
+            start = self.ids_start + self.id_size * middle
+            current = self.index[start:start + self.id_size]
+            if current == raw:
+                offset_start = self.offsets_start + 8 * middle
+                return struct.unpack('>Q', self.index[offset_start:offset_start + 8])[0]
+            if current < raw:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def entry_header(self, offset):
+        """Return (type code, size, compressed length, base offset, data offset) of an entry."""
+        type_code = self.data[offset]
+        size, pos = decode_varint(self.data, offset + 1)
+        compressed_length, pos = decode_varint(self.data, pos)
+        base_offset = None
+        if type_code == PACK_DELTA:
+            distance, pos = decode_varint(self.data, pos)
+            base_offset = offset - distance
+        return type_code, size, compressed_length, base_offset, pos
+
+    def object_info(self, offset):
+        """Return (type, size) of the entry at offset, reading only headers along its delta chain."""
+        type_code, size, compressed_length, base_offset, pos = self.entry_header(offset)
+        if type_code != PACK_DELTA:
+            return PACK_TYPE_NAMES[type_code], size
+        # The rebuilt size is the second varint at the start of the delta
+        delta_start = zlib.decompressobj().decompress(self.data[pos:pos + compressed_length], 20)
+        _, varint_end = decode_varint(delta_start, 0)
+        result_size, _ = decode_varint(delta_start, varint_end)
+        obj_type, _ = self.object_info(base_offset)
+        return obj_type, result_size
+
+    def read_at(self, offset, depth=0):
+        """Return (type, content) of the entry at offset, resolving its delta chain."""
+        type_code, size, compressed_length, base_offset, pos = self.entry_header(offset)
+        payload = zlib.decompress(self.data[pos:pos + compressed_length])
+        if type_code != PACK_DELTA:
+            return PACK_TYPE_NAMES[type_code], payload
+        if depth >= MAX_DELTA_DEPTH:
+            raise ValueError(f"Delta chain in '{self.pack_path}' is deeper than {MAX_DELTA_DEPTH}.")
+        obj_type, base = self.read_at(base_offset, depth + 1)
+        return obj_type, apply_delta(base, payload)
+
+    def iter_at(self, offset):
+        """Return (type, chunks) for the entry at offset, streaming whole (non-delta) entries."""
+        type_code, size, compressed_length, base_offset, pos = self.entry_header(offset)
+        if type_code == PACK_DELTA:
+            obj_type, content = self.read_at(offset)
+            return obj_type, iter([content])
+
+        def chunks():
+            decompressor = zlib.decompressobj()
+            for start in range(pos, pos + compressed_length, CHUNK_SIZE):
+                chunk = decompressor.decompress(self.data[start:min(start + CHUNK_SIZE, pos + compressed_length)])
+                if chunk:
+                    yield chunk
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+        return PACK_TYPE_NAMES[type_code], chunks()
+
+    def close(self):
+        """Unmap the pack and its index."""
+        self.index.close()
+        self.data.close()
+
+# The open packs of each repository root
+_packs = {}
+_packs_lock = threading.Lock()
+
+def packs():
+    """Return the packs of the repository, opening them on first use."""
+    root = REPOSITORY_ROOT.get()
+    with _packs_lock:
+        if root not in _packs:
+            pack_dir = repo_path(PACK_DIR)
+            opened = []
+            if os.path.exists(pack_dir):
+                for name in sorted(os.listdir(pack_dir)):
+                    if name.endswith('.pack') and os.path.exists(os.path.join(pack_dir, name[:-len('.pack')] + '.idx')):
+                        opened.append(Pack(os.path.join(pack_dir, name)))
+            _packs[root] = opened
+        return _packs[root]
+
+def close_packs():
+    """Unmap every open pack of the repository so the next lookup sees the current pack directory."""
+    with _packs_lock:
+        for pack in _packs.pop(REPOSITORY_ROOT.get(), []):
+            pack.close()
+
+def find_packed(object_hash):
+    """Return (pack, offset) for a packed object, or (None, None)."""
+    for pack in packs():
+        offset = pack.find(object_hash)
+        if offset is not None:
+            return pack, offset
+    return None, None
+
+def loose_object_hashes():
+    """Return the ids of every loose object in the fan-out layout."""
+    object_hashes = []
+    objects_dir = repo_path('.myvcs/objects')
+    for fanout in os.listdir(objects_dir):
+        fanout_dir = os.path.join(objects_dir, fanout)
+        if len(fanout) == 2 and os.path.isdir(fanout_dir):
+            object_hashes.extend(fanout + name for name in os.listdir(fanout_dir))
+    return object_hashes
+
+def object_names():
+    """Map blob ids to the last path component they appear under in any tree, for delta grouping."""
+    names = {}
+    for object_hash in loose_object_hashes() + [pack.object_id(i) for pack in packs() for i in range(pack.count)]:
+        if object_info(object_hash)[0] == 'tree':
+            for name, (kind, entry_hash) in read_tree(object_hash).entries.items():
+                if kind == 'blob':
+                    names.setdefault(entry_hash, os.path.basename(name))
+    return names
+
+def repack(window=DELTA_WINDOW, depth=MAX_DELTA_DEPTH, keep=None):
+    """
+    Write every loose and packed object into one new pack, delta-encoding similar objects.
+
+    Returns (objects packed, objects stored as deltas). With keep (a container of raw object ids) only those objects are packed; packed objects
+    outside it are dropped with their old packs and loose ones are left where they are.
+    """
+    objects_dir = repo_path('.myvcs/objects')
+    if depth > MAX_DELTA_DEPTH:
+        raise ValueError(f"The delta depth cannot be larger than {MAX_DELTA_DEPTH}.")
+    if any(len(name) == 40 for name in os.listdir(objects_dir)):
+        raise ValueError("The repository still has objects in the old layout. Run 'migrate-objects' first.")
+
+    object_hashes = sorted(set(loose_object_hashes()) | {pack.object_id(i) for pack in packs() for i in range(pack.count)})
+    if keep is not None:
+        object_hashes = [object_hash for object_hash in object_hashes if bytes.fromhex(object_hash) in keep]
+    if not object_hashes:
+        return 0, 0
+
+    # Like git, try deltas between objects of the same type and file name, largest first,
+    # so the newest (usually biggest) version of a file is stored whole
+    names = object_names()
+    candidates = []
+    for object_hash in object_hashes:
+        obj_type, size = object_info(object_hash)
+        candidates.append((obj_type, names.get(object_hash, ''), -size, object_hash))
+    candidates.sort()
+
+    pack_dir = repo_path(PACK_DIR)
+    os.makedirs(pack_dir, exist_ok=True)
+    fd, tmp_pack_path = tempfile.mkstemp(prefix='tmp_pack_', dir=pack_dir)
+    offsets = {}
+    # (hash, type, content, chain depth) of the objects recently written, tried as delta bases
+    recent = []
+    deltas = 0
+    pack_hasher = hashlib.sha1()
+    try:
+        with os.fdopen(fd, 'wb') as pack_file:
+            def write(data):
+                pack_hasher.update(data)
+                pack_file.write(data)
+
+            write(PACK_SIGNATURE + struct.pack('>II', PACK_VERSION, len(candidates)))
+            for obj_type, _, negative_size, object_hash in candidates:
+                offset = pack_file.tell()
+                offsets[object_hash] = offset
+                if -negative_size > DELTA_SIZE_LIMIT:
+                    # Too big to delta, stream it into the pack without holding it in memory
+                    _, chunks = iter_object(object_hash)
+                    compressor = zlib.compressobj(compression_level())
+                    fd_body, tmp_body = tempfile.mkstemp(prefix='tmp_pack_', dir=pack_dir)
+                    with os.fdopen(fd_body, 'w+b') as body:
+                        for chunk in chunks:
+                            body.write(compressor.compress(chunk))
+                        body.write(compressor.flush())
+                        compressed_length = body.tell()
+                        body.seek(0)
+                        write(bytes([PACK_TYPE_CODES[obj_type]]) + encode_varint(-negative_size) + encode_varint(compressed_length))
+                        for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+                            write(chunk)
+                    os.remove(tmp_body)
+                    continue
+
+                content = read_object(object_hash)
+                best = None
+                for base_hash, base_type, base_content, base_depth in recent:
+                    if base_type != obj_type or base_depth >= depth:
+                        continue
+                    delta = create_delta(base_content, content)
+                    # Only worth it when the delta is well below the object it replaces
+                    if len(delta) < len(content) // 2 and (best is None or len(delta) < len(best[1])):
+                        best = (base_hash, delta, base_depth + 1)
+
+                if best is None:
+                    compressed = zlib.compress(content, compression_level())
+                    write(bytes([PACK_TYPE_CODES[obj_type]]) + encode_varint(len(content)) + encode_varint(len(compressed)) + compressed)
+                    chain_depth = 0
+                else:
+                    base_hash, delta, chain_depth = best
+                    compressed = zlib.compress(delta, compression_level())
+                    write(bytes([PACK_DELTA]) + encode_varint(len(delta)) + encode_varint(len(compressed))
+                          + encode_varint(offset - offsets[base_hash]) + compressed)
+                    deltas += 1
+                recent.append((object_hash, obj_type, content, chain_depth))
+                if len(recent) > window:
+                    recent.pop(0)
+            pack_checksum = pack_hasher.digest()
+            pack_file.write(pack_checksum)
+
+        pack_name = 'pack-' + hash_bytes(''.join(object_hashes).encode())
+        pack_path = os.path.join(pack_dir, pack_name + '.pack')
+        index_path = os.path.join(pack_dir, pack_name + '.idx')
+
+        # Index: fan-out counts, then sorted ids, then their offsets
+        fanout = [0] * 256
+        for object_hash in object_hashes:
+            fanout[int(object_hash[:2], 16)] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        tmp_index_path = tmp_pack_path + '.idx'
+        with open(tmp_index_path, 'wb') as index_file:
+            index_file.write(PACK_INDEX_SIGNATURE + struct.pack('>IIB', PACK_INDEX_VERSION, len(object_hashes), id_size()))
+            index_file.write(struct.pack('>256I', *fanout))
+            for object_hash in object_hashes:
+                index_file.write(bytes.fromhex(object_hash))
+            for object_hash in object_hashes:
+                index_file.write(struct.pack('>Q', offsets[object_hash]))
+            index_file.write(pack_checksum)
+
+        old_packs = [pack.pack_path for pack in packs()]
+        close_packs()
+        # The pack goes in before its index so readers never find an index without data
+        os.replace(tmp_pack_path, pack_path)
+        os.replace(tmp_index_path, index_path)
+        # The loose copies and old packs are deleted below, the new pack has to be on disk first
+        if fsync_mode() == 'batch':
+            sync_paths([pack_path, index_path])
+    except BaseException:
+        for path in (tmp_pack_path, tmp_pack_path + '.idx'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    # Everything is now reachable through the new pack, drop the loose copies and old packs
+    for old_pack in old_packs:
+        if old_pack != pack_path:
+            os.remove(old_pack)
+            os.remove(old_pack[:-len('.pack')] + '.idx')
+    for object_hash in loose_object_hashes():
+        if object_hash in offsets:
+            os.remove(object_path(object_hash))
+    for fanout_dir in os.listdir(objects_dir):
+        path = os.path.join(objects_dir, fanout_dir)
+        if len(fanout_dir) == 2 and os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+    return len(object_hashes), deltas
+
+def print_repack_result(packed):
+    """Print the (objects, deltas) returned by repack, as 'repack' does."""
+    objects, deltas = packed
+    if not objects:
+        print('No objects to pack.')
+    else:
+        print(f'Packed {objects} object(s), {deltas} stored as deltas.')
+
+def migrate_objects():
+    """Convert every object in the old flat layout to the compressed fan-out layout and return how many there were."""
+    objects_dir = repo_path('.myvcs/objects')
+    legacy_hashes = [name for name in os.listdir(objects_dir)
+                     if len(name) == 40 and os.path.isfile(os.path.join(objects_dir, name))]
+    if not legacy_hashes:
+        return 0
+
+    # Flat objects have no header, so recover their types by walking the history from every ref;
+    # anything unreachable can only be a staged blob
+    types = {}
+    pending = ref_tips()
+    while pending:
+        commit_hash = pending.pop()
+        if commit_hash in types or not object_exists(commit_hash):
+            continue
+        types[commit_hash] = 'commit'
+        commit = read_commit(commit_hash)
+        tree_hashes = [commit.tree]
+        while tree_hashes:
+            tree_hash = tree_hashes.pop()
+            types[tree_hash] = 'tree'
+            for kind, entry_hash in read_tree(tree_hash).entries.values():
+                if kind == 'tree':
+                    tree_hashes.append(entry_hash)
+                else:
+                    types[entry_hash] = 'blob'
+        pending.extend(commit.parents)
+
+    # The flat copies are only removed once every converted object is on disk
+    with object_transaction():
+        for object_hash in legacy_hashes:
+            with open(legacy_object_path(object_hash), 'rb') as object_file:
+                content = object_file.read()
+            # Keep the name the object is referenced by, even if it was written with other line endings
+            write_object(types.get(object_hash, 'blob'), content, object_hash)
+    for object_hash in legacy_hashes:
+        os.remove(legacy_object_path(object_hash))
+    return len(legacy_hashes)
+        
+# =============================== Garbage collection ===============================
+# gc marks every object reachable from the branches, tags, HEAD and the index in one walk,
+# then deletes the loose objects it did not reach. Objects written less than a grace period
+# ago are kept, they may belong to an 'add' or 'commit' running at the same time.
+
+GC_GRACE_PERIOD = 14 * 24 * 60 * 60
+
+def gc_roots():
+    """Return (hash, kind) for every object gc starts marking from."""
+    roots = [(commit_hash, 'commit') for commit_hash in ref_tips()]
+    commit_hash = head_commit()
+    if commit_hash is not None:
+        roots.append((commit_hash, 'commit'))
+    # Staged blobs are not in any commit yet
+    roots.extend((blob_hash, 'blob') for blob_hash, _ in load_index(missing_ok=True).values())
+    return roots
+
+def mark_reachable():
+    """
+    Return the raw ids of every object reachable from the gc roots.
+
+    Ids are kept as raw digests rather than hex strings, and every tree shared between
+    commits is read once; of a blob only the object header is read, to find chunked ones.
+    """
+    reachable = set()
+    stack = gc_roots()
+    while stack:
+        object_hash, kind = stack.pop()
+        raw = bytes.fromhex(object_hash)
+        if raw in reachable:
+            continue
+        reachable.add(raw)
+        if kind == 'commit':
+            commit = read_commit(object_hash)
+            stack.append((commit.tree, 'tree'))
+            stack.extend((parent, 'commit') for parent in commit.parents)
+        elif kind == 'tree':
+            stack.extend((entry_hash, entry_kind) for entry_kind, entry_hash in read_tree(object_hash).entries.values())
+        elif kind == 'blob' and stored_type(object_hash) == 'chunked':
+            stack.extend((chunk_hash, 'blob') for chunk_hash, _ in read_manifest(object_hash))
+    return reachable
+
+def sweep_loose_objects(reachable, expire_before):
+    """
+    Delete the unreachable loose objects (and leftover temporary files) last modified before expire_before.
+
+    Returns (objects removed, bytes removed, bytes of reachable loose objects). The object
+    directories are streamed with scandir, so no list of every object is built.
+    """
+    objects_dir = repo_path('.myvcs/objects')
+    removed = removed_bytes = reachable_bytes = 0
+    for entry in os.scandir(objects_dir):
+        if len(entry.name) == 2 and entry.is_dir():
+            object_entries = ((entry.name + object_entry.name, object_entry) for object_entry in os.scandir(entry.path))
+        elif len(entry.name) == 40 and entry.is_file():
+            # Old flat layout
+            object_entries = [(entry.name, entry)]
+        elif entry.name.startswith('tmp_') and entry.is_file():
+            # Left behind by an interrupted write
+            st = entry.stat()
+            if st.st_mtime < expire_before:
+                os.remove(entry.path)
+                removed_bytes += st.st_size
+            continue
+        else:
+            continue
+
+        for object_hash, object_entry in object_entries:
+            if not OBJECT_ID_PATTERN.fullmatch(object_hash):
+                continue
+            st = object_entry.stat()
+            if bytes.fromhex(object_hash) in reachable:
+                reachable_bytes += st.st_size
+            elif st.st_mtime < expire_before:
+                os.remove(object_entry.path)
+                removed += 1
+                removed_bytes += st.st_size
+        if entry.is_dir() and not os.listdir(entry.path):
+            os.rmdir(entry.path)
+    return removed, removed_bytes, reachable_bytes
+
+def pack_bytes():
+    """Return the total size of the pack files."""
+    pack_dir = repo_path(PACK_DIR)
+    if not os.path.isdir(pack_dir):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(pack_dir) if entry.name.startswith('pack-'))
+
+def gc(grace=GC_GRACE_PERIOD, repack_objects=False):
+    """
+    Delete unreachable objects older than grace seconds, optionally repacking the rest, and return what was reclaimed.
+
+    The dict maps 'reachable' to the number of objects marked, 'removed' and 'removed_bytes'
+    to what was deleted, 'packed' to the result of repack (None without repacking), and
+    'mark_seconds' and 'seconds' to the time the marking and the whole run took.
+    """
+    start = time.perf_counter()
+    reachable = mark_reachable()
+    marked = time.perf_counter()
+    removed, removed_bytes, reachable_bytes = sweep_loose_objects(reachable, time.time() - grace)
+    OBJECT_CACHE.clear()
+
+    packed = None
+    if repack_objects:
+        # Unreachable objects inside packs have no age of their own, they go with the old packs
+        removed += sum(1 for pack in packs() for i in range(pack.count) if bytes.fromhex(pack.object_id(i)) not in reachable)
+        bytes_before = pack_bytes() + reachable_bytes
+        packed = repack(keep=reachable)
+        removed_bytes += max(0, bytes_before - pack_bytes())
+
+    if os.path.exists(repo_path(COMMIT_GRAPH_PATH)):
+        # Drop the rows of commits that no longer exist
+        write_commit_graph()
+    return {'reachable': len(reachable), 'removed': removed, 'removed_bytes': removed_bytes, 'packed': packed,
+            'mark_seconds': marked - start, 'seconds': time.perf_counter() - start}
+
+def print_gc_result(result):
+    """Print the dict returned by gc, as 'gc' does."""
+    if result['packed'] is not None:
+        print_repack_result(result['packed'])
+    print(f"Marked {result['reachable']} reachable object(s) in {result['mark_seconds']:.2f}s.")
+    print(f"Removed {result['removed']} unreachable object(s), reclaimed {result['removed_bytes'] / 1024:.1f} KB "
+          f"in {result['seconds']:.2f}s.")
+
+def object_children(object_hash, kind):
+    """Return (hash, kind) for the objects an object points to, as 'gc' follows them."""
+    if kind == 'commit':
+        commit = read_commit(object_hash)
+        return [(commit.tree, 'tree')] + [(parent, 'commit') for parent in commit.parents]
+    if kind == 'tree':
+        return [(entry_hash, entry_kind) for entry_kind, entry_hash in read_tree(object_hash).entries.values()]
+    if stored_type(object_hash) == 'chunked':
+        return [(chunk_hash, 'blob') for chunk_hash, _ in read_manifest(object_hash)]
+    return []
+
+def convert_object(object_hash, kind, new_ids, algorithm):
+    """Store an object under the algorithm's id, with the ids it points to taken from new_ids; return its new id."""
+    obj_type, size = object_info(object_hash)
+    if kind == 'commit':
+        lines = read_object(object_hash, 'commit').decode().split('\n')
+        for i, line in enumerate(lines):
+            words = line.split()
+            if words and words[0] == 'message':
+                break
+            if len(words) == 2 and words[0] in ('tree', 'parent'):
+                lines[i] = line.replace(words[1], new_ids[words[1]])
+        content = '\n'.join(lines).encode()
+    elif kind == 'tree':
+        lines = []
+        for line in read_object(object_hash, 'tree').decode().splitlines():
+            line_data = line.strip().split(' ', 2)
+            if len(line_data) == 3 and line_data[0] in ('blob', 'tree'):
+                line_data[1] = new_ids[line_data[1]]
+            elif len(line_data) >= 2:
+                # Old flat trees have "<hash> <path>" lines
+                line_data = line.strip().split(' ', 1)
+                line_data[0] = new_ids[line_data[0]]
+            else:
+                continue
+            lines.append(' '.join(line_data) + '\n')
+        content = ''.join(lines).encode()
+    elif obj_type == 'chunked':
+        manifest = ''.join(f"{new_ids[chunk_hash]} {chunk_size}\n" for chunk_hash, chunk_size in read_manifest(object_hash))
+        # A chunked blob keeps the id of its whole content
+        hasher = new_hasher(algorithm)
+        for chunk in iter_blob(object_hash):
+            hasher.update(chunk)
+        new_id = hasher.hexdigest()
+        write_object('chunked', manifest, new_id)
+        return new_id
+    else:
+        _, chunks = iter_object(object_hash)
+        return store_stream('blob', size, chunks, algorithm)[0]
+    new_id = hash_bytes(content, algorithm)
+    write_object(obj_type, content, new_id)
+    return new_id
+
+def convert_hash(algorithm):
+    """
+    Rewrite the repository with object ids made by another hash and return (objects converted, repack result).
+
+    Every object reachable from a branch, a tag, HEAD or the index is stored again, children
+    first: blobs and chunks keep their content, while manifests, trees and commits get the new
+    ids of what they point to. The new objects are made durable before the refs, the index and
+    the config switch over; only then are the old loose objects and the packs deleted, so an
+    interrupted conversion loses nothing. Unreachable objects are deleted, not converted. The
+    repack result is that of repacking the converted objects when there were packs, else None.
+    """
+    current = hash_algorithm()
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm '{algorithm}', expected one of: {', '.join(HASH_ALGORITHMS)}.")
+    if algorithm == current:
+        raise ValueError(f"The repository already uses {algorithm}.")
+    if any(len(name) == 40 for name in os.listdir(repo_path('.myvcs/objects'))):
+        raise ValueError("The repository still has objects in the old layout. Run 'migrate-objects' first.")
+
+    new_ids = {}
+    with object_transaction():
+        for root_hash, root_kind in gc_roots():
+            # Iterative post-order walk, an object is converted once everything it points to is
+            stack = [(root_hash, root_kind, False)]
+            while stack:
+                object_hash, kind, children_done = stack.pop()
+                if object_hash in new_ids:
+                    continue
+                if children_done:
+                    new_ids[object_hash] = convert_object(object_hash, kind, new_ids, algorithm)
+                    continue
+                stack.append((object_hash, kind, True))
+                stack.extend((child, child_kind, False) for child, child_kind in object_children(object_hash, kind)
+                             if child not in new_ids)
+
+    if os.path.exists(repo_path(PACKED_REFS_PATH)):
+        with LockFile(PACKED_REFS_PATH) as packed_lock:
+            # A packed line overridden by a loose ref may point to a commit nothing reaches any more
+            refs = {name: read_ref(name) for name, _ in PackedRefs().items()}
+            write_packed_refs(packed_lock, {name: new_ids[ref_hash] for name, ref_hash in refs.items() if ref_hash})
+    for prefix in (BRANCH_PREFIX, TAG_PREFIX):
+        ref_dir = ref_file(prefix)
+        if os.path.isdir(repo_path(ref_dir)):
+            for name in os.listdir(repo_path(ref_dir)):
+                ref_hash = read_ref(prefix + name) if not name.endswith(LOCK_SUFFIX) else None
+                # A branch without commits stays empty
+                if ref_hash:
+                    write_ref(prefix + name, new_ids[ref_hash])
+    index_data = load_index(missing_ok=True)
+    if index_data:
+        write_index({path: [new_ids[entry_hash], stat_data] for path, (entry_hash, stat_data) in index_data.items()}, durable=True)
+    set_config('hash', algorithm)
+
+    # Everything now points at the new objects
+    old_packs = [pack.pack_path for pack in packs()]
+    close_packs()
+    for pack_path in old_packs:
+        os.remove(pack_path)
+        os.remove(pack_path[:-len('.pack')] + '.idx')
+    new_objects = set(new_ids.values())
+    for object_hash in loose_object_hashes():
+        if object_hash not in new_objects:
+            os.remove(object_path(object_hash))
+    OBJECT_CACHE.clear()
+    packed = repack() if old_packs else None
+    if os.path.exists(repo_path(COMMIT_GRAPH_PATH)):
+        write_commit_graph()
+    return len(new_ids), packed
+
+def initialize_vcs(author_name, author_email, level=None, fsync=None, chunk_size_threshold=None, algorithm=None):
+    """Initialize the version control system by creating necessary directories and files."""
+    try:
+        # Objects already stored keep their ids, re-running init cannot change the hash
+        if os.path.exists(repo_path('.myvcs/config')):
+            current = hash_algorithm()
+            if algorithm is not None and algorithm != current:
+                print(f"The repository uses {current}, run 'convert-hash {algorithm}' to change it.")
+            algorithm = current
+        # Check if .myvcs/ already exists
+        if not os.path.exists(repo_path('.myvcs')):
+            # If not, create the directory structure
+            os.makedirs(repo_path('.myvcs/objects'), exist_ok=True)
+            os.makedirs(repo_path('.myvcs/refs'), exist_ok=True)
+            os.makedirs(repo_path('.myvcs/refs/branches'))
+            with open(repo_path('.myvcs/HEAD'), 'w') as head_file:
+                # Create the HEAD file with default branch
+                head_file.write('refs/branches/main\n')
+        else:
+            # In case the directory exists, we can check if the necessary subdirectories and files exist and create them if they don't
+            os.makedirs(repo_path('.myvcs/objects'), exist_ok=True)
+            os.makedirs(repo_path('.myvcs/refs'), exist_ok=True)
+            if not os.path.exists(repo_path('.myvcs/HEAD')):
+                with open(repo_path('.myvcs/HEAD'), 'w') as head_file:
+                    # Create the HEAD file with default branch
+                    head_file.write('refs/branches/main\n')
+        with open(repo_path('.myvcs/config'), 'w') as config_file:
+            # Create the config file with author information
+            config_file.write(f"author_name={author_name}\n")
+            config_file.write(f"author_email={author_email}\n")
+            if level is not None:
+                config_file.write(f"compression_level={level}\n")
+            if fsync is not None:
+                config_file.write(f"fsync={fsync}\n")
+            if chunk_size_threshold is not None:
+                config_file.write(f"chunk_threshold={chunk_size_threshold}\n")
+            config_file.write(f"hash={algorithm or DEFAULT_HASH}\n")
+    except PermissionError:
+        print("Error: Permission denied. Please run this script with appropriate permissions.")
+    except OSError as e:
+        print(f"Error: {e.strerror}. Please check your file system.")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+    
+def author_info():
+    config = read_config()
+    author_name = config['author_name']
+    author_email = config['author_email']
+    
+    return author_name, author_email
+
+def write_commit(tree_hash, parents, message):
+    """Write a commit object for tree_hash with the given parent commits and return its hash."""
+    aurhor_name, author_email = author_info()
+    
+    timestamp = int(time.time())
+    if not parents:
+        commit_content = f"""
+                tree {tree_hash}
+                author {aurhor_name} <{author_email}> 
+                timestamp {timestamp}
+                message {message}
+            """
+    else:
+        # Commit content with the previous commits' hashes, a merge commit has two
+        parent_lines = "".join(f"            parent {parent}\n" for parent in parents)
+        commit_content = f"""
+            tree {tree_hash}
+{parent_lines}            author {aurhor_name} <{author_email}> 
+            timestamp {timestamp}
+            message {message}
+        """
+    return write_object('commit', commit_content)
+
+def commit_index(message):
+    """Commit the index on the branch HEAD points to and return the new commit's hash."""
+    staged_files = load_index()
+    parent_hash = head_commit()
+    parent_tree_hash = read_commit(parent_hash).tree if parent_hash is not None else None
+    parent_tree = tree_files(parent_tree_hash)
+    sparse = sparse_cone()
+
+    # The index keeps every tracked file (with its cached stat data) after a commit, so the new
+    # tree is the parent's tree with the staged changes laid over it. Everything that moves HEAD
+    # or rewrites the worktree keeps the index equal to HEAD's tree plus what was staged since
+    # (see sync_index), so an entry differing from the parent was staged on purpose, and a
+    # path of the cone that left the index was deleted with 'add'
+    changes = {path: hashed_content for path, (hashed_content, _) in staged_files.items()
+               if parent_tree.get(path) != hashed_content}
+    changes.update((path, None) for path in parent_tree
+                   if path not in staged_files and (sparse is None or sparse.contains(path)))
+
+    if not changes:
+        raise ValueError("No files staged for commit.")
+    
+    with object_transaction():
+        # Save the trees to the objects directory so we can know what has been modified in the commit;
+        # only the directories on the way to a changed file get new tree objects
+        tree_hash = update_tree(parent_tree_hash, changes)
+
+        # Create the commit object   
+        commit_hash = write_commit(tree_hash, [parent_hash] if parent_hash is not None else [], message)
+    # The ref is only moved once the new trees and the commit are on disk, also inside a batch
+    sync_pending_objects()
+        
+    # Update the branch HEAD points to with the new commit
+    write_ref(head_ref_name(), commit_hash)
+    update_commit_graph(commit_hash)
+    return commit_hash
+
+def commit_tree_hash(commit_hash):
+    """Return the tree of a commit, None for no commit."""
+    return read_commit(commit_hash).tree if commit_hash else None
+
+def sync_index(old_commit, new_commit):
+    """
+    Move the index from old_commit to new_commit after HEAD moved between them; the worktree is left alone.
+
+    Entries staged on top of old_commit (those differing from its tree) and deletions are kept; every other
+    path takes its hash from new_commit, with the cached stat data kept only where the hash
+    does not change, so files differing from the new tree show up as modified.
+    """
+    if old_commit == new_commit:
+        return
+    sparse = sparse_cone()
+    old_files = tree_files(commit_tree_hash(old_commit), sparse=sparse)
+    new_files = tree_files(commit_tree_hash(new_commit), sparse=sparse)
+    index_data = load_index(missing_ok=True)
+    staged = {path: entry for path, entry in index_data.items() if old_files.get(path) != entry[0]}
+    new_index = {}
+    for path, file_hash in new_files.items():
+        entry = index_data.get(path)
+        new_index[path] = [file_hash, entry[1] if entry is not None and entry[0] == file_hash else None]
+    new_index.update(staged)
+    # Staged deletions stay staged
+    for path in old_files.keys() - index_data.keys():
+        new_index.pop(path, None)
+    write_index(new_index)
+
+def create_commit(message):
+    commit_hash = commit_index(message)
+    print(f"Commit created with hash: {commit_hash}")
+    
+    return commit_hash
+
+# ============================ Ignore rules and walking ============================
+# .myvcsignore files follow gitignore rules: globs with '*', '?' and '[...]', '**' across
+# directories, '!' to re-include, a trailing '/' for directories only, and patterns containing
+# a '/' anchored to the directory of the ignore file. Ignore files in subdirectories apply
+# below them and take precedence over the ones above. Ignored directories are never entered.
+
+IGNORE_FILE = '.myvcsignore'
+# Always left out of the worktree, whatever the ignore files say
+DEFAULT_IGNORES = frozenset(['.myvcs', '.git', 'myvcs.py', IGNORE_FILE, '.vscode'])
+
+def glob_to_regex(pattern):
+    """Translate one gitignore glob into a regular expression matching whole relative paths."""
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            # Zero or more directories
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex.append('[' + body.replace('\\', '\\\\') + ']')
+            i = end + 1
+            continue
+        elif char == '\\' and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return ''.join(regex)
+
+def compile_ignore_patterns(lines):
+    """
+    Compile gitignore-style lines into a list of (regex, negate, dir_only) groups, in file order.
+
+    Consecutive patterns with the same flags are merged into one alternation, so a typical
+    ignore file turns into a single regular expression.
+    """
+    groups = []
+    for line in lines:
+        line = line.rstrip('\n').rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+        # A slash at the start or in the middle anchors the pattern to the ignore file's directory
+        anchored = '/' in line
+        regex = glob_to_regex(line.lstrip('/'))
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        if groups and groups[-1][1] == negate and groups[-1][2] == dir_only:
+            groups[-1][0].append(regex)
+        else:
+            groups.append([[regex], negate, dir_only])
+    return [(re.compile('|'.join(f'(?:{regex})' for regex in regexes)), negate, dir_only)
+            for regexes, negate, dir_only in groups]
+
+def read_ignore_file(path):
+    """Return the compiled patterns of an ignore file, or None if it does not exist."""
+    if not os.path.isfile(repo_path(path)):
+        return None
+    with open(repo_path(path), 'r') as ignore_file:
+        return compile_ignore_patterns(ignore_file)
+
+def is_ignored(path, is_dir, matchers):
+    """
+    Return True if the ignore rules exclude path (relative to the repository root).
+
+    matchers is a list of (directory prefix, compiled patterns), shallowest first; the deepest
+    ignore file and, within a file, the last matching pattern decides.
+    """
+    for prefix, groups in reversed(matchers):
+        relative = path[len(prefix):]
+        for regex, negate, dir_only in reversed(groups):
+            if dir_only and not is_dir:
+                continue
+            if regex.fullmatch(relative):
+                return not negate
+    return False
+
+def ignore_matchers(dir_prefix):
+    """Return the matchers of every ignore file from the repository root down to dir_prefix ('' or 'a/b/')."""
+    matchers = []
+    ancestor = ''
+    for part in dir_prefix.split('/'):
+        groups = read_ignore_file(ancestor + IGNORE_FILE)
+        if groups:
+            matchers.append((ancestor, groups))
+        if not part:
+            break
+        ancestor += part + '/'
+    return matchers
+
+def iter_worktree(root_dir=".", ignore_list=None, directories=False, sparse=None):
+    """
+    Yield (path relative to root_dir, DirEntry) for every file under root_dir that is not ignored.
+
+    The walk uses os.scandir so callers can reuse the DirEntry's cached stat results, and it
+    does not descend into ignored directories at all. ignore_list holds extra patterns that
+    apply from the repository root with the lowest precedence. With directories, the
+    directories that are walked are yielded too, before their contents. With a SparseCone,
+    the directories outside it are not entered either.
+    """
+    root_prefix = os.path.relpath(root_dir).replace(os.sep, '/')
+    root_prefix = '' if root_prefix == '.' else root_prefix + '/'
+
+    matchers = []
+    if ignore_list:
+        matchers.append(('', compile_ignore_patterns(ignore_list)))
+    # The ignore files of the directories above root_dir apply to it as well
+    if root_prefix:
+        parent = root_prefix[:-1].rpartition('/')[0]
+        matchers += ignore_matchers(parent + '/' if parent else '')
+
+    stack = [(repo_path(root_dir), root_prefix, '', matchers)]
+    while stack:
+        dir_path, repo_prefix, out_prefix, matchers = stack.pop()
+        with os.scandir(dir_path) as scan:
+            entries = list(scan)
+        if any(entry.name == IGNORE_FILE for entry in entries):
+            groups = read_ignore_file(os.path.join(dir_path, IGNORE_FILE))
+            if groups:
+                matchers = matchers + [(repo_prefix, groups)]
+
+        for entry in entries:
+            if entry.name in DEFAULT_IGNORES:
+                continue
+            is_dir = entry.is_dir()
+            # Like os.walk, symlinks to directories are not followed
+            if is_dir and entry.is_symlink():
+                continue
+            if matchers and is_ignored(repo_prefix + entry.name, is_dir, matchers):
+                continue
+            if sparse is not None and not (sparse.enters if is_dir else sparse.contains)(repo_prefix + entry.name):
+                continue
+            if is_dir:
+                if directories:
+                    yield out_prefix + entry.name, entry
+                stack.append((entry.path, repo_prefix + entry.name + '/', out_prefix + entry.name + '/', matchers))
+            else:
+                yield out_prefix + entry.name, entry
+
+def list_all_files(root_dir=".", ignore_list=None):
+    """
+    Return a list of *relative* file paths for everything under root_dir,
+    excluding anything matched by the .myvcsignore files or by ignore_list.
+    
+    ignore_list: extra gitignore-style patterns to ignore (e.g. ['temp.txt', 'build/'])
+    """
+    return [path for path, _ in iter_worktree(root_dir, ignore_list)]
+
+def classify_file(a_file, stat_data, tree_files, staged, index_mtime_ns, algorithm=None):
+    """
+    Return (state, refreshed entry) for one worktree file.
+
+    state is 'modified', 'unmodified', 'new' or 'untracked'. The refreshed entry is the
+    [hash, stat_data] pair to cache in the index when the file had to be hashed and still
+    matches what the index records, otherwise None.
+    """
+    if a_file in tree_files:
+        entry = staged.get(a_file)
+        refreshed = None
+        if entry is not None and stat_matches(entry[1], a_file, index_mtime_ns, stat_data):
+            # Stat data unchanged since the file was hashed, the cached hash is still valid
+            current_hash = entry[0]
+        else:
+            current_hash = hash_file(a_file, algorithm)
+            # Refresh the cached stat data when the file still matches what the index records
+            expected_hash = entry[0] if entry is not None else tree_files[a_file]
+            if current_hash == expected_hash:
+                refreshed = [current_hash, stat_data]
+        if tree_files[a_file] != current_hash:
+            return 'modified', refreshed
+        return 'unmodified', refreshed
+    elif a_file in staged:
+        return 'new', None
+    return 'untracked', None
+
+def scan_status():
+    """Walk the worktree (the sparse cone of it) and return a [path, state] pair for every file."""
+    sparse = sparse_cone()
+    tree_files = head_tree(sparse)
+
+    index_path = repo_path(INDEX_PATH)
+    staged = load_index(missing_ok=True)
+    index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+    refreshed = False
+    algorithm = hash_algorithm()
+        
+    status = []
+    for a_file, dir_entry in iter_worktree(sparse=sparse):
+        # The walk already has the stat result, no need to stat the file again
+        stat_data = file_stat_data(a_file, dir_entry.stat())
+        state, entry = classify_file(a_file, stat_data, tree_files, staged, index_mtime_ns, algorithm)
+        if entry is not None:
+            staged[a_file] = entry
+            refreshed = True
+        status.append([a_file, state])
+
+    if refreshed:
+        write_index(staged)
+    return status
+
+def status_sections():
+    """Return a dict mapping each status state to the list of files in it."""
+    # A running 'watch' daemon already knows the answer, otherwise scan the worktree
+    status = query_watch_daemon()
+    if status is None:
+        status = scan_status()
+    sections = {state: [] for state in STATUS_STATES}
+    for path, state in status:
+        sections[state].append(path)
+    return sections
+
+def status_check(log_status=True):
+    # =============================== Print out Status  ==============================
+    # modified, unmodified, new, untracked
+    sections = status_sections()
+
+    if log_status == True:
+        print_status(sections)
+    else:
+        return [sections[state] for state in STATUS_STATES]
+
+def print_status(sections):
+    """Print the sections returned by status_sections, as 'status' does."""
+    print("Status:")
+    print("modified:\n", end="     ")
+    for file in sections['modified']:
+        print(file, end="\n")
+    print()
+    print("unmodified:\n", end="     ")
+    for file in sections['unmodified']:
+        print(file, end="\n")
+    print()
+    print("new:\n", end="     ")
+    for file in sections['new']:
+        print(file, end="\n")
+    print()
+    print("untracked:\n", end="     ")
+    for file in sections['untracked']:
+        print(file, end="\n")
+
+# ================================= Watch daemon =================================
+# 'watch' runs a daemon that watches every non-ignored directory with Linux inotify, keeps the
+# status of each worktree file in memory and only re-examines the paths events were reported
+# for. Like a scan, it only watches the sparse cone, and a change of the cone in the config
+# makes it start over. status_check asks it over the Unix socket below and scans the worktree itself when no
+# daemon answers.
+
+WATCH_SOCKET_PATH = '.myvcs/watch.sock'
+# Seconds status waits for the daemon before falling back to a full scan
+WATCH_TIMEOUT = 5
+STATUS_STATES = ('modified', 'unmodified', 'new', 'untracked')
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class Inotify:
+    """A non-blocking inotify instance, called through ctypes."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask=WATCH_EVENTS):
+        """Watch a directory and return its watch descriptor."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def remove_watch(self, wd):
+        """Stop watching a descriptor (errors for already removed watches are ignored)."""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Return the queued (wd, mask, name) events without blocking."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+                pos += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        """Close the inotify descriptor, dropping every watch."""
+        os.close(self.fd)
+
+class WatchDaemon:
+    """The in-memory status of the worktree, kept current from inotify events."""
+
+    def __init__(self):
+        self.inotify = Inotify()
+        self.directories = {}
+        self.repository_watches = set()
+        self.status = {}
+        self.dirty = set()
+        self.response = None
+        self.full_rescan()
+
+    def load_repository_state(self):
+        """Read the sparse cone, the HEAD tree and the index that files are classified against."""
+        self.sparse = sparse_cone()
+        self.algorithm = hash_algorithm()
+        self.tree_files = head_tree(self.sparse)
+        index_path = repo_path(INDEX_PATH)
+        self.staged = load_index(missing_ok=True)
+        self.index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+        self.repository_changed = False
+
+    def full_rescan(self):
+        """Drop everything and watch and classify the whole worktree again."""
+        for wd in list(self.directories) + list(self.repository_watches):
+            self.inotify.remove_watch(wd)
+        self.directories = {}
+        self.repository_watches = set()
+        self.status = {}
+        self.dirty = set()
+        self.matchers = {}
+        self.needs_rescan = False
+        self.load_repository_state()
+        # HEAD, the index and the refs decide what every file is compared with
+        self.vcs_watch = self.inotify.add_watch(repo_path('.myvcs'))
+        self.repository_watches.add(self.vcs_watch)
+        for path in ('.myvcs/refs/branches', '.myvcs/refs/tags'):
+            if os.path.isdir(repo_path(path)):
+                self.repository_watches.add(self.inotify.add_watch(repo_path(path)))
+        self.add_directory('.', '')
+
+    def add_directory(self, dir_path, prefix):
+        """Watch a directory and everything below it, marking its files for classification."""
+        # Each directory is watched before it is scanned so no file created meanwhile is missed
+        self.directories[self.inotify.add_watch(repo_path(dir_path))] = prefix
+        for path, entry in iter_worktree(dir_path, directories=True, sparse=self.sparse):
+            if entry.is_dir():
+                self.directories[self.inotify.add_watch(entry.path)] = prefix + path + '/'
+            else:
+                self.dirty.add(prefix + path)
+        self.response = None
+
+    def is_path_ignored(self, path):
+        """Return True if a file reported by an event is excluded by the ignore rules."""
+        dir_prefix, _, name = path.rpartition('/')
+        dir_prefix = dir_prefix + '/' if dir_prefix else ''
+        if name in DEFAULT_IGNORES:
+            return True
+        if dir_prefix not in self.matchers:
+            self.matchers[dir_prefix] = ignore_matchers(dir_prefix)
+        return is_ignored(path, False, self.matchers[dir_prefix])
+
+    def process_events(self):
+        """Turn the queued inotify events into dirty paths."""
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.needs_rescan = True
+                continue
+            if wd in self.repository_watches:
+                if wd != self.vcs_watch or name in ('HEAD', 'index', 'packed-refs', 'config'):
+                    self.repository_changed = True
+                continue
+            prefix = self.directories.get(wd)
+            if prefix is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.directories[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # The parent reports deletions; a moved or deleted root needs a fresh start
+                if prefix == '':
+                    self.needs_rescan = True
+                continue
+            path = prefix + name
+            if name == IGNORE_FILE or (mask & IN_ISDIR and mask & IN_MOVED_FROM):
+                # Changed rules, or watches now registered under the wrong prefix
+                self.needs_rescan = True
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if self.sparse is not None and not self.sparse.enters(path):
+                        continue
+                    if name not in DEFAULT_IGNORES and not is_ignored(path, True, ignore_matchers(prefix)):
+                        self.add_directory(path, path + '/')
+                elif mask & IN_DELETE:
+                    for known in [known for known in self.status if known.startswith(path + '/')]:
+                        del self.status[known]
+                    self.response = None
+            elif self.sparse is None or self.sparse.contains(path):
+                self.dirty.add(path)
+
+    def sparse_directories(self):
+        """Return the directories of the cone the worktree is watched with (None for the whole tree)."""
+        return self.sparse.directories if self.sparse is not None else None
+
+    def refresh(self):
+        """Bring the status up to date with every event received so far."""
+        self.process_events()
+        if self.needs_rescan:
+            self.full_rescan()
+        elif self.repository_changed:
+            cone = self.sparse_directories()
+            self.load_repository_state()
+            if self.sparse_directories() != cone:
+                # Other directories are watched now, start over with the new cone
+                self.full_rescan()
+            else:
+                self.dirty.update(self.status)
+        if not self.dirty:
+            return
+        for path in self.dirty:
+            try:
+                st = os.stat(repo_path(path))
+            except OSError:
+                self.status.pop(path, None)
+                continue
+            if stat.S_ISDIR(st.st_mode) or self.is_path_ignored(path):
+                self.status.pop(path, None)
+                continue
+            state, entry = classify_file(path, file_stat_data(path, st), self.tree_files, self.staged, self.index_mtime_ns,
+                                         self.algorithm)
+            if entry is not None:
+                # Remember the fresh hash so the file is not hashed again on the next reload
+                self.staged[path] = entry
+            self.status[path] = state
+        self.dirty.clear()
+        self.response = None
+
+    def status_response(self):
+        """Return the encoded answer to a status query: one newline-separated list per state."""
+        if self.response is None:
+            sections = {state: [] for state in STATUS_STATES}
+            for path in sorted(self.status):
+                sections[self.status[path]].append(path)
+            self.response = b'OK\0' + '\0'.join('\n'.join(sections[state]) for state in STATUS_STATES).encode()
+        return self.response
+
+    def close(self):
+        """Release the inotify descriptor."""
+        self.inotify.close()
+
+def run_watch_daemon():
+    """Serve status queries for the current repository until stopped."""
+    if not sys.platform.startswith('linux'):
+        raise ValueError("The watch daemon needs Linux inotify.")
+    if not os.path.exists('.myvcs'):
+        raise FileNotFoundError("There is no repository here. Run 'init' first.")
+    if query_watch_daemon() is not None:
+        raise ValueError("A watch daemon is already running for this repository.")
+    if os.path.exists(WATCH_SOCKET_PATH):
+        os.remove(WATCH_SOCKET_PATH)
+
+    daemon = WatchDaemon()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(WATCH_SOCKET_PATH)
+    server.listen()
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    selector.register(daemon.inotify.fd, selectors.EVENT_READ)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Watching {os.getcwd()} ({len(daemon.directories)} directories).")
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is not server:
+                    # Keep the kernel queue short between queries
+                    daemon.process_events()
+                    continue
+                connection, _ = server.accept()
+                with connection:
+                    request = connection.recv(64).strip()
+                    if request == b'stop':
+                        connection.sendall(b'OK\0')
+                        return
+                    daemon.refresh()
+                    connection.sendall(daemon.status_response())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        selector.close()
+        server.close()
+        daemon.close()
+        if os.path.exists(WATCH_SOCKET_PATH):
+            os.remove(WATCH_SOCKET_PATH)
+        print("Watch daemon stopped.")
+
+def watch_request(request):
+    """Send a request to the watch daemon and return its answer (without the OK marker), or None."""
+    if not os.path.exists(repo_path(WATCH_SOCKET_PATH)):
+        return None
+    chunks = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(WATCH_TIMEOUT)
+            client.connect(repo_path(WATCH_SOCKET_PATH))
+            client.sendall(request + b'\n')
+            client.shutdown(socket.SHUT_WR)
+            for chunk in iter(lambda: client.recv(1024 * 1024), b''):
+                chunks.append(chunk)
+    except OSError:
+        return None
+    response = b''.join(chunks)
+    if not response.startswith(b'OK\0'):
+        return None
+    return response[3:]
+
+def query_watch_daemon():
+    """Return [path, state] pairs from a running watch daemon, or None if there is none."""
+    response = watch_request(b'status')
+    if response is None:
+        return None
+    status = []
+    for state, section in zip(STATUS_STATES, response.decode().split('\0')):
+        status.extend([path, state] for path in section.split('\n') if path)
+    return status
+
+def stop_watch_daemon():
+    """Ask the running watch daemon to exit."""
+    if watch_request(b'stop') is None:
+        print("No watch daemon is running.")
+    else:
+        print("Watch daemon stopped.")
+
+# ==================================== Server ====================================
+# 'serve' keeps one process running per repository so editors and scripts do not pay for
+# interpreter startup, imports and argument parsing on every command. A client connects to
+# the Unix socket below, sends its arguments (each followed by a NUL byte) and gets back
+# frames of (channel, length, payload): command output on the stdout and stderr channels and
+# finally the exit status. Commands run one at a time in the server process, on the same
+# code paths as the command line.
+#
+# Between commands the server keeps the parsed index, config, HEAD and refs (and, through
+# OBJECT_CACHE, parsed objects). Each cached file is dropped as soon as inotify reports a
+# change to it, whether the change was made by the server or by another process.
+
+SERVE_SOCKET_PATH = '.myvcs/serve.sock'
+SERVE_FRAME = struct.Struct('>BI')
+SERVE_STDOUT = 1
+SERVE_STDERR = 2
+SERVE_EXIT = 3
+# Directories whose files the server caches, or whose changes make its open packs stale
+SERVE_WATCHED_DIRECTORIES = ('.myvcs', '.myvcs/refs', '.myvcs/refs/branches', '.myvcs/refs/tags', '.myvcs/objects', PACK_DIR)
+# Options that change the process itself and are only honoured when running without the server
+SERVE_UNSUPPORTED_OPTIONS = ('trace', 'trace_chrome', 'profile')
+
+# The RepositoryCache of the repository the current call runs in, None when nothing is cached
+REPOSITORY_CACHE = contextvars.ContextVar('REPOSITORY_CACHE', default=None)
+
+class RepositoryCache:
+    """Parsed repository files kept by 'serve' between commands and dropped when they change."""
+
+    def __init__(self, root):
+        self.inotify = Inotify()
+        self.pid = os.getpid()
+        self.directories = {}
+        self.values = {}
+        self.packs_changed = False
+        # Files are cached under their location on disk, the watched directories are named the same way
+        self.watched = {os.path.join(root, directory) for directory in SERVE_WATCHED_DIRECTORIES}
+        self.pack_dir = os.path.join(root, PACK_DIR)
+        for directory in sorted(self.watched):
+            if os.path.isdir(directory):
+                self.directories[self.inotify.add_watch(directory)] = directory
+
+    def process_events(self):
+        """Drop the cached files that changed since the last call."""
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.values.clear()
+                self.packs_changed = True
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.directories[wd]
+                continue
+            path = os.path.join(directory, name)
+            self.values.pop(path, None)
+            if directory == self.pack_dir or path == self.pack_dir:
+                self.packs_changed = True
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and path in self.watched:
+                self.directories[self.inotify.add_watch(path)] = path
+
+    def get(self, path, read):
+        """Return the cached value of a file, reading it with read() when it is missing or stale."""
+        # Events are queued by the write itself, so draining them first never serves stale data
+        self.process_events()
+        if path not in self.values:
+            self.values[path] = read()
+        return self.values[path]
+
+    def refresh(self):
+        """Catch up with external changes before a command runs."""
+        self.process_events()
+        if self.packs_changed:
+            close_packs()
+            self.packs_changed = False
+
+    def close(self):
+        """Release the inotify descriptor."""
+        self.inotify.close()
+
+def cached_file(path, read):
+    """Return read()'s result for a repository file, kept between commands when serving."""
+    cache = REPOSITORY_CACHE.get()
+    # Worker processes forked by 'add' share the inotify descriptor and must not drain it
+    if cache is None or cache.pid != os.getpid():
+        return read()
+    return cache.get(os.path.normpath(os.path.abspath(repo_path(path))), read)
+
+class ServeStream(io.RawIOBase):
+    """A writable stream that sends everything written to it as frames of one channel."""
+
+    def __init__(self, connection, channel):
+        super().__init__()
+        self.connection = connection
+        self.channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.connection.sendall(SERVE_FRAME.pack(self.channel, len(data)) + bytes(data))
+        return len(data)
+
+def read_serve_request(connection):
+    """Read the NUL-terminated arguments a client sends."""
+    chunks = []
+    for chunk in iter(lambda: connection.recv(64 * 1024), b''):
+        chunks.append(chunk)
+    return [os.fsdecode(arg) for arg in b''.join(chunks).split(b'\0')[:-1]]
+
+def serve_command(parser, argv, connection, repository):
+    """Run one command in repository with its output sent to the client and return the exit status."""
+    streams = {}
+    for name, channel in (('stdout', SERVE_STDOUT), ('stderr', SERVE_STDERR)):
+        streams[name] = io.TextIOWrapper(io.BufferedWriter(ServeStream(connection, channel)),
+                                         encoding='utf-8', errors='surrogateescape')
+    saved = sys.stdout, sys.stderr, sys.stdin
+    sys.stdout, sys.stderr = streams['stdout'], streams['stderr']
+    # There is no terminal to answer prompts, they see end of file
+    sys.stdin = io.StringIO('')
+    status = 0
+    try:
+        args = parser.parse_args(argv)
+        if args.command in ('serve', 'watch'):
+            parser.error(f"'{args.command}' cannot run inside the server")
+        if any(getattr(args, option) for option in SERVE_UNSUPPORTED_OPTIONS):
+            parser.error("--trace, --trace-chrome and --profile need a run without the server")
+        run_command(parser, args, repository)
+    except SystemExit as exit:
+        if isinstance(exit.code, int) or exit.code is None:
+            status = exit.code or 0
+        else:
+            print(exit.code, file=sys.stderr)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            sys.stdout, sys.stderr, sys.stdin = saved
+    return status
+
+def send_exit_status(connection, status):
+    """Send the frame ending a command."""
+    payload = str(status).encode()
+    connection.sendall(SERVE_FRAME.pack(SERVE_EXIT, len(payload)) + payload)
+
+def run_server():
+    """Run commands for clients of the current repository until stopped."""
+    if not sys.platform.startswith('linux'):
+        raise ValueError("The server needs Linux inotify to notice changes made by other processes.")
+    if not os.path.exists('.myvcs'):
+        raise FileNotFoundError("There is no repository here. Run 'init' first.")
+    if serve_request(['serve', '--ping']) is not None:
+        raise ValueError("A server is already running for this repository.")
+    if os.path.exists(SERVE_SOCKET_PATH):
+        os.remove(SERVE_SOCKET_PATH)
+
+    parser = create_parser()
+    # Entering the repository for a command refreshes its caches
+    repository = Repository(os.getcwd())
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(SERVE_SOCKET_PATH)
+    server.listen()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving {os.getcwd()} on {SERVE_SOCKET_PATH}.", flush=True)
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                argv = read_serve_request(connection)
+                if argv in (['serve', '--stop'], ['serve', '--ping']):
+                    # Control requests: stop, or the check of another server starting up
+                    send_exit_status(connection, 0)
+                    if argv[1] == '--stop':
+                        return
+                    continue
+                start = time.perf_counter()
+                try:
+                    send_exit_status(connection, serve_command(parser, argv, connection, repository))
+                except OSError:
+                    # The client went away, its output has nowhere to go
+                    continue
+                print(f"{' '.join(argv[:1])}: {(time.perf_counter() - start) * 1000:.1f} ms", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        repository.close()
+        if os.path.exists(SERVE_SOCKET_PATH):
+            os.remove(SERVE_SOCKET_PATH)
+        print("Server stopped.")
+
+def serve_request(argv):
+    """Run argv on the repository's server and return (exit status, stdout, stderr), or None without a server."""
+    if not os.path.exists(SERVE_SOCKET_PATH):
+        return None
+    output = {SERVE_STDOUT: [], SERVE_STDERR: []}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(SERVE_SOCKET_PATH)
+            client.sendall(b''.join(os.fsencode(arg) + b'\0' for arg in argv))
+            client.shutdown(socket.SHUT_WR)
+            reader = client.makefile('rb')
+            while True:
+                header = reader.read(SERVE_FRAME.size)
+                if len(header) < SERVE_FRAME.size:
+                    return None
+                channel, length = SERVE_FRAME.unpack(header)
+                payload = reader.read(length)
+                if channel == SERVE_EXIT:
+                    return int(payload), b''.join(output[SERVE_STDOUT]), b''.join(output[SERVE_STDERR])
+                output[channel].append(payload)
+    except OSError:
+        return None
+
+def stop_server():
+    """Ask the running server to exit."""
+    if serve_request(['serve', '--stop']) is None:
+        print("No server is running.")
+    else:
+        print("Server stopped.")
+
+# ==================================== Checkout ====================================
+# A sparse checkout keeps only some directories of the tree in the worktree. The cone is the
+# comma-separated list of directories in the 'sparse' config key; the files inside them and
+# the files at the top level are checked out, and checkout and status never read a subtree,
+# write a file or walk a directory outside it. The index only tracks the files of the cone,
+# commits take every other path unchanged from their parent.
+#
+# Checkout writes the files on a thread pool ('checkout -j' or the checkout_threads config
+# key): decompression and file writes release the GIL, so the reads of objects, inflating
+# them and writing the files overlap. Every folder is created up front, parents first.
+
+SPARSE_CONFIG_KEY = 'sparse'
+CHECKOUT_THREADS = 8
+
+class SparseCone:
+    """The directories of a sparse checkout and the paths they let through."""
+
+    def __init__(self, directories):
+        self.directories = sorted({directory.strip('/') for directory in directories if directory.strip('/')})
+        # The directories above the cone are walked to reach it
+        self.parents = {'/'.join(parts[:i]) for parts in (directory.split('/') for directory in self.directories)
+                        for i in range(1, len(parts))}
+
+    def contains(self, path):
+        """Return True for a file path inside the cone (or at the top level)."""
+        return '/' not in path or any(path.startswith(directory + '/') for directory in self.directories)
+
+    def enters(self, directory):
+        """Return True when a directory is inside the cone or on the way to it."""
+        return directory in self.parents or any(directory == cone or directory.startswith(cone + '/') for cone in self.directories)
+
+def sparse_cone():
+    """Return the SparseCone of the repository, or None when the whole tree is checked out."""
+    directories = read_config().get(SPARSE_CONFIG_KEY)
+    return SparseCone(directories.split(',')) if directories else None
+
+def checkout_threads():
+    """Return the number of threads checkout writes files with (checkout_threads in the config)."""
+    return int(read_config().get('checkout_threads', CHECKOUT_THREADS))
+
+def write_worktree_file(path, file_hash):
+    """Write the content of a blob to a worktree path whose folder exists and return its stat data."""
+    with open(repo_path(path), 'wb') as file:
+        for chunk in iter_blob(file_hash):
+            file.write(chunk)
+    return file_stat_data(path)
+
+def create_folders(paths):
+    """Create the folders of every path in one pass, parents first and each only once."""
+    folders = set()
+    for path in paths:
+        folder = os.path.dirname(path)
+        while folder and folder not in folders:
+            folders.add(folder)
+            folder = os.path.dirname(folder)
+    for folder in sorted(folders):
+        if not os.path.isdir(repo_path(folder)):
+            os.mkdir(repo_path(folder))
+
+def remove_empty_folders(folders):
+    """Remove the folders left empty and the parents they leave empty, deepest first."""
+    for folder in sorted(folders, key=len, reverse=True):
+        while folder != '' and os.path.isdir(repo_path(folder)) and not os.listdir(repo_path(folder)):
+            os.rmdir(repo_path(folder))
+            folder = os.path.dirname(folder)
+
+def local_changes(paths):
+    """
+    Return the paths among paths whose index entry or worktree file differs from HEAD's tree.
+
+    Untracked files count as changes, as do tracked files missing from the worktree, since
+    writing the path would destroy them or bring the file back.
+    """
+    head_files = head_tree()
+    index_path = repo_path(INDEX_PATH)
+    index_data = load_index(missing_ok=True)
+    index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+    changed = []
+    for path in paths:
+        expected = head_files.get(path)
+        entry = index_data.get(path)
+        if entry is not None and entry[0] != expected:
+            changed.append(path)
+        elif not os.path.isfile(repo_path(path)):
+            if expected is not None or os.path.exists(repo_path(path)):
+                changed.append(path)
+        elif expected is None or (not (entry is not None and stat_matches(entry[1], path, index_mtime_ns))
+                                  and hash_file(path) != expected):
+            changed.append(path)
+    return changed
+
+def update_worktree(changes):
+    """
+    Apply a dict of path -> new blob hash (None to remove) to the worktree and the index.
+
+    Used when HEAD's branch moves to a commit whose tree differs from the old one by changes;
+    the caller has checked with local_changes that none of the paths would lose work.
+    """
+    if not changes:
+        return
+    index_data = load_index(missing_ok=True)
+    removed_folders = set()
+    for path, file_hash in changes.items():
+        if file_hash is None:
+            index_data.pop(path, None)
+            if os.path.exists(repo_path(path)):
+                os.remove(repo_path(path))
+                removed_folders.add(os.path.dirname(path))
+    remove_empty_folders(removed_folders)
+    written = {path: file_hash for path, file_hash in changes.items() if file_hash is not None}
+    create_folders(written)
+    for path, stat_data in write_worktree_files(written).items():
+        index_data[path] = [written[path], stat_data]
+    write_index(index_data)
+
+def write_worktree_files(files, threads=None):
+    """
+    Write the blobs of a dict of path -> hash to the worktree and return path -> stat data.
+
+    The folders must exist already (see create_folders).
+    """
+    threads = threads or checkout_threads()
+    if threads <= 1 or len(files) < 2:
+        return {path: write_worktree_file(path, file_hash) for path, file_hash in files.items()}
+    # Opened before the threads start, so they share one mapping of each pack
+    packs()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(files, executor.map(in_context(write_worktree_file), files, files.values())))
+
+def set_sparse_cone(directories):
+    """
+    Store a new sparse cone (None or no directories for the whole tree) and update the worktree.
+
+    Tracked files leaving the cone are removed, after checking none of them has local changes;
+    files of HEAD entering it are written. Returns (files removed, files written).
+    """
+    old = sparse_cone()
+    new = SparseCone(directories) if directories else None
+    index_path = repo_path(INDEX_PATH)
+    index_data = load_index(missing_ok=True)
+    index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+
+    leaving = [path for path in index_data if new is not None and not new.contains(path)]
+    modified = [path for path in leaving if os.path.exists(repo_path(path))
+                and not stat_matches(index_data[path][1], path, index_mtime_ns) and hash_file(path) != index_data[path][0]]
+    if modified:
+        raise ValueError(f"These files outside the new sparse cone have local changes: {', '.join(modified)}")
+
+    set_config(SPARSE_CONFIG_KEY, ','.join(new.directories) if new is not None else None)
+    removed_folders = set()
+    for path in leaving:
+        if os.path.exists(repo_path(path)):
+            os.remove(repo_path(path))
+            removed_folders.add(os.path.dirname(path))
+        del index_data[path]
+    remove_empty_folders(removed_folders)
+
+    entering = {path: file_hash for path, file_hash in head_tree(new).items()
+                if old is not None and not old.contains(path) and not os.path.exists(repo_path(path))}
+    create_folders(entering)
+    for path, stat_data in write_worktree_files(entering).items():
+        index_data[path] = [entering[path], stat_data]
+    write_index(index_data)
+    return len(leaving), len(entering)
+
+def confirm_checkout(sections):
+    """Ask before a checkout overwrites the modified, new and untracked files of status sections; 'no' aborts."""
+    def get_user_confirmation(message):
+        while True:
+            response = input(message).strip().lower()
+            if response == 'yes' or response == 'y':
+                break
+            elif response == 'no' or response == 'n':
+                break
+        if response == 'yes' or response == 'y':
+            print('\n')
+            pass
+        elif response == 'no' or response == 'n':
+            raise SystemExit("Checkout aborted.")
+
+    if sections['modified'] != []:
+        print(f'The following files have been modified\n')
+        for modified_file in sections['modified']:
+            print(f"{modified_file}\n")
+        message = "These files will be OVERWRITTEN. Do you want to continue? (yes/no)/(y/n): "
+        get_user_confirmation(message)
+
+    if sections['new'] != []:
+        print(f'The following files have been added\n')
+        for added_file in sections['new']:
+            print(f"{added_file}\n")
+        message = "These files in the staged area will be DELETED. Do you want to continue? (yes/no)/(y/n): "
+        get_user_confirmation(message)
+
+    if sections['untracked'] != []:
+        print(f'The following files have been untracked\n')
+        for untracked_file in sections['untracked']:
+            print(f"{untracked_file}\n")
+        message = "These files will be DELETED. Do you want to continue? (yes/no)(y/n): "
+        get_user_confirmation(message)
+
+def checkout(commit, force, threads=None):
+    # If force is True skips the warnings
+    if not force:
+        confirm_checkout(status_sections())
+
+    # If main was selected changes the commit_hash to the hash of the current main
+    if commit == 'main':
+        commit = head_commit()
+        if commit is None:
+            raise FileNotFoundError(f"The branch '{head_ref_path()}' has no commits.")
+            
+    elif '/' not in commit and read_ref(TAG_PREFIX + commit):
+        commit = read_ref(TAG_PREFIX + commit)
+
+    restore_commit(commit, threads)
+
+def restore_commit(commit, threads=None):
+    """
+    Make the worktree match a commit, rewriting only the files that differ, and reset the index to HEAD.
+
+    The index always describes HEAD's tree, so after restoring another commit its differences
+    from HEAD show as local changes instead of being committed by the next 'commit'. Only
+    the sparse cone is read, walked and written when one is set; the files are written by
+    threads threads (checkout_threads by default).
+    """
+    sparse = sparse_cone()
+    # Get information about the commit about to be restored
+    target_files = tree_files(read_commit(commit).tree, sparse=sparse)
+
+    # The index describes the files currently checked out (with their stat data), so only the
+    # paths whose content differs from the target are removed or written
+    index_path = repo_path(INDEX_PATH)
+    current = load_index(missing_ok=True)
+    index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+
+    index_data = {}
+    removed_folders = set()
+    # Get all files in the project, outside the .myvcsignore file
+    for file, dir_entry in iter_worktree(sparse=sparse):
+        if file not in target_files:
+            os.remove(repo_path(file))
+            removed_folders.add(os.path.dirname(file))
+            continue
+        entry = current.get(file)
+        stat_data = file_stat_data(file, dir_entry.stat())
+        if entry is not None and stat_matches(entry[1], file, index_mtime_ns, stat_data):
+            current_hash = entry[0]
+        else:
+            current_hash = hash_file(file)
+        if current_hash == target_files[file]:
+            # Already up to date, leave the file (and its mtime) alone
+            index_data[file] = [current_hash, stat_data]
+
+    # Remove the folders left empty, deepest first
+    remove_empty_folders(removed_folders)
+            
+    # Restore the files that are missing or differ from the commit
+    missing = {path: file_hash for path, file_hash in target_files.items() if path not in index_data}
+    create_folders(missing)
+    for path, stat_data in write_worktree_files(missing, threads).items():
+        # The worktree now matches the restored tree, cache the fresh stat data in the index
+        index_data[path] = [missing[path], stat_data]
+    head = head_commit()
+    if head != commit:
+        head_files = tree_files(commit_tree_hash(head), sparse=sparse)
+        index_data = {path: [file_hash, index_data[path][1] if path in index_data and index_data[path][0] == file_hash else None]
+                      for path, file_hash in head_files.items()}
+    write_index(index_data)
+
+# ===================================== Diff =====================================
+# Files are diffed as arrays of line hashes, so neither version is held as a list of strings;
+# the text of the lines is read a second time, in order, only for the hunks that get printed.
+
+DIFF_CONTEXT = 3
+# Like git, a file with a NUL byte in its first 8000 bytes is treated as binary
+BINARY_CHECK_SIZE = 8000
+
+def middle_snake(a, a_lo, a_hi, b, b_lo, b_hi):
+    """
+    Return (x start, y start, x end, y end) of the middle snake of a[a_lo:a_hi] and b[b_lo:b_hi].
+
+    The shortest edit script is searched from both ends at once (Myers, "An O(ND) Difference
+    Algorithm"); where the two searches meet splits the problem into two halves.
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) // 2
+    # The furthest x reached on each diagonal k, kept for the diagonals touched so far only
+    forward = {1: 0}
+    backward = {1: 0}
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            if odd and delta - (d - 1) <= k <= delta + (d - 1) and x + backward[delta - k] >= n:
+                return x_start, y_start, x, y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+            if not odd and -d <= delta - k <= d and x + forward[delta - k] >= n:
+                return n - x, m - y, n - x_start, m - y_start
+    raise ValueError("No middle snake found.")
+
+def diff_range(a, a_lo, a_hi, b, b_lo, b_hi, blocks):
+    """Append the matching blocks of a[a_lo:a_hi] and b[b_lo:b_hi] to blocks, in order."""
+    prefix = 0
+    while a_lo + prefix < a_hi and b_lo + prefix < b_hi and a[a_lo + prefix] == b[b_lo + prefix]:
+        prefix += 1
+    if prefix:
+        blocks.append((a_lo, b_lo, prefix))
+        a_lo += prefix
+        b_lo += prefix
+    suffix = 0
+    while a_lo < a_hi - suffix and b_lo < b_hi - suffix and a[a_hi - 1 - suffix] == b[b_hi - 1 - suffix]:
+        suffix += 1
+    a_hi -= suffix
+    b_hi -= suffix
+    if a_lo < a_hi and b_lo < b_hi:
+        x_start, y_start, x_end, y_end = middle_snake(a, a_lo, a_hi, b, b_lo, b_hi)
+        diff_range(a, a_lo, a_lo + x_start, b, b_lo, b_lo + y_start, blocks)
+        if x_end > x_start:
+            blocks.append((a_lo + x_start, b_lo + y_start, x_end - x_start))
+        diff_range(a, a_lo + x_end, a_hi, b, b_lo + y_end, b_hi, blocks)
+    if suffix:
+        blocks.append((a_hi, b_hi, suffix))
+
+def diff_blocks(a, b):
+    """Return the matching blocks (a start, b start, length) of two sequences, ending with (len(a), len(b), 0)."""
+    blocks = []
+    diff_range(a, 0, len(a), b, 0, len(b), blocks)
+    merged = []
+    for a_start, b_start, size in blocks:
+        if merged and merged[-1][0] + merged[-1][2] == a_start and merged[-1][1] + merged[-1][2] == b_start:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+        else:
+            merged.append((a_start, b_start, size))
+    merged.append((len(a), len(b), 0))
+    return merged
+
+def diff_hunks(blocks, context=DIFF_CONTEXT):
+    """
+    Yield the hunks of a diff as (a start, a end, b start, b end, changes).
+
+    changes lists the (a start, a end, b start, b end) ranges that differ inside the hunk;
+    changes less than 2 * context lines apart share a hunk.
+    """
+    a_len, b_len = blocks[-1][0], blocks[-1][1]
+
+    def finish(changes):
+        before = min(context, changes[0][0])
+        after = min(context, a_len - changes[-1][1])
+        return changes[0][0] - before, changes[-1][1] + after, changes[0][2] - before, changes[-1][3] + after, changes
+
+    changes = []
+    a_pos = b_pos = 0
+    for a_start, b_start, size in blocks:
+        if a_start > a_pos or b_start > b_pos:
+            if changes and a_pos - changes[-1][1] > 2 * context:
+                yield finish(changes)
+                changes = []
+            changes.append((a_pos, a_start, b_pos, b_start))
+        a_pos, b_pos = a_start + size, b_start + size
+    if changes:
+        yield finish(changes)
+
+def content_chunks(source):
+    """Return an iterator over the content of a ('blob', hash) or ('file', path) source."""
+    kind, name = source
+    if kind == 'blob':
+        return iter_blob(name)
+
+    def file_chunks():
+        with open(repo_path(name), 'rb') as file:
+            yield from iter(lambda: file.read(CHUNK_SIZE), b'')
+    return file_chunks()
+
+def iter_lines(chunks):
+    """Yield the lines of content arriving in chunks, each with its line ending."""
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+def is_binary(source):
+    """Return True if the start of a source contains a NUL byte."""
+    if source is None:
+        return False
+    head = b''
+    chunks = content_chunks(source)
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= BINARY_CHECK_SIZE:
+            break
+    chunks.close()
+    return b'\0' in head[:BINARY_CHECK_SIZE]
+
+def line_hashes(source):
+    """
+    Return the lines of a source as an array of their hashes.
+
+    Two different lines are only taken as equal if their 64-bit hashes collide.
+    """
+    if source is None:
+        return array.array('q')
+    return array.array('q', map(hash, iter_lines(content_chunks(source))))
+
+class LineCursor:
+    """Reads the lines of one side of a diff front to back, skipping those no hunk shows."""
+
+    def __init__(self, source):
+        self.lines = iter_lines(content_chunks(source)) if source is not None else iter(())
+        self.position = 0
+
+    def read(self, start, end):
+        """Return lines start to end (exclusive); start must not be behind the last line read."""
+        for _ in range(start - self.position):
+            next(self.lines)
+        self.position = end
+        return [next(self.lines) for _ in range(end - start)]
+
+def hunk_range(start, end):
+    """Format one side of a hunk header the way unified diffs do."""
+    length = end - start
+    if length == 1:
+        return f'{start + 1}'
+    return f'{start + 1 if length else start},{length}'
+
+def write_lines(out, marker, lines):
+    """Write diff lines with their marker, flagging a last line without a newline."""
+    for line in lines:
+        out.write(marker + line)
+        if not line.endswith(b'\n'):
+            out.write(b'\n\\ No newline at end of file\n')
+
+def write_file_diff(out, path, old_source, new_source, context=DIFF_CONTEXT):
+    """Write the unified diff of one file, hunk by hunk."""
+    old_name = f'a/{path}' if old_source is not None else '/dev/null'
+    new_name = f'b/{path}' if new_source is not None else '/dev/null'
+    out.write(f'diff --myvcs a/{path} b/{path}\n'.encode())
+    if is_binary(old_source) or is_binary(new_source):
+        out.write(f'Binary files {old_name} and {new_name} differ\n'.encode())
+        return
+    out.write(f'--- {old_name}\n+++ {new_name}\n'.encode())
+
+    blocks = diff_blocks(line_hashes(old_source), line_hashes(new_source))
+    old_lines = LineCursor(old_source)
+    new_lines = LineCursor(new_source)
+    for a_start, a_end, b_start, b_end, changes in diff_hunks(blocks, context):
+        out.write(f'@@ -{hunk_range(a_start, a_end)} +{hunk_range(b_start, b_end)} @@\n'.encode())
+        a_pos, b_pos = a_start, b_start
+        for change_a_start, change_a_end, change_b_start, change_b_end in changes:
+            write_lines(out, b' ', old_lines.read(a_pos, change_a_start))
+            write_lines(out, b'-', old_lines.read(change_a_start, change_a_end))
+            write_lines(out, b'+', new_lines.read(change_b_start, change_b_end))
+            a_pos, b_pos = change_a_end, change_b_end
+        write_lines(out, b' ', old_lines.read(a_pos, a_end))
+
+def resolve_revision(revision):
+    """Return the commit hash named by HEAD, a branch, a tag or a (possibly abbreviated) commit hash."""
+    if revision == 'HEAD':
+        commit_hash = head_commit()
+        if commit_hash is None:
+            raise ValueError("HEAD has no commits yet.")
+        return commit_hash
+    for prefix in (BRANCH_PREFIX, TAG_PREFIX):
+        ref_hash = read_ref(prefix + revision) if '/' not in revision else None
+        if ref_hash is not None:
+            return ref_hash
+    hex_length = 2 * id_size()
+    if re.fullmatch(f'[0-9a-f]{{{hex_length}}}', revision) and object_exists(revision):
+        return revision
+    if re.fullmatch(f'[0-9a-f]{{4,{hex_length - 1}}}', revision):
+        matches = {object_hash for object_hash in loose_object_hashes() if object_hash.startswith(revision)}
+        matches.update(pack.object_id(i) for pack in packs() for i in range(pack.count) if pack.object_id(i).startswith(revision))
+        matches = [object_hash for object_hash in matches if object_info(object_hash)[0] in ('commit', None)]
+        if len(matches) == 1:
+            return matches[0]
+        if len(matches) > 1:
+            raise ValueError(f"The revision '{revision}' is ambiguous.")
+    raise ValueError(f"Unknown revision '{revision}'.")
+
+def revision_tree(revision):
+    """Return the tree hash of a revision."""
+    return read_commit(resolve_revision(revision)).tree
+
+def worktree_changes(old_files, paths):
+    """
+    Yield (path, old source, new source) for the worktree files in paths that differ from old_files.
+
+    Files whose stat data still matches the index are taken to have their indexed hash, so
+    only files that were touched are read.
+    """
+    index_path = repo_path(INDEX_PATH)
+    index_data = load_index(missing_ok=True)
+    index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+    for path in sorted(paths):
+        old_hash = old_files.get(path)
+        if not os.path.isfile(repo_path(path)):
+            if old_hash is not None:
+                yield path, ('blob', old_hash), None
+            continue
+        entry = index_data.get(path)
+        if entry is not None and stat_matches(entry[1], path, index_mtime_ns):
+            new_hash = entry[0]
+        else:
+            new_hash = hash_file(path)
+        if new_hash != old_hash:
+            yield path, ('blob', old_hash) if old_hash is not None else None, ('file', path)
+
+def diff_changes(revisions, cached=False):
+    """
+    Yield (path, old source, new source) for every file 'diff' shows.
+
+    With no revision the index is compared with the worktree, with one the revision is compared
+    with the worktree (or the index if cached), and with two the revisions with each other.
+    """
+    def blob(blob_hash):
+        return ('blob', blob_hash) if blob_hash is not None else None
+
+    if len(revisions) == 2:
+        for path, old_hash, new_hash in diff_trees(revision_tree(revisions[0]), revision_tree(revisions[1])):
+            yield path, blob(old_hash), blob(new_hash)
+        return
+
+    index_data = load_index(missing_ok=True)
+    if cached or revisions:
+        if revisions:
+            old_files = tree_files(revision_tree(revisions[0]))
+        else:
+            old_files = head_tree()
     else:
-        # Get the hash of the previous commit (in refs/main)
-        with open('.myvcs/refs/branches/main', 'r') as main:
-            main_hash = main.read().strip()
-        # Commit content with the previous commit's hash
-        commit_content = f"""
-            tree {tree_hash}
-            parent {main_hash}
-            author {aurhor_name} <{author_email}> 
-            timestamp {timestamp}
-            message {message}
-        """
-    commit_hash = hashlib.sha1(commit_content.encode()).hexdigest()
-    
-    # Create the commit object   
-    commit_path = f'.myvcs/objects/{commit_hash}'
-    with open(commit_path, 'w') as commit_file:
-        commit_file.write(commit_content)
-        
-    # Update HEAD to point to the new commit (in refs/main)
-    with open('.myvcs/refs/branches/main', 'w') as ref_file:
-        ref_file.write(commit_hash)
+        old_files = {path: blob_hash for path, (blob_hash, _) in index_data.items()}
 
-    # Clear the index after commit
-    with open('.myvcs/index', 'w') as index_file:
-        index_file.write("")
-    
-    print(f"Commit created with hash: {commit_hash}")
-    
-    return commit_hash
+    if cached:
+        for path in sorted(set(old_files) | set(index_data)):
+            old_hash = old_files.get(path)
+            new_hash = index_data[path][0] if path in index_data else None
+            if old_hash != new_hash:
+                yield path, blob(old_hash), blob(new_hash)
+        return
+    yield from worktree_changes(old_files, set(old_files) | set(index_data))
 
-def list_all_files(root_dir=".", ignore_list=None):
+def diff_output(revisions, cached=False, context=DIFF_CONTEXT):
+    """Yield the unified diff of the 'diff' command as bytes, one file at a time."""
+    if len(revisions) > 2:
+        raise ValueError("diff compares at most two revisions.")
+    if cached and len(revisions) > 1:
+        raise ValueError("--cached compares the index with one revision.")
+    for path, old_source, new_source in diff_changes(revisions, cached):
+        out = io.BytesIO()
+        write_file_diff(out, path, old_source, new_source, context)
+        yield out.getvalue()
+
+def show_diff(revisions, cached=False, context=DIFF_CONTEXT):
+    """Write the unified diff for the 'diff' command to stdout, one file at a time."""
+    write_diff(diff_output(revisions, cached, context))
+
+def write_diff(chunks):
+    """Write the chunks of a diff to stdout as they arrive."""
+    out = sys.stdout.buffer
+    for chunk in chunks:
+        out.write(chunk)
+    out.flush()
+
+# ==================================== Merging ====================================
+# The merge base is found inside the commit graph: both tips are walked at once, highest
+# generation first, and the walk stops as soon as everything still queued lies below a common
+# ancestor, so the histories under the merge base are never read.
+
+MERGE_SIDE_ONE = 1
+MERGE_SIDE_TWO = 2
+MERGE_STALE = 4
+
+def merge_bases(graph, one, two):
+    """Return the graph rows of the best common ancestors of rows one and two, highest generation first."""
+    if one == two:
+        return [one]
+    flags = {one: MERGE_SIDE_ONE, two: MERGE_SIDE_TWO}
+    queue = [(-graph.row(one)[4], one), (-graph.row(two)[4], two)]
+    heapq.heapify(queue)
+    bases = []
+    while any(not flags[position] & MERGE_STALE for _, position in queue):
+        _, position = heapq.heappop(queue)
+        side = flags[position]
+        if side == MERGE_SIDE_ONE | MERGE_SIDE_TWO:
+            # Reached from both tips and not below another common ancestor
+            bases.append(position)
+            side |= MERGE_STALE
+            flags[position] = side
+        for parent in graph.row(position)[2]:
+            if flags.get(parent, 0) & side == side:
+                continue
+            flags[parent] = flags.get(parent, 0) | side
+            heapq.heappush(queue, (-graph.row(parent)[4], parent))
+    return bases
+
+def merge_lines(base, ours, theirs):
     """
-    Return a list of *relative* file paths for everything under root_dir,
-    excluding any files or folders in ignore_list.
-    
-    ignore_list: list of folder or file names to ignore (e.g. ['.myvcs', 'temp.txt'])
+    Three-way merge of three lists of lines; return the merged lines, or None on a conflict.
+
+    The regions where both sides still match the base are lined up, and between them each
+    hunk is taken from whichever side changed it. Both sides changing it differently is a conflict.
     """
-    ignore_list.extend(['.myvcs', '.git', 'myvcs.py', '.myvcsignore', '.vscode'])
-    if ignore_list is None:
-        ignore_list = []
+    ours_blocks = diff_blocks(base, ours)
+    theirs_blocks = diff_blocks(base, theirs)
+    regions = []
+    i = j = 0
+    while i < len(ours_blocks) and j < len(theirs_blocks):
+        ours_base, ours_start, ours_size = ours_blocks[i]
+        theirs_base, theirs_start, theirs_size = theirs_blocks[j]
+        start = max(ours_base, theirs_base)
+        end = min(ours_base + ours_size, theirs_base + theirs_size)
+        if start < end:
+            regions.append((start, end, ours_start + start - ours_base, theirs_start + start - theirs_base))
+        if ours_base + ours_size < theirs_base + theirs_size:
+            i += 1
+        else:
+            j += 1
+    regions.append((len(base), len(base), len(ours), len(theirs)))
+
+    merged = []
+    base_pos = ours_pos = theirs_pos = 0
+    for base_start, base_end, ours_start, theirs_start in regions:
+        base_part = base[base_pos:base_start]
+        ours_part = ours[ours_pos:ours_start]
+        theirs_part = theirs[theirs_pos:theirs_start]
+        if ours_part == theirs_part or theirs_part == base_part:
+            merged.extend(ours_part)
+        elif ours_part == base_part:
+            merged.extend(theirs_part)
+        else:
+            return None
+        merged.extend(base[base_start:base_end])
+        base_pos = base_end
+        ours_pos = ours_start + base_end - base_start
+        theirs_pos = theirs_start + base_end - base_start
+    return merged
 
-    all_paths = []
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        # Remove ignored folders from dirnames so os.walk skips them
-        dirnames[:] = [d for d in dirnames if d not in ignore_list]
+def merge_blobs(base_blob, ours_blob, theirs_blob):
+    """Line-level merge of one file changed on both sides; return the merged blob hash, or None on a conflict."""
+    ours = read_blob(ours_blob).data
+    theirs = read_blob(theirs_blob).data
+    base = read_blob(base_blob).data if base_blob is not None else b''
+    if b'\0' in base or b'\0' in ours or b'\0' in theirs:
+        # Binary files cannot be merged line by line
+        return None
+    merged = merge_lines(base.splitlines(keepends=True), ours.splitlines(keepends=True), theirs.splitlines(keepends=True))
+    if merged is None:
+        return None
+    return write_object('blob', b''.join(merged))
 
-        for fname in filenames:
-            # Skip ignored files
-            if fname in ignore_list:
+def merge_entry(base, ours, theirs):
+    """Return the result of a trivial three-way merge of one entry, or False when both sides changed it."""
+    if ours == theirs or theirs == base:
+        return ours
+    if ours == base:
+        return theirs
+    return False
+
+def merge_flat_trees(base_tree, ours_tree, theirs_tree):
+    """Three-way merge where one of the trees is an old flat tree, path by path."""
+    base_files = tree_files(base_tree)
+    ours_files = tree_files(ours_tree)
+    theirs_files = tree_files(theirs_tree)
+    changes = {}
+    conflicts = []
+    for path in sorted(set(base_files) | set(ours_files) | set(theirs_files)):
+        base, ours, theirs = base_files.get(path), ours_files.get(path), theirs_files.get(path)
+        merged = merge_entry(base, ours, theirs)
+        if merged is False:
+            merged = merge_blobs(base, ours, theirs) if ours is not None and theirs is not None else None
+            if merged is None:
+                conflicts.append(path)
                 continue
+        if merged != ours:
+            changes[path] = merged
+    # update_tree rewrites a flat base as nested trees
+    return update_tree(ours_tree, changes) if changes else ours_tree, conflicts
 
-            full_path = os.path.join(dirpath, fname)
-            rel_path = os.path.relpath(full_path, root_dir)
-            all_paths.append(rel_path)
-            
-    return all_paths
+def merge_trees(base_tree, ours_tree, theirs_tree, prefix=''):
+    """
+    Three-way merge of three trees; return (merged tree hash, conflicting paths).
 
-def status_check(log_status=True):
-    with open('.myvcs/HEAD','r') as head_file:
-        main_path = head_file.read().strip()
-    
-    if main_path == '':
-        print('No commits yet!')
-        return
-    else:
-        with open(os.path.join('.myvcs', main_path), 'r') as main_file:
-            main_hash = main_file.read().lstrip()
-    
-    with open(os.path.join('.myvcs/objects', main_hash)) as commit_content:
-        commit = commit_content.read().strip().splitlines()
-    
-    if os.path.exists('.myvcsignore'):
-        with open('.myvcsignore') as ignore_file:
-            ignore_content = ignore_file.read().strip().splitlines()
-    else:
-        ignore_content = None
-    all_files = list_all_files(ignore_list=ignore_content)
-    
-    tree_hash = next((ln for ln in commit if "tree" in ln), None).split()[1]
-    with open(os.path.join('.myvcs/objects', tree_hash)) as tree:
-        tree = tree.read().strip().splitlines()
+    Entries with the same hash on two sides are settled without being read, subtrees changed
+    on both sides are merged recursively and only files changed on both sides are merged line by line.
+    """
+    merged = merge_entry(base_tree, ours_tree, theirs_tree)
+    if merged is not False:
+        return merged, []
+    trees = read_tree(base_tree), read_tree(ours_tree), read_tree(theirs_tree)
+    if any(tree.flat for tree in trees):
+        return merge_flat_trees(base_tree, ours_tree, theirs_tree)
+    base_entries, ours_entries, theirs_entries = (tree.entries for tree in trees)
 
-    with open('.myvcs/index') as index:
-        staged = index.read().strip().splitlines()
-        
-    tree_files = []
-    hash_existFile = []
-    for file in tree:
-        tree_files.append(file.split()[1])
-        hash_existFile.append(file.split()[0])
-
-    staged_files = []
-    for file_staged in staged:
-        staged_files.append(file_staged.split()[0])
-        
-    status = []
-    for a_file in all_files:
-        if a_file in tree_files:
-            idx = tree_files.index(a_file)
-            with open(a_file, 'rb') as file:
-                content = file.read()
-            current_hash = hashlib.sha256(content).hexdigest()
-            if hash_existFile[idx] != current_hash:
-                status.append([a_file, 'modified'])
+    entries = {}
+    conflicts = []
+    for name in sorted(set(base_entries) | set(ours_entries) | set(theirs_entries)):
+        base, ours, theirs = base_entries.get(name), ours_entries.get(name), theirs_entries.get(name)
+        merged = merge_entry(base, ours, theirs)
+        if merged is False:
+            path = prefix + name
+            kinds = {entry[0] for entry in (base, ours, theirs) if entry is not None}
+            if kinds == {'tree'}:
+                sub_tree, sub_conflicts = merge_trees(base and base[1], ours and ours[1], theirs and theirs[1], path + '/')
+                conflicts.extend(sub_conflicts)
+                merged = ('tree', sub_tree) if sub_tree is not None else None
+            elif kinds == {'blob'} and ours is not None and theirs is not None:
+                merged_blob = merge_blobs(base and base[1], ours[1], theirs[1])
+                if merged_blob is None:
+                    conflicts.append(path)
+                    merged = ours
+                else:
+                    merged = ('blob', merged_blob)
             else:
-                status.append([a_file, 'unmodified'])
-        elif a_file in staged_files:
-            status.append([a_file, 'new'])
-        elif a_file not in tree_files:
-            status.append([a_file, 'untracked'])
-            
-    # =============================== Print out Status  ==============================
-    # modified, unmodified, new, untracked
-    status_bulk = [[],[],[],[]]
-    for status_file in status:
-        if status_file[1] == 'modified':
-            status_bulk[0].append(status_file[0])
-        elif status_file[1] == 'unmodified':
-            status_bulk[1].append(status_file[0])
-        elif status_file[1] == 'new':
-            status_bulk[2].append(status_file[0])
-        elif status_file[1] == 'untracked':
-            status_bulk[3].append(status_file[0]) 
-    
-    if log_status == True:
-        # print out the status
-        print("Status:")
-        print("modified:\n", end="     ")
-        for file in status_bulk[0]:
-            print(file, end="\n")
-        print()
-        print("unmodified:\n", end="     ")
-        for file in status_bulk[1]:
-            print(file, end="\n")
-        print()
-        print("new:\n", end="     ")
-        for file in status_bulk[2]:
-            print(file, end="\n")
-        print()
-        print("untracked:\n", end="     ")
-        for file in status_bulk[3]:
-            print(file, end="\n")
+                # Deleted on one side and changed on the other, or a file against a directory
+                conflicts.append(path)
+                merged = ours
+        if merged is not None:
+            entries[name] = merged
+    return write_tree(entries), conflicts
+
+def merge_branch(branch_name, into):
+    """
+    Merge branch_name into the branch into and return (the commit into now points to, fast-forward).
+
+    The commit is None when into already contains branch_name, and fast-forward tells whether
+    into was only moved to branch_name's commit.
+
+    When into has no commits of its own since the merge base the branch is fast-forwarded,
+    otherwise a commit with both tips as parents is written. Nothing is changed on a conflict.
+    When into is checked out, the worktree and the index are brought to the result as well;
+    the merge is refused if a path it changes has local changes.
+    """
+    into_ref = BRANCH_PREFIX + into
+    theirs = read_ref(BRANCH_PREFIX + branch_name)
+    ours = read_ref(into_ref)
+    if theirs is None:
+        raise ValueError(f'The given branch does not exist.{branch_name}')
+    if ours is None:
+        raise ValueError(f'The given branch does not exist.{into}')
+    if not theirs:
+        raise ValueError(f"The branch '{branch_name}' has no commits.")
+
+    if ours:
+        graph = load_commit_graph()
+        if graph is None or graph.lookup(ours) is None or graph.lookup(theirs) is None:
+            if graph is not None:
+                graph.close()
+            write_commit_graph()
+            graph = load_commit_graph()
+        try:
+            bases = merge_bases(graph, graph.lookup(ours), graph.lookup(theirs))
+            # With several best common ancestors (criss-cross merges) the newest one is used
+            base = graph.row(bases[0])[:2] if bases else None
+            ours_tree = graph.row(graph.lookup(ours))[1]
+            theirs_tree = graph.row(graph.lookup(theirs))[1]
+        finally:
+            graph.close()
     else:
-        return status_bulk
+        base = None
 
-def checkout(commit, force):
-    def get_user_confirmation(message):
+    if base is not None and base[0] == theirs:
+        return None, False
+    checked_out = head_ref_name() == into_ref
+    if not ours or base[0] == ours:
+        worktree_changes = merge_worktree_changes(branch_name, into, commit_tree_hash(ours), commit_tree_hash(theirs)) if checked_out else {}
+        write_ref(into_ref, theirs)
+        update_worktree(worktree_changes)
+        return theirs, True
+
+    with object_transaction():
+        tree_hash, conflicts = merge_trees(base[1] if base is not None else None, ours_tree, theirs_tree)
+        if conflicts:
+            raise ValueError(f"Merge of '{branch_name}' into '{into}' stopped, both sides changed: {', '.join(conflicts)}")
+        worktree_changes = merge_worktree_changes(branch_name, into, ours_tree, tree_hash) if checked_out else {}
+        commit_hash = write_commit(tree_hash, [ours, theirs], f"Merge branch {branch_name} into {into}")
+    sync_pending_objects()
+    write_ref(into_ref, commit_hash)
+    update_commit_graph(commit_hash)
+    update_worktree(worktree_changes)
+    return commit_hash, False
+
+def print_merge(branch_name, into, commit_hash, fast_forward):
+    """Print the result of merge_branch, as 'branch -m' does."""
+    if commit_hash is None:
+        print(f"Branch '{into}' already contains '{branch_name}'.")
+    elif fast_forward:
+        print(f"Branch '{branch_name}' merged into '{into}' (fast-forward to {commit_hash}).")
+    else:
+        print(f"Branch '{branch_name}' merged into '{into}' successfully. Merge commit: {commit_hash}")
+
+def merge_worktree_changes(branch_name, into, old_tree, new_tree):
+    """Return the worktree changes (path -> hash, None to remove) a merge into the checked-out branch makes, refusing to overwrite local changes."""
+    sparse = sparse_cone()
+    changes = {path: new_hash for path, _, new_hash in diff_trees(old_tree, new_tree)
+               if sparse is None or sparse.contains(path)}
+    blocked = local_changes(changes)
+    if blocked:
+        raise ValueError(f"Merge of '{branch_name}' into '{into}' stopped, it would overwrite local changes: {', '.join(blocked)}")
+    return changes
+
+# ================================= Branches and tags =================================
+# A ref is named by its path below .myvcs (refs/branches/main, refs/tags/v1.0) and holds a
+# commit hash. It is stored either loose, as a file of that name, or as a line of packed-refs:
+#
+#   # myvcs packed-refs
+#   <commit hash> <ref name>
+#   ...
+#
+# with the lines sorted by name, so one ref is found by a binary search of the mapped file and
+# all the refs of a kind are one contiguous range, without opening a file per ref. A loose ref
+# overrides a packed one of the same name; 'pack-refs' moves the loose refs into packed-refs.
+# Every write goes through a LockFile: the new content is written to <file>.lock, created
+# exclusively, and renamed over the file, so concurrent writers wait for one another and
+# readers see the old or the new content, never part of it.
+
+BRANCH_PREFIX = 'refs/branches/'
+TAG_PREFIX = 'refs/tags/'
+PACKED_REFS_PATH = '.myvcs/packed-refs'
+PACKED_REFS_HEADER = '# myvcs packed-refs\n'
+LOCK_SUFFIX = '.lock'
+# Seconds a writer waits for the lock another one holds
+LOCK_TIMEOUT = 10.0
+
+class LockFile:
+    """
+    An exclusive lock on a repository file, held as <path>.lock until it is committed or closed.
+
+    The new content is written to the lock file and commit() renames it over path; closing
+    the lock without committing leaves path as it was.
+    """
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = repo_path(path)
+        self.lock_path = self.path + LOCK_SUFFIX
+        self.committed = False
+        deadline = time.monotonic() + timeout
         while True:
-            response = input(message).strip().lower()
-            if response == 'yes' or response == 'y':
+            try:
+                fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
                 break
-            elif response == 'no' or response == 'n':
-                break
-        if response == 'yes' or response == 'y':
-            print('\n')
-            pass
-        elif response == 'no' or response == 'n':
-            raise SystemExit("Checkout aborted.")
-    
-    # If force is True skips the warnings
-    if not force:
-        # [[modified], [unmodified], [new], [untracked]]
-        status = status_check(log_status=False)
-        if status[0] != [] or status[2] != [] or status[3] != []:
-            if status[0] != []:
-                print(f'The following files have been modified\n')
-                for modified_file in status[0]:
-                    print(f"{modified_file}\n")
-                message = "These files will be OVERWRITTEN. Do you want to continue? (yes/no)/(y/n): "
-                get_user_confirmation(message)
-                
-            if status[2] != []:
-                print(f'The following files have been added\n')
-                for added_file in status[2]:
-                    print(f"{added_file}\n")
-                message = "These files in the staged area will be DELETED. Do you want to continue? (yes/no)/(y/n): "
-                get_user_confirmation(message)
-            
-            if status[3] != []:
-                print(f'The following files have been untracked\n')
-                for untracked_file in status[3]:
-                    print(f"{untracked_file}\n")
-                message = "These files will be DELETED. Do you want to continue? (yes/no)(y/n): "
-                get_user_confirmation(message)
+            except FileExistsError:
+                if time.monotonic() >= deadline:
+                    raise ValueError(f"Unable to lock '{path}': '{self.lock_path}' exists. "
+                                     f"If no other command is running, remove it.")
+                time.sleep(0.01)
+        self.file = os.fdopen(fd, 'w')
 
-    # Get all files in the project, outside the .myvcsignore file
-    if os.path.exists('.myvcsignore'):
-        with open('.myvcsignore') as ignore_file:
-            ignore_content = ignore_file.read().strip().splitlines()
-    else:
-        ignore_content = None
-    all_files = list_all_files(ignore_list=ignore_content)
-    
-    # Remove all files from the project
-    for file in all_files:
-        os.remove(file)
-        folder = os.path.dirname(file)
-        if folder != '':
-            if not os.listdir(folder):
-                os.rmdir(folder)
-                
-    if os.path.exists('.myvcs/refs/tags'):
-        tags = os.listdir('.myvcs/refs/tags')
+    def write(self, text):
+        self.file.write(text)
 
-    # If main was selected changes the commit_hash to the hash of the current main
-    if commit == 'main':
-        head_path = ".myvcs/HEAD"
-        # Check if HEAD file exists
-        if not os.path.exists(head_path):
-            raise FileNotFoundError(f"The HEAD file does not exist.")
-        with open(head_path, 'r') as head:
-            head_path_data = head.read().strip()
-        # Check if main exists
-        if not os.path.exists(os.path.join('.myvcs', head_path_data)):
-            raise FileNotFoundError(f"The HEAD file '{head_path_data}' does not exist.")
-        # main path is the contents of head_date
-        main_path = os.path.join('.myvcs', head_path_data)
-        # Read the main file and get the commit hash
-        with open(main_path, 'r') as main:
-            commit = main.read().strip()
-            
-    elif commit in tags:
-        tag_path = os.path.join('.myvcs/refs/tags',commit)
-        with open(tag_path,'r') as tag:
-            commit =tag.read().strip()
-            
-    # Get information about the commit about to be restored
-    commit_path = os.path.join('.myvcs/objects',commit)
-    with open(commit_path,'r') as commit_data:
-        lines = commit_data.read().strip().splitlines()
-    for line in lines:
-        line_data = line.strip().split()
-        if line_data[0] == 'tree':
-            tree_hash = line_data[1]
-            tree_path = os.path.join('.myvcs/objects',tree_hash)
-            
-    # Restore the files from the commit
-    with open(tree_path, 'r') as tree_file:
-        tree_data = tree_file.read().strip().splitlines()
-        for line in tree_data:
-            tree_line = line.strip().split()
-            with open(os.path.join('.myvcs\objects',tree_line[0]), 'rb') as hash_file:
-                hash_bytes = hash_file.read()
-            
-            # Make sure the folder exists before creating the file
-            folder = os.path.dirname(tree_line[1])
-            if folder != '':
-                os.makedirs(folder, exist_ok=True)
-            
-            with open(tree_line[1], 'wb') as file:
-                file.write(hash_bytes)
+    def commit(self):
+        """Replace the locked file with what was written, durably when fsync is on."""
+        durable = fsync_mode() == 'batch'
+        self.file.flush()
+        if durable:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.lock_path, self.path)
+        self.committed = True
+        if durable:
+            fsync_path(os.path.dirname(self.path))
+
+    def close(self):
+        """Release the lock, discarding what was written unless it was committed."""
+        self.file.close()
+        if not self.committed:
+            os.remove(self.lock_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class PackedRefs:
+    """The packed-refs file, mapped read-only; refs are found by binary search over its lines."""
+
+    def __init__(self, path=PACKED_REFS_PATH):
+        with open(repo_path(path), 'rb') as file:
+            if os.fstat(file.fileno()).st_size:
+                self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b''
+        self.start = len(PACKED_REFS_HEADER)
+        if self.data[:self.start] != PACKED_REFS_HEADER.encode():
+            raise ValueError(f"The file '{path}' is not a packed-refs file.")
+
+    def line(self, position):
+        """Return (name, hash, start of the next line) of the line starting at position."""
+        end = self.data.find(b'\n', position)
+        ref_hash, name = self.data[position:end].split(b' ', 1)
+        return name, ref_hash, end + 1
+
+    def lower_bound(self, name):
+        """Return where the first line with a ref name not below name starts."""
+        low, high = self.start, len(self.data)
+        while low < high:
+            # Every line holds one ref, so the search works on the line around the midpoint
+            middle = self.data.rfind(b'\n', 0, (low + high) // 2) + 1
+            line_name, _, following = self.line(middle)
+            if line_name < name:
+                low = following
+            else:
+                high = middle
+        return low
+
+    def lookup(self, name):
+        """Return the commit hash of a packed ref, or None."""
+        encoded = name.encode()
+        position = self.lower_bound(encoded)
+        if position >= len(self.data):
+            return None
+        line_name, ref_hash, _ = self.line(position)
+        return ref_hash.decode() if line_name == encoded else None
+
+    def items(self, prefix='refs/'):
+        """Yield (name, hash) for the packed refs whose name starts with prefix, sorted."""
+        encoded = prefix.encode()
+        position = self.lower_bound(encoded)
+        while position < len(self.data):
+            name, ref_hash, position = self.line(position)
+            if not name.startswith(encoded):
+                return
+            yield name.decode(), ref_hash.decode()
+
+def packed_refs():
+    """Return the PackedRefs of the repository, or None when nothing is packed."""
+    def read():
+        if not os.path.exists(repo_path(PACKED_REFS_PATH)):
+            return None
+        return PackedRefs()
+    return cached_file(PACKED_REFS_PATH, read)
+
+def ref_file(name):
+    """Return the path of a loose ref, relative to the repository root as HEAD stores it."""
+    return os.path.join('.myvcs', name)
+
+def check_ref_name(name, kind):
+    """Raise ValueError for names that cannot be stored as a ref file."""
+    if not name or '/' in name or name in ('.', '..') or name.endswith(LOCK_SUFFIX) or not name.isprintable():
+        raise ValueError(f"Invalid {kind} name.")
+
+def read_ref(name):
+    """Return the commit hash of a ref ('' for a branch without commits), or None if it does not exist."""
+    path = ref_file(name)
+    if os.path.exists(repo_path(path)):
+        return read_repository_file(path)
+    packed = packed_refs()
+    return packed.lookup(name) if packed is not None else None
+
+def list_refs(prefix):
+    """Return a dict mapping the names of the refs below prefix (e.g. TAG_PREFIX) to their hashes, sorted."""
+    packed = packed_refs()
+    refs = {name[len(prefix):]: ref_hash for name, ref_hash in packed.items(prefix)} if packed is not None else {}
+    # Loose refs are only the ones written since the last 'pack-refs'
+    ref_dir = ref_file(prefix)
+    if os.path.isdir(repo_path(ref_dir)):
+        for name in os.listdir(repo_path(ref_dir)):
+            if not name.endswith(LOCK_SUFFIX):
+                refs[name] = read_repository_file(os.path.join(ref_dir, name))
+    return dict(sorted(refs.items()))
+
+def write_ref(name, commit_hash, create=False):
+    """
+    Point a ref at commit_hash, under the ref's lock; return False without writing if create is set and it exists.
+
+    The check for an existing ref is made under the lock, so of two processes creating the
+    same ref exactly one succeeds.
+    """
+    path = ref_file(name)
+    os.makedirs(os.path.dirname(repo_path(path)), exist_ok=True)
+    with LockFile(path) as lock:
+        if create and read_ref(name) is not None:
+            return False
+        lock.write(commit_hash)
+        lock.commit()
+    return True
+
+def write_packed_refs(lock, refs):
+    """Write a dict of ref name -> hash to a locked packed-refs file, sorted by name."""
+    lock.write(PACKED_REFS_HEADER)
+    for name in sorted(refs, key=str.encode):
+        lock.write(f"{refs[name]} {name}\n")
+    lock.commit()
+
+def delete_ref(name):
+    """Delete a ref, loose and packed; return False if it did not exist."""
+    path = ref_file(name)
+    with LockFile(path):
+        found = os.path.exists(repo_path(path))
+        # The loose ref's lock is always taken before the one of packed-refs
+        if os.path.exists(repo_path(PACKED_REFS_PATH)):
+            with LockFile(PACKED_REFS_PATH) as packed_lock:
+                refs = dict(PackedRefs().items())
+                if refs.pop(name, None) is not None:
+                    found = True
+                    write_packed_refs(packed_lock, refs)
+        if os.path.exists(repo_path(path)):
+            os.remove(repo_path(path))
+    return found
+
+def pack_refs():
+    """Move the loose branches and tags into packed-refs and return how many were packed."""
+    with LockFile(PACKED_REFS_PATH) as packed_lock:
+        refs = dict(PackedRefs().items()) if os.path.exists(repo_path(PACKED_REFS_PATH)) else {}
+        loose = {}
+        for prefix in (BRANCH_PREFIX, TAG_PREFIX):
+            ref_dir = repo_path(ref_file(prefix))
+            if os.path.isdir(ref_dir):
+                for name in os.listdir(ref_dir):
+                    if not name.endswith(LOCK_SUFFIX):
+                        with open(os.path.join(ref_dir, name), 'r') as ref:
+                            loose[prefix + name] = ref.read().strip()
+        # A branch without commits has nothing to pack
+        loose = {name: ref_hash for name, ref_hash in loose.items() if ref_hash}
+        refs.update(loose)
+        write_packed_refs(packed_lock, refs)
+
+    # Loose copies go only once packed-refs holds them; one being written meanwhile stays loose,
+    # where it overrides the packed line, and is picked up by the next 'pack-refs'
+    for name, ref_hash in loose.items():
+        try:
+            with LockFile(ref_file(name), timeout=0):
+                with open(repo_path(ref_file(name)), 'r') as ref:
+                    unchanged = ref.read().strip() == ref_hash
+                if unchanged:
+                    os.remove(repo_path(ref_file(name)))
+        except (ValueError, FileNotFoundError):
+            continue
+    return len(loose)
+
+def list_branches():
+    """Return the names of the branches, sorted."""
+    return list(list_refs(BRANCH_PREFIX))
+
+def create_branch(name, commit_hash=None):
+    """Create a branch at commit_hash (HEAD's commit by default) and return the commit it points to."""
+    check_ref_name(name, 'branch')
+    if commit_hash is None:
+        commit_hash = head_commit()
+        if commit_hash is None:
+            raise ValueError(f"The branch '{os.path.basename(head_ref_path())}' has no commits yet.")
+    write_ref(BRANCH_PREFIX + name, commit_hash)
+    return commit_hash
+
+def switch_branch(name):
+    """Point HEAD at a branch; the worktree is left alone and the index follows (see sync_index)."""
+    if '/' in name or read_ref(BRANCH_PREFIX + name) is None:
+        raise ValueError(f'The given branch does not exist.{name}')
+    old_commit = head_commit()
+    write_repository_file('.myvcs/HEAD', ref_file(BRANCH_PREFIX + name))
+    sync_index(old_commit, head_commit())
+
+def delete_branch(name):
+    """Delete a branch; HEAD goes back to main when it pointed at the deleted branch."""
+    old_commit = head_commit()
+    if '/' in name or not delete_ref(BRANCH_PREFIX + name):
+        raise ValueError(f'The given branch does not exist.{name}')
+    if head_ref_name() == BRANCH_PREFIX + name:
+        write_repository_file('.myvcs/HEAD', ref_file(BRANCH_PREFIX + 'main'))
+        sync_index(old_commit, head_commit())
+
+def list_tags():
+    """Return a dict mapping each tag name to the commit it points to."""
+    return list_refs(TAG_PREFIX)
+
+def create_tag(name, commit_hash=None):
+    """Tag commit_hash (HEAD's commit by default) and return the tagged commit."""
+    check_ref_name(name, 'tag')
+    if commit_hash is None:
+        commit_hash = head_commit()
+        if commit_hash is None:
+            raise ValueError('HEAD has no commits yet.')
+    if not write_ref(TAG_PREFIX + name, commit_hash, create=True):
+        raise ValueError(f"Tag '{name}' already exists.")
+    return commit_hash
 
 def add_tag(tag_name):
-    os.makedirs('.myvcs/refs/tags', exist_ok=True)
-    tags = os.listdir('.myvcs/refs/tags')
-    
-    # Invalid tag name check
-    if '/' in tag_name or tag_name == '':
-        raise ValueError("Invalid tag name.")
-    
-    if tag_name in tags:
-        raise ValueError(f"Tag '{tag_name}' already exists.")
-    
-    with open('.myvcs/HEAD', 'r') as head:
-        head_path = head.read().strip()
-    if head_path == '':
-        raise ValueError('HEAD file is empty.')
-    
-    with open(os.path.join('.myvcs', head_path), 'r') as main:
-        main_hash = main.read().strip()
-    
-    with open('.myvcs/refs/tags/' + tag_name, 'w') as tag:
-        tag.write(main_hash)
-    
+    create_tag(tag_name)
     print(f'Tag created successfully. Tag: {tag_name}')
 
 
 def branch(name, list_flag, delete, switch, merge, into):
     """[name:Str, list_flag:bool, delete:str, switch:str, merge:str]"""
-    os.makedirs('.myvcs/refs/branches', exist_ok=True)
-
     def branch_create(branch_name_create):
-        with open('.myvcs/HEAD', 'r') as head:
-            current_head = head.read().strip()  
-            
-        with open(f'.myvcs/refs/branches/{current_head}', 'r') as main:
-            main_hash = main.read().strip()
-        with open(f'.myvcs/refs/branches/{branch_name_create}', 'w') as new_branch:
-            new_branch.write(main_hash)
-        with open('.myvcs/HEAD', 'w') as head:
-            head.write(f'.myvcs/refs/branches/{branch_name_create}')    
+        current_head = os.path.basename(head_ref_path())
+        create_branch(branch_name_create)
+        switch_branch(branch_name_create)
         print(f'From {current_head}, branch {branch_name_create} was created successfully.')
         
     def branch_list():
-        print('Branches:')
-        branches = os.listdir('.myvcs/refs/branches')
-        for branch in branches:
-            print('     ' + branch)
+        print_branches(list_branches())
             
     def branch_delete(branch_name_delete):
-        if os.path.exists(f'.myvcs/refs/branches/{branch_name_delete}'):
-            os.remove(f'.myvcs/refs/branches/{branch_name_delete}')
-            with open('.myvcs/HEAD', 'w') as head:
-                head.write('.myvcs/refs/branches/main') 
-        else:
-            raise ValueError(f'The given branch does not exist.{branch_name_delete}')
-        
+        delete_branch(branch_name_delete)
         print(f'Branch {branch_name_delete} deleted successfully.')
     
     def branch_switch(branch_name_switch):
-        if os.path.exists(f'.myvcs/refs/branches/{branch_name_switch}'):
-            with open('.myvcs/HEAD', 'w') as head:
-                head.write(f'.myvcs/refs/branches/{branch_name_switch}') 
-        else:
-            raise ValueError(f'The given branch does not exist.{branch_name_switch}')
+        switch_branch(branch_name_switch)
         print(f'Switched to branch: {branch_name_switch}')
     
     def branch_merge(branch_name_merge, branch_into):
-        if not os.path.exists(f'.myvcs/refs/branches/{branch_name_merge}'):
-            raise ValueError(f'The given branch does not exist.{branch_name_merge}')
-        if not os.path.exists(f'.myvcs/refs/branches/{branch_into}'):
-            raise ValueError(f'The given branch does not exist.{branch_into}')
-        
-        with open(f'.myvcs/refs/branches/{branch_name_merge}', 'r') as merge:
-            hash_merge = merge.read().strip()
-        with open(f'.myvcs/refs/branches/{branch_into}', 'w') as into:
-            into.write(hash_merge)
-        
-        print(f"Branch '{branch_name_merge}' merged into '{branch_into}' successfully.")
+        print_merge(branch_name_merge, branch_into, *merge_branch(branch_name_merge, branch_into))
         
     if name != None:
         branch_create(name)
@@ -522,20 +4523,488 @@ def branch(name, list_flag, delete, switch, merge, into):
         branch_list()
     else:
         raise ValueError("Invalid command.")
-    
+
+def print_branches(names):
+    """Print the branch names, as 'branch -l' does."""
+    print('Branches:')
+    for branch in names:
+        print('     ' + branch)
+
+# ================================== Python API ==================================
+# Repository gives Python programs the commands as methods that return data instead of
+# printing; the command line formats what they return. A call sets REPOSITORY_ROOT for the
+# calling thread only (see Repository root), so the process's working directory is never
+# changed and calls into different repositories run side by side. Calls into the same
+# repository take turns, like the commands of 'serve'.
+
+# The lock of each repository root, shared by every Repository opened on it
+REPOSITORY_LOCKS = {}
+REPOSITORY_LOCKS_LOCK = threading.Lock()
+
+def repository_lock(root):
+    """Return the lock calls into the repository at root hold."""
+    with REPOSITORY_LOCKS_LOCK:
+        return REPOSITORY_LOCKS.setdefault(root, threading.RLock())
+
+class Repository:
+    """
+    A repository opened from Python.
+
+    Parsed objects stay in OBJECT_CACHE between calls, and on Linux the parsed index, config
+    and refs are kept too, dropped through inotify when another process changes them.
+
+    Paths given to the methods are relative to the repository's root, whatever the working
+    directory of the process is. Threads may share a Repository; their calls take turns.
+    """
+
+    def __init__(self, path='.', cache=True):
+        self.root = os.path.abspath(path)
+        if not os.path.isdir(os.path.join(self.root, '.myvcs')):
+            raise FileNotFoundError(f"There is no repository in '{self.root}'. Run 'init' first.")
+        self.use_cache = cache and sys.platform.startswith('linux')
+        self.cache = None
+        self.lock = repository_lock(self.root)
+
+    @classmethod
+    def init(cls, path, author_name, author_email, compression_level=None, fsync=None, chunk_threshold=None, algorithm=None):
+        """Create a repository in path (which must exist) and open it."""
+        token = REPOSITORY_ROOT.set(os.path.abspath(path))
+        try:
+            initialize_vcs(author_name, author_email, compression_level, fsync, chunk_threshold, algorithm)
+        finally:
+            REPOSITORY_ROOT.reset(token)
+        return cls(path)
+
+    @contextlib.contextmanager
+    def entered(self):
+        """Run the block in the repository's root with its caches active."""
+        with self.lock:
+            if REPOSITORY_ROOT.get() == self.root:
+                # A call made by another method of the same repository
+                yield self
+                return
+            root_token = REPOSITORY_ROOT.set(self.root)
+            try:
+                if self.use_cache and self.cache is None:
+                    self.cache = RepositoryCache(self.root)
+                if self.cache is not None:
+                    self.cache.refresh()
+                cache_token = REPOSITORY_CACHE.set(self.cache)
+                try:
+                    OBJECT_CACHE.resize(object_cache_budget())
+                    yield self
+                finally:
+                    REPOSITORY_CACHE.reset(cache_token)
+            finally:
+                REPOSITORY_ROOT.reset(root_token)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group operations so they share one index write and one pass of fsyncs.
+
+        Inside the batch the index is kept in memory and written when the block ends; new
+        objects are synced then too, except that a commit syncs what it points its branch at
+        before moving it. When the block raises the index is left as it was.
+        """
+        with self.entered():
+            if PENDING_INDEX.get() is not None:
+                yield self
+                return
+            token = PENDING_INDEX.set(load_index(missing_ok=True))
+            try:
+                with object_transaction():
+                    yield self
+                index_data = PENDING_INDEX.get()
+            finally:
+                PENDING_INDEX.reset(token)
+            write_index(index_data, durable=True)
+
+    def steps(self, items):
+        """Yield from an iterator over repository data, entering the repository for each step only."""
+        done = object()
+        while True:
+            # The repository is only entered while reading, never while the caller runs
+            with self.entered():
+                item = next(items, done)
+            if item is done:
+                return
+            yield item
+
+    def add(self, paths=(), add_all=False, jobs=None):
+        """Stage files, directories or glob patterns and return the summary of add_paths (None when nothing matched)."""
+        with self.entered():
+            return add_paths(paths, add_all, jobs)
+
+    def stage(self, paths=(), add_all=False, jobs=None):
+        """Stage files, directories or glob patterns and return a dict of path -> blob hash (None for a deletion)."""
+        with self.entered():
+            filepaths = expand_add_paths(paths, add_all)
+            if not filepaths:
+                return {}
+            return {path: hashed_content for path, hashed_content, *_ in stage_files(filepaths, jobs)}
+
+    def commit(self, message):
+        """Commit the index and return the new commit's hash."""
+        with self.entered():
+            return commit_index(message)
+
+    def status(self):
+        """Return a dict mapping 'modified', 'unmodified', 'new' and 'untracked' to lists of paths."""
+        with self.entered():
+            return status_sections()
+
+    def resolve(self, revision):
+        """Return the commit hash named by HEAD, a branch, a tag or an abbreviated hash."""
+        with self.entered():
+            return resolve_revision(revision)
+
+    def head(self):
+        """Return (branch name, commit hash or None) of HEAD."""
+        with self.entered():
+            return os.path.basename(head_ref_path()), head_commit()
+
+    def log(self, revision='HEAD', limit=None, paths=(), author=None, since=None, until=None, grep=None):
+        """
+        Yield the Commit records of the first-parent history of revision, newest first.
+
+        The filters are those of log_history; since and until are timestamps.
+        """
+        with self.entered():
+            graph = load_commit_graph()
+            history = log_history(resolve_revision(revision), graph, paths, author, since, until, grep)
+        try:
+            yield from self.steps(read_commit(commit_hash) for commit_hash, _ in itertools.islice(history, limit))
+        finally:
+            if graph is not None:
+                graph.close()
+
+    def summaries(self, revision='HEAD', limit=None, paths=(), author=None, since=None, until=None, grep=None):
+        """
+        Yield (hash, timestamp, author, message) for the commits log yields, as 'log --oneline' shows them.
+
+        The summaries come from the commit graph, so commits it holds are not read.
+        """
+        with self.entered():
+            graph = load_commit_graph()
+            history = log_history(resolve_revision(revision), graph, paths, author, since, until, grep)
+        try:
+            yield from self.steps((commit_hash, *commit_summary(commit_hash, graph, position))
+                                  for commit_hash, position in itertools.islice(history, limit))
+        finally:
+            if graph is not None:
+                graph.close()
+
+    def files(self, revision='HEAD'):
+        """Return a dict of path -> blob hash of the files in a commit."""
+        with self.entered():
+            return tree_files(read_commit(resolve_revision(revision)).tree)
+
+    def read_file(self, path, revision='HEAD'):
+        """Return the content of a file as committed in revision."""
+        with self.entered():
+            blob_hash = tree_files(read_commit(resolve_revision(revision)).tree).get(path)
+            if blob_hash is None:
+                raise FileNotFoundError(f"The file '{path}' is not in '{revision}'.")
+            return read_blob(blob_hash).data
+
+    def branches(self):
+        """Return a dict mapping each branch name to its commit (None for an empty branch)."""
+        with self.entered():
+            return {name: commit_hash or None for name, commit_hash in list_refs(BRANCH_PREFIX).items()}
+
+    def create_branch(self, name, revision='HEAD'):
+        """Create a branch at revision and return its commit; HEAD does not move."""
+        with self.entered():
+            # HEAD is left to create_branch, which names its branch when it has no commits
+            return create_branch(name, None if revision == 'HEAD' else resolve_revision(revision))
+
+    def switch_branch(self, name):
+        """Point HEAD at a branch without touching the worktree."""
+        with self.entered():
+            switch_branch(name)
+
+    def delete_branch(self, name):
+        """Delete a branch."""
+        with self.entered():
+            delete_branch(name)
+
+    def tags(self):
+        """Return a dict mapping each tag name to the commit it points to."""
+        with self.entered():
+            return list_tags()
+
+    def create_tag(self, name, revision='HEAD'):
+        """Tag revision and return the tagged commit."""
+        with self.entered():
+            return create_tag(name, resolve_revision(revision))
+
+    def checkout(self, revision, force=False, threads=None):
+        """
+        Make the worktree and the index match revision and return its commit hash.
+
+        Unless force is set, local changes that would be lost (modified, staged or untracked
+        files) raise ValueError instead of being overwritten. threads is that of restore_commit.
+        """
+        with self.entered():
+            commit_hash = resolve_revision(revision)
+            if not force:
+                sections = status_sections()
+                at_risk = sections['modified'] + sections['new'] + sections['untracked']
+                if at_risk:
+                    raise ValueError(f"Checkout would overwrite local changes: {', '.join(at_risk)}")
+            restore_commit(commit_hash, threads)
+            return commit_hash
+
+    def sparse_directories(self):
+        """Return the directories of the sparse cone, or None when the whole tree is checked out."""
+        with self.entered():
+            cone = sparse_cone()
+            return list(cone.directories) if cone is not None else None
+
+    def set_sparse_directories(self, directories):
+        """Set the sparse cone (None for the whole tree) and return (files removed, files written)."""
+        with self.entered():
+            return set_sparse_cone(directories)
+
+    def merge(self, name, into='main'):
+        """Merge the branch name into the branch into and return merge_branch's (commit, fast-forward)."""
+        with self.entered():
+            return merge_branch(name, into)
+
+    def diff(self, revisions=(), cached=False, context=DIFF_CONTEXT):
+        """Yield the unified diff 'diff' prints as bytes, one file at a time; revisions are as for diff_changes."""
+        yield from self.steps(diff_output(list(revisions), cached, context))
+
+    def hash_algorithm(self):
+        """Return the name of the hash object ids are made with."""
+        with self.entered():
+            return hash_algorithm()
+
+    def write_commit_graph(self):
+        """Rewrite the commit graph and return the number of commits in it."""
+        with self.entered():
+            return write_commit_graph()
+
+    def pack_refs(self):
+        """Move the loose branches and tags into packed-refs and return how many were packed."""
+        with self.entered():
+            return pack_refs()
+
+    def repack(self, window=DELTA_WINDOW, depth=MAX_DELTA_DEPTH):
+        """Pack every object and return (objects packed, objects stored as deltas)."""
+        with self.entered():
+            return repack(window, depth)
+
+    def gc(self, grace=GC_GRACE_PERIOD, repack_objects=False):
+        """Delete the unreachable objects older than grace seconds and return gc's dict of what was reclaimed."""
+        with self.entered():
+            return gc(grace, repack_objects)
+
+    def convert_hash(self, algorithm):
+        """Rewrite the repository with object ids made by algorithm and return convert_hash's (objects, repack result)."""
+        with self.entered():
+            return convert_hash(algorithm)
+
+    def migrate_objects(self):
+        """Convert the objects of the old flat layout and return how many there were."""
+        with self.entered():
+            return migrate_objects()
+
+    def close(self):
+        """Release the inotify watches and the open packs."""
+        with self.lock:
+            if self.cache is not None:
+                self.cache.close()
+                self.cache = None
+            token = REPOSITORY_ROOT.set(self.root)
+            try:
+                close_packs()
+            finally:
+                REPOSITORY_ROOT.reset(token)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+# ==================================== Tracing ====================================
+# With --trace (or MYVCS_TRACE) the hot functions below are swapped for wrappers that record
+# calls, bytes and wall time per phase; nothing is wrapped otherwise, so tracing costs nothing
+# when it is off. Times are inclusive (a tree read includes the object read under it) and a
+# phase entered again while it is running is timed once, from its outermost call. Worker
+# processes started by 'add' are not traced.
+
+# function name: (phase, what the bytes of a call are)
+TRACED_FUNCTIONS = {
+    'iter_worktree': ('walk', None),
+    'list_all_files': ('walk', None),
+    'stat_matches': ('stat cache', None),
+    'hash_file': ('hash', 'file'),
+    'store_file': ('hash and store', 'file'),
+    'load_index': ('index read', None),
+    'write_index': ('index write', None),
+    'read_object': ('object read', 'result'),
+    'iter_object': ('object read', 'chunks'),
+    'object_info': ('object info', None),
+    'write_object': ('object write', 'content'),
+    'read_tree': ('tree read', None),
+    'read_commit': ('commit read', None),
+    'read_blob': ('blob read', None),
+    'write_worktree_file': ('worktree write', 'file'),
+}
+TRACE_FILE = 'myvcs-trace.json'
+TRACER = None
+
+class Tracer:
+    """Calls, bytes and wall time per phase, and the spans of a Chrome trace if one was asked for."""
+
+    def __init__(self, chrome=False):
+        self.start = time.perf_counter()
+        # phase -> [calls, bytes, seconds]
+        self.phases = {}
+        # (thread, phase) -> calls running, so the checkout threads each time their own calls
+        self.depth = {}
+        self.events = [] if chrome else None
+        # The checkout threads record their calls concurrently
+        self.lock = threading.Lock()
+
+    def enter(self, phase):
+        """Enter a phase; return True if it was not already running in this thread."""
+        key = (threading.get_ident(), phase)
+        with self.lock:
+            depth = self.depth.get(key, 0)
+            self.depth[key] = depth + 1
+        return depth == 0
+
+    def leave(self, phase, name, start, outermost):
+        """Leave a phase entered at start, timing it if this was its outermost call."""
+        end = time.perf_counter()
+        with self.lock:
+            self.depth[threading.get_ident(), phase] -= 1
+            if not outermost:
+                return
+            self.phases.setdefault(phase, [0, 0, 0.0])[2] += end - start
+            if self.events is not None:
+                self.events.append({'name': name, 'cat': phase, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_native_id(),
+                                    'ts': (start - self.start) * 1e6, 'dur': (end - start) * 1e6})
+
+    def count(self, phase, calls, nbytes):
+        """Add calls and bytes to a phase."""
+        with self.lock:
+            stats = self.phases.setdefault(phase, [0, 0, 0.0])
+            stats[0] += calls
+            stats[1] += nbytes
+
+    def report(self):
+        """Print the per-phase summary table to stderr."""
+        total = time.perf_counter() - self.start
+        print(f"{'phase':<16}{'calls':>10}{'bytes':>14}{'seconds':>10}{'%':>7}", file=sys.stderr)
+        for phase, (calls, nbytes, seconds) in sorted(self.phases.items(), key=lambda item: -item[1][2]):
+            print(f"{phase:<16}{calls:>10}{nbytes:>14}{seconds:>10.4f}{100 * seconds / total:>6.1f}%", file=sys.stderr)
+        print(f"{'total':<16}{'':>10}{'':>14}{total:>10.4f}", file=sys.stderr)
+        cache = OBJECT_CACHE.stats()
+        print(f"object cache: {cache['hits']} hit(s), {cache['misses']} miss(es), {cache['evictions']} eviction(s), "
+              f"{cache['records']} record(s) using {cache['bytes']} of {cache['budget']} bytes", file=sys.stderr)
+
+    def write_chrome_trace(self, path, command):
+        """Write the recorded spans as Chrome trace-event JSON (chrome://tracing, Perfetto)."""
+        total = time.perf_counter() - self.start
+        events = [{'name': command, 'cat': 'command', 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_native_id(), 'ts': 0, 'dur': total * 1e6}]
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events + self.events, 'displayTimeUnit': 'ms'}, trace_file)
+        print(f"Trace with {len(self.events)} span(s) written to {path}.", file=sys.stderr)
+
+def traced_iter(iterator, phase, name, count_bytes=False):
+    """Yield from iterator, timing the work done inside it as part of phase."""
+    while True:
+        outermost = TRACER.enter(phase)
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            TRACER.leave(phase, name, start, outermost)
+        if count_bytes:
+            TRACER.count(phase, 0, len(item))
+        yield item
+
+def traced(function, phase, measure):
+    """Wrap a function so its calls, bytes and time are added to phase."""
+    name = function.__name__
+
+    def wrapper(*args, **kwargs):
+        outermost = TRACER.enter(phase)
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            TRACER.leave(phase, name, start, outermost)
+        if measure == 'file':
+            nbytes = os.path.getsize(repo_path(args[0]))
+        elif measure == 'result':
+            nbytes = len(result)
+        elif measure == 'content':
+            nbytes = len(args[1])
+        else:
+            nbytes = 0
+        TRACER.count(phase, 1, nbytes)
+        if isinstance(result, types.GeneratorType):
+            return traced_iter(result, phase, name)
+        if measure == 'chunks':
+            return result[0], traced_iter(result[1], phase, name, count_bytes=True)
+        return result
+    return wrapper
+
+def enable_tracing(chrome=False):
+    """Start recording the traced functions of this module."""
+    global TRACER
+    TRACER = Tracer(chrome)
+    module_globals = globals()
+    for name, (phase, measure) in TRACED_FUNCTIONS.items():
+        module_globals[name] = traced(module_globals[name], phase, measure)
+
+def trace_setting(summary=False, chrome_path=None):
+    """Return (mode, Chrome trace path) from the command line or MYVCS_TRACE ('summary', 'chrome' or 'chrome:PATH'), or None."""
+    if chrome_path is not None:
+        return 'chrome', chrome_path
+    if summary:
+        return 'summary', None
+    setting = os.environ.get('MYVCS_TRACE', '')
+    if setting in ('', '0'):
+        return None
+    mode, _, path = setting.partition(':')
+    if mode in ('1', 'summary'):
+        return 'summary', None
+    if mode == 'chrome':
+        return 'chrome', path or TRACE_FILE
+    raise ValueError(f"Unknown trace mode '{setting}', use 'summary' or 'chrome[:PATH]'.")
+
 def create_parser():
     """Create and return the command-line argument parser."""
     parser = argparse.ArgumentParser(description="Simple version control system")
+    parser.add_argument("--trace", action='store_true', help="Print calls, bytes and time per phase (or set MYVCS_TRACE=summary).")
+    parser.add_argument("--trace-chrome", metavar="PATH", default=None,
+                        help="Write the phases as Chrome trace-event JSON to PATH (or set MYVCS_TRACE=chrome:PATH).")
+    parser.add_argument("--profile", metavar="PATH", default=None, help="Run the command under cProfile and dump its stats to PATH.")
     subparsers = parser.add_subparsers(dest="command")
 
     # 'init' command
     init_parser = subparsers.add_parser('init', help="Initialize a new version control repository")
     init_parser.add_argument("-n", "--author_name", help="Your name (author)")
     init_parser.add_argument("-e","--author_email", help="Your email (author)")
+    init_parser.add_argument("-c", "--compression_level", type=int, choices=range(0, 10), default=None, help="zlib level objects are compressed with (0-9).")
+    init_parser.add_argument("--chunk-threshold", type=int, default=None, help=f"Store files of at least this many bytes as deduplicated chunks (default {CHUNK_THRESHOLD}).")
+    init_parser.add_argument("--hash", choices=HASH_ALGORITHMS, default=None, help=f"Hash object ids are made with (default {DEFAULT_HASH}; blake2b is the fastest).")
+    init_parser.add_argument("--fsync", choices=FSYNC_MODES, default=None, help="How written objects are made durable: 'batch' fsyncs them in one pass per command (default), 'off' never fsyncs.")
 
     # 'add' command
-    add_parser = subparsers.add_parser("add", help="Stage a file for commit")
-    add_parser.add_argument("filepath", help="Path to the file to add") 
+    add_parser = subparsers.add_parser("add", help="Stage files for commit")
+    add_parser.add_argument("filepaths", nargs='*', help="Files, directories or glob patterns to add") 
+    add_parser.add_argument("-A", "--all", action='store_true', help="Add every file that is not ignored.")
+    add_parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (defaults to the CPU count).")
 
     # 'commit' command
     commit_parser = subparsers.add_parser("commit", help="Commit staged files")
@@ -543,15 +5012,65 @@ def create_parser():
     
     # 'log' command
     log_parser = subparsers.add_parser("log", help="Show commit logs")
-    log_parser.add_argument("-n", "--number", type=int, default=1, help="Number of commits to show")
+    log_parser.add_argument("-n", "--number", type=int, default=1, help="Number of commits to show (0 for all)")
+    log_parser.add_argument("--oneline", action='store_true', help="One line per commit, read from the commit graph only")
+    log_parser.add_argument("--path", action='append', default=[], help="Only commits that changed this file or directory (repeatable)")
+    log_parser.add_argument("--author", help="Only commits whose author name matches this regular expression")
+    log_parser.add_argument("--grep", help="Only commits whose message matches this regular expression")
+    log_parser.add_argument("--since", type=parse_log_date, help="Only commits made at or after this date")
+    log_parser.add_argument("--until", type=parse_log_date, help="Only commits made at or before this date")
+    log_parser.add_argument("--json", action='store_true', help="Print one JSON object per commit")
+    
+    # 'commit-graph' command
+    subparsers.add_parser("commit-graph", help="Rebuild the commit graph used to walk history.")
+    
+    # 'repack' command
+    repack_parser = subparsers.add_parser("repack", help="Pack all objects into one delta-compressed pack file.")
+    repack_parser.add_argument("-w", "--window", type=int, default=DELTA_WINDOW, help="Number of similar objects tried as delta bases.")
+    repack_parser.add_argument("-d", "--depth", type=int, default=MAX_DELTA_DEPTH, help=f"Maximum delta chain length (at most {MAX_DELTA_DEPTH}).")
+    
+    # 'gc' command
+    gc_parser = subparsers.add_parser("gc", help="Delete objects no branch, tag, HEAD or the index can reach.")
+    gc_parser.add_argument("-g", "--grace", type=int, default=GC_GRACE_PERIOD, help="Keep unreachable objects younger than this many seconds.")
+    gc_parser.add_argument("--repack", action='store_true', help="Pack the surviving objects afterwards.")
+    
+    # 'pack-refs' command
+    subparsers.add_parser("pack-refs", help="Move the branch and tag files into the sorted packed-refs file.")
+    
+    # 'convert-hash' command
+    convert_hash_parser = subparsers.add_parser("convert-hash", help="Rewrite every object, ref and the index with ids made by another hash.")
+    convert_hash_parser.add_argument("algorithm", choices=HASH_ALGORITHMS, help="The hash to switch to.")
+
+    # 'migrate-objects' command
+    subparsers.add_parser("migrate-objects", help="Convert objects from the old flat layout to compressed fan-out directories.")
+    
+    # 'diff' command
+    diff_parser = subparsers.add_parser("diff", help="Show line changes between the worktree, the index and commits.")
+    diff_parser.add_argument("revisions", nargs='*', help="Up to two commits, branches or tags to compare.")
+    diff_parser.add_argument("--cached", action='store_true', help="Compare the index with HEAD (or the given revision).")
+    diff_parser.add_argument("-U", "--unified", type=int, default=DIFF_CONTEXT, help="Lines of context around each change.")
     
     # 'status' command
     subparsers.add_parser("status", help="Show the current status")
     
+    # 'watch' command
+    watch_parser = subparsers.add_parser("watch", help="Run a daemon that keeps status answers up to date (Linux).")
+    watch_parser.add_argument("--stop", action='store_true', help="Stop the running watch daemon.")
+    
+    # 'serve' command
+    serve_parser = subparsers.add_parser("serve", help="Keep a process running that myvcs_client.py sends commands to (Linux).")
+    serve_parser.add_argument("--stop", action='store_true', help="Stop the running server.")
+    
     # 'checkout' command
     checkout_parser = subparsers.add_parser("checkout", help="Restore Files from a given commit.")
     checkout_parser.add_argument("-ch", "--commit_hash", type=str, default=None, help="Use log command to see copy the hash.")
     checkout_parser.add_argument("-f", "--force", action='store_true', help="Force checkout.")
+    checkout_parser.add_argument("-j", "--jobs", type=int, default=None, help=f"Threads writing files (default: checkout_threads in the config, or {CHECKOUT_THREADS}).")
+
+    # 'sparse-checkout' command
+    sparse_parser = subparsers.add_parser("sparse-checkout", help="Show or set the directories a sparse checkout keeps.")
+    sparse_parser.add_argument("directories", nargs='*', help="Directories to keep in the worktree (besides the top-level files)")
+    sparse_parser.add_argument("--disable", action='store_true', help="Check out the whole tree again.")
     
     # 'tag' command
     tag_parser = subparsers.add_parser("tag", help="Add a tag to the current commit.")
@@ -567,30 +5086,170 @@ def create_parser():
     branch_parser.add_argument("-i", "--into", type=str, default='main', help="The default merge will be MAIN, but you can pick another branch to merge into.")
     return parser  
     
-def func_main():
-    """Main function to handle the command-line interaction."""
-    parser = create_parser()
-    args = parser.parse_args()
-    
+def run_command(parser, args, repository=None):
+    """Run the command selected on the command line in repository (the one in the current directory by default)."""
     if args.command == 'init':
-        initialize_vcs(args.author_name, args.author_email)
+        Repository.init(os.getcwd(), args.author_name, args.author_email, args.compression_level, args.fsync,
+                        args.chunk_threshold, args.hash)
         print("Version control system initialized.")
-    elif args.command == 'add':
-        add_file(args.filepath)
+        return
+    if args.command is None:
+        print("Invalid command. Use 'help' for a list of commands.")
+        return
+    if repository is None:
+        # A single command gains nothing from the inotify caches
+        repository = Repository(os.getcwd(), cache=False)
+    run_repository_command(parser, args, repository)
+
+def run_repository_command(parser, args, repository):
+    """Run a command other than 'init' through the methods of repository and print what they return."""
+    if args.command == 'add':
+        if not args.filepaths and not args.all:
+            parser.error("add needs at least one path, or -A")
+        print_add_summary(repository.add(args.filepaths, args.all, args.jobs))
     elif args.command == 'commit':
-        create_commit(args.message)
+        print(f"Commit created with hash: {repository.commit(args.message)}")
     elif args.command == 'log':
-        log_commit(args.number)
+        run_log(repository, args)
+    elif args.command == 'commit-graph':
+        print(f"Commit graph written with {repository.write_commit_graph()} commit(s).")
+    elif args.command == 'repack':
+        print_repack_result(repository.repack(args.window, args.depth))
+    elif args.command == 'gc':
+        print_gc_result(repository.gc(args.grace, args.repack))
+    elif args.command == 'pack-refs':
+        print(f"Packed {repository.pack_refs()} ref(s).")
+    elif args.command == 'convert-hash':
+        previous = repository.hash_algorithm()
+        converted, packed = repository.convert_hash(args.algorithm)
+        if packed is not None:
+            print_repack_result(packed)
+        print(f"Converted {converted} object(s) from {previous} to {args.algorithm}.")
+    elif args.command == 'migrate-objects':
+        migrated = repository.migrate_objects()
+        if migrated:
+            print(f'Migrated {migrated} object(s) to the compressed layout.')
+        else:
+            print('No objects to migrate.')
+    elif args.command == 'diff':
+        write_diff(repository.diff(args.revisions, args.cached, args.unified))
     elif args.command == 'status':
-        status_check()
+        print_status(repository.status())
+    elif args.command in ('watch', 'serve'):
+        # The daemons run in the repository until stopped
+        with repository.entered():
+            if args.command == 'watch' and args.stop:
+                stop_watch_daemon()
+            elif args.command == 'watch':
+                run_watch_daemon()
+            elif args.stop:
+                stop_server()
+            else:
+                run_server()
     elif args.command == 'checkout':
-        checkout(args.commit_hash, args.force)
+        run_checkout(repository, args)
+    elif args.command == 'sparse-checkout':
+        if args.directories or args.disable:
+            try:
+                removed, written = repository.set_sparse_directories(None if args.disable else args.directories)
+            except ValueError as error:
+                raise SystemExit(f"Sparse checkout aborted. {error}")
+            print(f"Sparse cone updated: {removed} file(s) removed, {written} file(s) written.")
+        else:
+            directories = repository.sparse_directories()
+            if directories is None:
+                print("Sparse checkout is off, the whole tree is checked out.")
+            for directory in directories or ():
+                print(directory)
     elif args.command == 'tag':
-        add_tag(args.tag_name)
+        repository.create_tag(args.tag_name)
+        print(f'Tag created successfully. Tag: {args.tag_name}')
     elif args.command == 'branch':
-        branch(args.name, args.list, args.delete, args.change_branch, args.merge, args.into)
+        run_branch(repository, args)
     else:
         print("Invalid command. Use 'help' for a list of commands.")
+
+def run_log(repository, args):
+    """Print the history of HEAD for 'log'; --oneline reads only the commit graph."""
+    branch_name, head = repository.head()
+    if head is None:
+        raise FileNotFoundError(f"The branch '{BRANCH_PREFIX + branch_name}' has no commits.")
+    # -n 0 prints every commit
+    limit = args.number or None
+    filters = (args.path, args.author, args.since, args.until, args.grep)
+    if args.json:
+        for commit in repository.log('HEAD', limit, *filters):
+            print(json.dumps(commit_record(commit)))
+        return
+    if args.oneline:
+        for summary in repository.summaries('HEAD', limit, *filters):
+            print_summary(*summary)
+        return
+    # One commit past the limit is read to know whether the history goes on
+    for i, commit in enumerate(repository.log('HEAD', limit + 1 if limit else None, *filters)):
+        if i == limit:
+            return
+        if i > 0:
+            print("\n")
+        print_commit(commit, repository.files(commit.hash))
+    print("\n(No more commits to print.)")
+
+def run_checkout(repository, args):
+    """Restore a commit for 'checkout', asking first when local changes would be lost."""
+    if not args.force:
+        confirm_checkout(repository.status())
+    revision = args.commit_hash
+    # 'main' names the commit HEAD is on
+    if revision == 'main':
+        branch_name, head = repository.head()
+        if head is None:
+            raise FileNotFoundError(f"The branch '{ref_file(BRANCH_PREFIX + branch_name)}' has no commits.")
+        revision = head
+    repository.checkout(revision, force=True, threads=args.jobs)
+
+def run_branch(repository, args):
+    """Create, delete, switch, merge or list branches for 'branch'."""
+    if args.name is not None:
+        current_head, _ = repository.head()
+        repository.create_branch(args.name)
+        repository.switch_branch(args.name)
+        print(f'From {current_head}, branch {args.name} was created successfully.')
+    elif args.delete is not None:
+        repository.delete_branch(args.delete)
+        print(f'Branch {args.delete} deleted successfully.')
+    elif args.change_branch is not None:
+        repository.switch_branch(args.change_branch)
+        print(f'Switched to branch: {args.change_branch}')
+    elif args.merge is not None:
+        print_merge(args.merge, args.into, *repository.merge(args.merge, args.into))
+    elif args.list:
+        print_branches(list(repository.branches()))
+    else:
+        raise ValueError("Invalid command.")
+
+def func_main():
+    """Main function to handle the command-line interaction."""
+    parser = create_parser()
+    args = parser.parse_args()
+    trace = trace_setting(args.trace, args.trace_chrome)
+    if trace is not None:
+        enable_tracing(chrome=trace[0] == 'chrome')
+    try:
+        if args.profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run_command, parser, args)
+            finally:
+                profiler.dump_stats(args.profile)
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(15)
+        else:
+            run_command(parser, args)
+    finally:
+        if trace is not None:
+            if trace[0] == 'chrome':
+                TRACER.write_chrome_trace(trace[1], args.command or '')
+            else:
+                TRACER.report()
         
 if __name__ == "__main__":
     func_main()
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""
+Thin client for 'myvcs.py serve'.
+
+Forwards its arguments to the server of the repository in the current directory and streams
+the output back, exiting with the command's status. Only the standard modules it needs are
+imported, so a command costs little more than the interpreter startup. Without a running
+server the command is run by myvcs.py directly.
+"""
+import os
+import socket
+import struct
+import sys
+
+SERVE_SOCKET_PATH = '.myvcs/serve.sock'
+SERVE_FRAME = struct.Struct('>BI')
+SERVE_STDOUT = 1
+SERVE_STDERR = 2
+SERVE_EXIT = 3
+MYVCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myvcs.py')
+
+def func_main():
+    """Send the command line to the server and copy its frames to stdout and stderr."""
+    argv = sys.argv[1:]
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SERVE_SOCKET_PATH)
+    except OSError:
+        client.close()
+        os.execv(sys.executable, [sys.executable, MYVCS] + argv)
+
+    outputs = {SERVE_STDOUT: sys.stdout.buffer, SERVE_STDERR: sys.stderr.buffer}
+    with client:
+        client.sendall(b''.join(os.fsencode(arg) + b'\0' for arg in argv))
+        client.shutdown(socket.SHUT_WR)
+        reader = client.makefile('rb')
+        while True:
+            header = reader.read(SERVE_FRAME.size)
+            if len(header) < SERVE_FRAME.size:
+                sys.exit("The server closed the connection before the command finished.")
+            channel, length = SERVE_FRAME.unpack(header)
+            payload = reader.read(length)
+            if channel == SERVE_EXIT:
+                sys.exit(int(payload))
+            outputs[channel].write(payload)
+            outputs[channel].flush()
+
+if __name__ == "__main__":
+    func_main()
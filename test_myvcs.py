@@ -0,0 +1,117 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import myvcs
+
+MYVCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myvcs.py')
+
+def run_myvcs(repo_dir, *args):
+    """Run a myvcs command in repo_dir and return its output."""
+    return subprocess.run([sys.executable, MYVCS, *args], cwd=repo_dir, check=True,
+                          capture_output=True, text=True).stdout
+
+def write_file(repo_dir, path, content):
+    """Write a worktree file, creating its folder."""
+    path = os.path.join(repo_dir, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(content)
+
+def committed_files(repo_dir):
+    """Return the paths in the tree of HEAD's commit."""
+    output = run_myvcs(repo_dir, 'log', '-n', '1')
+    return {line.split()[-1] for line in output.splitlines() if line.startswith(('File(s):', '      '))}
+
+@pytest.fixture
+def repo(tmp_path):
+    """A repository with one commit of a.txt, b.txt, sub/c.txt and sub/d.txt."""
+    run_myvcs(tmp_path, 'init', '-n', 'tester', '-e', 'tester@example.com')
+    for path in ('a.txt', 'b.txt', 'sub/c.txt', 'sub/d.txt'):
+        write_file(tmp_path, path, f'{path}\n')
+    run_myvcs(tmp_path, 'add', '-A')
+    run_myvcs(tmp_path, 'commit', '-m', 'first')
+    return tmp_path
+
+def test_commit_deletion_of_named_file(repo):
+    os.remove(repo / 'a.txt')
+    run_myvcs(repo, 'add', 'a.txt')
+    run_myvcs(repo, 'commit', '-m', 'delete a.txt')
+    assert committed_files(repo) == {'b.txt', 'sub/c.txt', 'sub/d.txt'}
+
+def test_commit_deletions_with_add_all_and_directories(repo):
+    os.remove(repo / 'sub' / 'c.txt')
+    run_myvcs(repo, 'add', 'sub')
+    run_myvcs(repo, 'commit', '-m', 'delete sub/c.txt')
+    assert committed_files(repo) == {'a.txt', 'b.txt', 'sub/d.txt'}
+
+    os.remove(repo / 'b.txt')
+    os.remove(repo / 'sub' / 'd.txt')
+    run_myvcs(repo, 'add', '-A')
+    run_myvcs(repo, 'commit', '-m', 'delete b.txt and sub/d.txt')
+    assert committed_files(repo) == {'a.txt'}
+
+def test_unstaged_deletion_is_not_committed(repo):
+    os.remove(repo / 'a.txt')
+    write_file(repo, 'b.txt', 'changed\n')
+    run_myvcs(repo, 'add', 'b.txt')
+    run_myvcs(repo, 'commit', '-m', 'change b.txt')
+    assert committed_files(repo) == {'a.txt', 'b.txt', 'sub/c.txt', 'sub/d.txt'}
+
+def test_object_cache_resize_evicts_least_recently_used():
+    cache = myvcs.ObjectCache(budget=1000)
+    for name in ('a', 'b', 'c'):
+        cache.put(name, myvcs.Blob(name, b''), 100)
+    cache.get('a', myvcs.Blob)
+    cache.resize(250)
+    assert list(cache.records) == ['c', 'a']
+    assert cache.size == 200 and cache.evictions == 1
+
+def test_object_cache_budget_from_config(repo):
+    with open(repo / '.myvcs' / 'config', 'a') as config_file:
+        config_file.write('object_cache_budget=4096\n')
+    try:
+        with myvcs.Repository(repo, cache=False) as repository:
+            list(repository.log())
+            assert myvcs.OBJECT_CACHE.budget == 4096
+            assert myvcs.OBJECT_CACHE.size <= 4096
+    finally:
+        myvcs.OBJECT_CACHE.resize(myvcs.OBJECT_CACHE_BUDGET)
+
+def test_repositories_used_from_threads_keep_the_working_directory(tmp_path):
+    repositories = []
+    for name in ('one', 'two'):
+        os.mkdir(tmp_path / name)
+        repositories.append(myvcs.Repository.init(tmp_path / name, 'tester', 'tester@example.com'))
+    cwd = os.getcwd()
+
+    def work(repository):
+        for n in range(5):
+            write_file(repository.root, f'sub/{n}.txt', f'{n}\n')
+            repository.stage(add_all=True)
+            repository.commit(f'commit {n}')
+
+    threads = [threading.Thread(target=work, args=(repository,)) for repository in repositories]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.getcwd() == cwd
+    for repository in repositories:
+        with repository:
+            assert len(list(repository.log())) == 5
+            assert sorted(repository.files()) == [f'sub/{n}.txt' for n in range(5)]
+
+def test_repository_methods_return_what_the_commands_print(repo):
+    write_file(repo, 'a.txt', 'changed\n')
+    with myvcs.Repository(repo, cache=False) as repository:
+        assert b''.join(repository.diff()).startswith(b'diff --myvcs a/a.txt b/a.txt\n')
+        summary = repository.add(['a.txt'])
+        assert (summary['files'], summary['deleted'], summary['objects']) == (1, 0, 1)
+        commit_hash = repository.commit('change a.txt')
+        [(summary_hash, _, author, message)] = repository.summaries(limit=1)
+        assert (summary_hash, author, message) == (commit_hash, 'tester', 'change a.txt')
+        assert repository.merge('main', 'main') == (None, False)